@@ -119,7 +119,7 @@ def websocket_client_example():
             print("WebSocket连接已关闭")
         
         # 连接到WebSocket服务器
-        ws = websocket.WebSocketApp("ws://localhost:8080/ws",
+        ws = websocket.WebSocketApp("ws://localhost:8000/ws",
                                    on_message=on_message,
                                    on_open=on_open,
                                    on_error=on_error,
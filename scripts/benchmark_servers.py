@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地服务器吞吐量基准测试 - WutheringWaves Navigator
+对比原来的 ThreadingTCPServer 文件服务器 (legacy) 和 hosting.ServerHost (host:<工作进程数>)：
+在合成的瓦片目录上以不同并发数请求瓦片和静态文件，记录每秒请求数、延迟分位数、错误数和平稳停止耗时，
+输出可跨提交对比的 JSON 报告。纯命令行运行，不依赖 Qt。
+
+使用方法:
+1. 默认对比: python benchmark_servers.py
+2. 指定模式和并发: python benchmark_servers.py --modes legacy,host:1,host:4 --concurrency 16,128
+3. 与旧报告对比: python benchmark_servers.py --compare old_report.json
+
+每个服务器模式在独立的子进程中运行，压测客户端分布在 --client-processes 个进程中，避免客户端成为瓶颈。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import platform
+import argparse
+import subprocess
+import multiprocessing
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+SRC_DIR = SCRIPT_DIR.parent / 'src'
+sys.path.insert(0, str(SRC_DIR))
+
+BENCH_MAP = 'bench'
+# 合成地图的缩放级别 0..MAX_ZOOM
+MAX_ZOOM = 4
+# 静态文件请求所占比例（其余为瓦片请求）
+STATIC_RATIO = 0.1
+STATIC_FILE = 'index.html'
+
+
+# --- 合成数据 ---
+def make_root(work_dir):
+    """生成瓦片目录、maps.json 和一个静态页面，已存在时复用"""
+    from PIL import Image, ImageDraw
+
+    root = Path(work_dir) / 'root'
+    marker = root / 'tiles' / BENCH_MAP / str(MAX_ZOOM)
+    if not marker.exists():
+        print("[GEN] 生成合成瓦片 ...")
+        rng = random.Random(0)
+        for z in range(MAX_ZOOM + 1):
+            for x in range(2 ** z):
+                tile_dir = root / 'tiles' / BENCH_MAP / str(z) / str(x)
+                tile_dir.mkdir(parents=True, exist_ok=True)
+                for y in range(2 ** z):
+                    img = Image.effect_noise((256, 256), 24).convert('RGB')
+                    draw = ImageDraw.Draw(img)
+                    for _ in range(8):
+                        points = [(rng.randrange(256), rng.randrange(256)) for _ in range(4)]
+                        draw.line(points, fill=(200, 180, 90), width=3)
+                    img.save(tile_dir / f'{y}.png', 'PNG')
+        (root / 'maps.json').write_text(json.dumps({'maps': []}), encoding='utf-8')
+        (root / STATIC_FILE).write_text('<!DOCTYPE html><html><body>' + 'x' * 20000 + '</body></html>',
+                                        encoding='utf-8')
+    return root
+
+
+def list_urls():
+    urls = []
+    for z in range(MAX_ZOOM + 1):
+        for x in range(2 ** z):
+            for y in range(2 ** z):
+                urls.append(f'/tiles/{BENCH_MAP}/{z}/{x}/{y}.png')
+    return urls
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# --- 服务器（在子进程中运行）---
+def serve_legacy(root, port):
+    """原来的文件服务器: ThreadingTCPServer + SimpleHTTPRequestHandler，每个连接一个线程"""
+    from http.server import SimpleHTTPRequestHandler
+    from socketserver import ThreadingTCPServer
+    from tile_store import TileStore, parse_tile_path, TILE_CACHE_CONTROL
+
+    tile_store = TileStore(os.path.join(root, 'tiles'))
+
+    class LocalFileHandler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=root, **kwargs)
+
+        def do_GET(self):
+            tile_request = parse_tile_path(self.path)
+            if tile_request:
+                tile = tile_store.get_tile(*tile_request)
+                if tile is None:
+                    self.send_error(404, "Tile not found")
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", tile.content_type)
+                self.send_header("Content-Length", str(len(tile.data)))
+                self.send_header("ETag", tile.etag)
+                self.send_header("Cache-Control", TILE_CACHE_CONTROL)
+                self.end_headers()
+                self.wfile.write(tile.data)
+                return
+            super().do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    ThreadingTCPServer.allow_reuse_address = True
+    server = ThreadingTCPServer(('127.0.0.1', port), LocalFileHandler)
+    server.daemon_threads = True
+    import threading
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+    return stop
+
+
+def serve_host(root, port, workers, threads):
+    from hosting import ServerHost, HostingConfig
+    host = ServerHost(HostingConfig(host='127.0.0.1', port=port, workers=workers, threads=threads, root_dir=root,
+                                    journal=False))
+    host.start()
+    return host.close
+
+
+def run_server(mode, root, port, threads):
+    """启动服务器后输出 READY，读到标准输入的一行后平稳停止，输出停止耗时"""
+    if mode == 'legacy':
+        stop = serve_legacy(root, port)
+    else:
+        stop = serve_host(root, port, int(mode.split(':')[1]), threads)
+    print('READY', flush=True)
+    sys.stdin.readline()
+    start = time.perf_counter()
+    stop()
+    print(json.dumps({'shutdown_seconds': round(time.perf_counter() - start, 3)}), flush=True)
+
+
+# --- 压测客户端（在子进程中运行）---
+def run_client(base_url, urls, connections, duration, seed):
+    """在 duration 秒内以 connections 个并发连接循环请求，返回 (请求数, 错误数, 传输字节数, 延迟毫秒列表)"""
+    return asyncio.run(_client_main(base_url, urls, connections, duration, seed))
+
+
+async def _client_main(base_url, urls, connections, duration, seed):
+    import aiohttp
+    rng = random.Random(seed)
+    latencies = []
+    counters = {'requests': 0, 'errors': 0, 'bytes': 0}
+    deadline = time.perf_counter() + duration
+    connector = aiohttp.TCPConnector(limit=connections)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def loop():
+            while time.perf_counter() < deadline:
+                path = '/' + STATIC_FILE if rng.random() < STATIC_RATIO else rng.choice(urls)
+                start = time.perf_counter()
+                try:
+                    async with session.get(base_url + path) as response:
+                        body = await response.read()
+                        if response.status != 200:
+                            counters['errors'] += 1
+                            continue
+                except (aiohttp.ClientError, OSError, asyncio.TimeoutError):
+                    counters['errors'] += 1
+                    continue
+                latencies.append((time.perf_counter() - start) * 1000)
+                counters['requests'] += 1
+                counters['bytes'] += len(body)
+
+        await asyncio.gather(*(loop() for _ in range(connections)))
+    return counters['requests'], counters['errors'], counters['bytes'], latencies
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return round(sorted_values[index], 2)
+
+
+# --- 主流程 ---
+class ServerBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = Path(args.work_dir).absolute()
+        self.results = []
+
+    def run(self):
+        modes = [item.strip() for item in self.args.modes.split(',') if item.strip()]
+        for mode in modes:
+            if mode != 'legacy' and not (mode.startswith('host:') and mode[5:].isdigit() and int(mode[5:]) > 0):
+                print(f"[ERROR] 未知模式: {mode}，可选: legacy, host:<工作进程数>")
+                sys.exit(1)
+        concurrency = [int(item) for item in self.args.concurrency.split(',') if item.strip()]
+        root = make_root(self.work_dir)
+        urls = list_urls()
+
+        for mode in modes:
+            for level in concurrency:
+                self.results.append(self.run_case(mode, level, root, urls))
+
+        report = {'meta': self.collect_meta(), 'results': self.results}
+        with open(self.args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n[DONE] 报告已写入 {self.args.output}")
+
+        if self.args.compare:
+            compare_reports(self.args.compare, report)
+
+        if not self.args.keep_output:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def run_case(self, mode, level, root, urls):
+        case = {'mode': mode, 'concurrency': level, 'threads': self.args.threads}
+        port = free_port()
+        command = [sys.executable, __file__, '--serve', mode, str(root), str(port), str(self.args.threads)]
+        server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        print(f"[RUN] {mode:<8} c={level:<4} ...", end=' ', flush=True)
+        try:
+            if server.stdout.readline().strip() != 'READY':
+                print("失败")
+                case['error'] = 'server did not start'
+                return case
+
+            processes = max(1, min(self.args.client_processes, level))
+            per_process = [level // processes + (1 if i < level % processes else 0) for i in range(processes)]
+            base_url = f'http://127.0.0.1:{port}'
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(processes) as pool:
+                start = time.perf_counter()
+                outputs = pool.starmap(run_client, [(base_url, urls, n, self.args.duration, i)
+                                                    for i, n in enumerate(per_process)])
+                elapsed = time.perf_counter() - start
+
+            latencies = sorted(value for output in outputs for value in output[3])
+            requests = sum(output[0] for output in outputs)
+            case.update({
+                'requests': requests,
+                'errors': sum(output[1] for output in outputs),
+                'requests_per_second': round(requests / self.args.duration, 1),
+                'megabytes_per_second': round(sum(output[2] for output in outputs) / self.args.duration / 2 ** 20, 2),
+                'latency_ms': {'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95),
+                               'p99': percentile(latencies, 0.99)},
+                'wall_seconds': round(elapsed, 2),
+            })
+        finally:
+            try:
+                server.stdin.write('stop\n')
+                server.stdin.flush()
+                output, _ = server.communicate(timeout=30)
+                lines = output.strip().splitlines()
+                if lines:
+                    case.update(json.loads(lines[-1]))
+            except (subprocess.TimeoutExpired, OSError, ValueError):
+                server.kill()
+                case['shutdown_seconds'] = None
+        if 'requests' in case:
+            print(f"{case['requests_per_second']:.0f} req/s, p50 {case['latency_ms']['p50']} ms, "
+                  f"p99 {case['latency_ms']['p99']} ms, {case['errors']} errors, "
+                  f"stop {case.get('shutdown_seconds')}s")
+        return case
+
+    def collect_meta(self):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                    capture_output=True, text=True).stdout.strip() or None
+        except OSError:
+            commit = None
+        import aiohttp
+        return {
+            'commit': commit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'aiohttp': aiohttp.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'duration': self.args.duration,
+            'client_processes': self.args.client_processes,
+        }
+
+
+def compare_reports(old_path, new_report):
+    """按 (模式, 并发数) 对比两份报告的吞吐量和 p99 延迟"""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old_report = json.load(f)
+    old_results = {(r['mode'], r['concurrency']): r for r in old_report['results'] if 'error' not in r}
+
+    print(f"\n[COMPARE] {old_report['meta'].get('commit')} -> {new_report['meta'].get('commit')}")
+    for result in new_report['results']:
+        old = old_results.get((result['mode'], result['concurrency']))
+        if old is None or 'error' in result:
+            continue
+        rps_delta = (result['requests_per_second'] - old['requests_per_second']) / old['requests_per_second'] * 100 \
+            if old['requests_per_second'] else 0
+        old_p99, new_p99 = old['latency_ms']['p99'], result['latency_ms']['p99']
+        p99_delta = (new_p99 - old_p99) / old_p99 * 100 if old_p99 and new_p99 is not None else 0
+        print(f"  {result['mode']:<8} c={result['concurrency']:<4} req/s {rps_delta:+6.1f}%  p99 {p99_delta:+6.1f}%")
+
+
+def main():
+    if len(sys.argv) == 6 and sys.argv[1] == '--serve':
+        run_server(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+        return
+
+    parser = argparse.ArgumentParser(description='本地服务器吞吐量基准测试')
+    parser.add_argument('--modes', default='legacy,host:1,host:4',
+                        help='服务器模式，逗号分隔: legacy 或 host:<工作进程数>')
+    parser.add_argument('--concurrency', default='8,64', help='并发连接数列表，逗号分隔')
+    parser.add_argument('--duration', type=float, default=10.0, help='每个用例的压测秒数')
+    parser.add_argument('--threads', type=int, default=8, help='host 模式每个进程的线程数')
+    parser.add_argument('--client-processes', type=int, default=min(4, os.cpu_count() or 1),
+                        help='压测客户端进程数')
+    parser.add_argument('--work-dir', default='bench_servers_work', help='合成瓦片目录')
+    parser.add_argument('--output', default='bench_servers_report.json', help='JSON 报告路径')
+    parser.add_argument('--compare', help='与之前的 JSON 报告对比')
+    parser.add_argument('--keep-output', action='store_true', help='保留合成瓦片目录')
+    args = parser.parse_args()
+
+    ServerBenchmark(args).run()
+
+
+if __name__ == '__main__':
+    main()
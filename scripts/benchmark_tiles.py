@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+瓦片生成基准测试 - WutheringWaves Navigator
+生成不同尺寸和类型的合成地图，对 tile_generator 的每种生成模式计时，
+记录耗时、峰值内存、瓦片数量和磁盘占用，输出可跨提交对比的 JSON 报告。
+纯命令行运行，不依赖 Qt。
+
+使用方法:
+1. 全部用例: python benchmark_tiles.py
+2. 指定尺寸和类型: python benchmark_tiles.py --sizes 2k,8k --kinds map
+3. 指定模式: python benchmark_tiles.py --modes tiles:webp:archive,process_image
+4. 与旧报告对比: python benchmark_tiles.py --compare old_report.json
+
+注意: 32k 用例需要约 8GB 可用内存。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import statistics
+import shutil
+import platform
+import argparse
+import subprocess
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+SRC_DIR = SCRIPT_DIR.parent / 'src'
+sys.path.insert(0, str(SRC_DIR))
+
+SIZES = {'2k': 2048, '8k': 8192, '16k': 16384, '32k': 32768}
+KINDS = ('noise', 'flat', 'map')
+
+
+def list_modes():
+    """列出所有生成模式: process_image 默认流程 + 每种格式与存储方式组合的强制瓦片化"""
+    from tile_generator import get_available_tile_formats, TILE_STORAGES
+    modes = ['process_image']
+    for tile_format in get_available_tile_formats():
+        for storage in TILE_STORAGES:
+            modes.append(f'tiles:{tile_format}:{storage}')
+    return modes
+
+
+# --- 合成地图 ---
+def make_source_image(kind, size, path):
+    """生成合成源图并保存为 PNG"""
+    from PIL import Image, ImageDraw, ImageFilter
+
+    if kind == 'flat':
+        img = Image.new('RGB', (size, size), (96, 128, 88))
+    elif kind == 'noise':
+        # 高熵图像，压缩最困难的情况
+        channels = [Image.effect_noise((size, size), 96) for _ in range(3)]
+        img = Image.merge('RGB', channels)
+    else:
+        # 类地图图像: 低频地形 + 调色板着色 + 道路和河流线条
+        rng = random.Random(size)
+        terrain = Image.effect_noise((max(size // 64, 8), max(size // 64, 8)), 64)
+        terrain = terrain.filter(ImageFilter.GaussianBlur(2)).resize((size, size), Image.Resampling.BICUBIC)
+        palette = [(40, 80, 160)] * 90 + [(210, 200, 150)] * 20 + [(90, 150, 70)] * 80 + \
+                  [(60, 110, 50)] * 40 + [(130, 120, 110)] * 16 + [(240, 240, 240)] * 10
+        lut = [channel for index in range(256) for channel in [palette[min(index, len(palette) - 1)][c] for c in range(3)]]
+        img = terrain.convert('P')
+        img.putpalette(lut)
+        img = img.convert('RGB')
+        draw = ImageDraw.Draw(img)
+        for _ in range(max(size // 256, 4)):
+            points = [(rng.randrange(size), rng.randrange(size)) for _ in range(6)]
+            draw.line(points, fill=(200, 180, 90), width=max(size // 1024, 2))
+
+    img.save(path, 'PNG', compress_level=1)
+
+
+def get_source_image(work_dir, kind, size_name):
+    """复用已生成的源图，避免每个模式都重新生成"""
+    sources_dir = Path(work_dir) / 'sources'
+    sources_dir.mkdir(parents=True, exist_ok=True)
+    path = sources_dir / f'{kind}_{size_name}.png'
+    if not path.exists():
+        print(f"[GEN] 生成源图 {path.name} ...")
+        make_source_image(kind, SIZES[size_name], path)
+    return path
+
+
+# --- 单个用例（在子进程中运行，保证峰值内存互不影响）---
+def measure_output(run_dir):
+    """统计输出目录中的瓦片数量和磁盘占用"""
+    from tile_archive import TileArchiveReader, ARCHIVE_EXT
+    tiles_written = 0
+    bytes_on_disk = 0
+    for root, _, files in os.walk(run_dir):
+        for name in files:
+            if name.startswith('maps.json'):
+                continue
+            path = os.path.join(root, name)
+            bytes_on_disk += os.path.getsize(path)
+            if name.endswith(ARCHIVE_EXT):
+                reader = TileArchiveReader(path)
+                tiles_written += len(reader)
+                reader.close()
+            elif os.path.relpath(root, run_dir).startswith('tiles') and not name.startswith('source'):
+                tiles_written += 1
+    return tiles_written, bytes_on_disk
+
+
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def run_case(source_path, mode, run_dir):
+    """在 run_dir 中执行一个生成模式并返回测量结果"""
+    os.chdir(run_dir)
+    import tile_generator
+
+    result = {}
+    start = time.perf_counter()
+    if mode == 'process_image':
+        tile_generator.process_image(str(source_path))
+    else:
+        _, tile_format, storage = mode.split(':')
+        _, width, height = tile_generator.get_image_info(str(source_path))
+        map_name = Path(source_path).stem
+        tile_generator.generate_tiles(str(source_path), map_name, width, height, tile_format, storage)
+        if storage == tile_generator.TILE_STORAGE_LAZY:
+            # 可浏览时间 + 后台补全全部瓦片所需时间
+            from lazy_tiles import LazyTileRenderer
+            from map_registry import get_map_registry
+            result['ready_seconds'] = round(time.perf_counter() - start, 3)
+            entry = get_map_registry(tile_generator.MAP_CONFIG_FILE).get(map_name)
+            renderer = LazyTileRenderer(tile_generator.OUTPUT_TILES_DIR, entry)
+            for z, x, y in renderer.iter_missing_tiles():
+                renderer.render_tile(z, x, y, foreground=False)
+            renderer.release()
+            os.remove(renderer.source_path)
+    result['wall_seconds'] = round(time.perf_counter() - start, 3)
+    result['peak_rss_mb'] = get_peak_rss_mb()
+    result['tiles_written'], result['bytes_on_disk'] = measure_output(run_dir)
+    return result
+
+
+# --- 主流程 ---
+class TileBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = Path(args.work_dir).absolute()
+        self.results = []
+
+    def selected(self, value, options):
+        if value == 'all':
+            return list(options)
+        chosen = [item.strip() for item in value.split(',') if item.strip()]
+        unknown = [item for item in chosen if item not in options]
+        if unknown:
+            print(f"[ERROR] 未知选项: {', '.join(unknown)}，可选: {', '.join(options)}")
+            sys.exit(1)
+        return chosen
+
+    def run(self):
+        sizes = self.selected(self.args.sizes, SIZES)
+        kinds = self.selected(self.args.kinds, KINDS)
+        modes = self.selected(self.args.modes, list_modes())
+
+        for size_name in sizes:
+            for kind in kinds:
+                source_path = get_source_image(self.work_dir, kind, size_name)
+                for mode in modes:
+                    for repeat in range(self.args.repeat):
+                        self.results.append(self.run_in_subprocess(source_path, size_name, kind, mode, repeat))
+
+        report = {'meta': self.collect_meta(), 'results': self.results}
+        with open(self.args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n[DONE] 报告已写入 {self.args.output}")
+
+        if self.args.compare:
+            compare_reports(self.args.compare, report)
+
+        if not self.args.keep_output:
+            shutil.rmtree(self.work_dir / 'runs', ignore_errors=True)
+
+    def run_in_subprocess(self, source_path, size_name, kind, mode, repeat):
+        run_dir = self.work_dir / 'runs' / f'{kind}_{size_name}_{mode.replace(":", "_")}_{repeat}'
+        shutil.rmtree(run_dir, ignore_errors=True)
+        run_dir.mkdir(parents=True)
+
+        print(f"[RUN] {size_name:>4} {kind:<6} {mode} ...", end=' ', flush=True)
+        command = [sys.executable, __file__, '--run-case', str(source_path), mode, str(run_dir)]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        case = {'size': size_name, 'kind': kind, 'mode': mode, 'repeat': repeat}
+        if completed.returncode != 0:
+            print("失败")
+            case['error'] = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'unknown error'
+            return case
+
+        case.update(json.loads(completed.stdout.strip().splitlines()[-1]))
+        print(f"{case['wall_seconds']:.2f}s, {case['peak_rss_mb']} MB, "
+              f"{case['tiles_written']} tiles, {case['bytes_on_disk'] / (1024 * 1024):.1f} MB")
+        return case
+
+    def collect_meta(self):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                    capture_output=True, text=True).stdout.strip() or None
+        except OSError:
+            commit = None
+        import PIL
+        return {
+            'commit': commit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        }
+
+
+def aggregate_results(results):
+    """把同一 (尺寸, 类型, 模式) 的多次重复汇总为耗时中位数/最小值和磁盘占用中位数，忽略失败的运行"""
+    groups = {}
+    for result in results:
+        if 'error' not in result:
+            groups.setdefault((result['size'], result['kind'], result['mode']), []).append(result)
+    return {
+        key: {
+            'runs': len(runs),
+            'wall_median': statistics.median(r['wall_seconds'] for r in runs),
+            'wall_min': min(r['wall_seconds'] for r in runs),
+            'bytes_on_disk': statistics.median(r['bytes_on_disk'] for r in runs),
+        }
+        for key, runs in groups.items()
+    }
+
+
+def compare_reports(old_path, new_report):
+    """按 (尺寸, 类型, 模式) 汇总所有重复后，对比两份报告的耗时（中位数和最小值）和磁盘占用"""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old_report = json.load(f)
+    old_results = aggregate_results(old_report['results'])
+    new_results = aggregate_results(new_report['results'])
+
+    def delta(new, old):
+        return (new - old) / old * 100 if old else 0
+
+    print(f"\n[COMPARE] {old_report['meta'].get('commit')} -> {new_report['meta'].get('commit')}")
+    for key, new in new_results.items():
+        old = old_results.get(key)
+        if old is None:
+            continue
+        size_name, kind, mode = key
+        print(f"  {size_name:>4} {kind:<6} {mode:<32} "
+              f"time median {delta(new['wall_median'], old['wall_median']):+6.1f}%  "
+              f"min {delta(new['wall_min'], old['wall_min']):+6.1f}%  "
+              f"disk {delta(new['bytes_on_disk'], old['bytes_on_disk']):+6.1f}%  "
+              f"(runs {old['runs']} -> {new['runs']})")
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == '--run-case':
+        print(json.dumps(run_case(Path(sys.argv[2]), sys.argv[3], Path(sys.argv[4]))))
+        return
+
+    parser = argparse.ArgumentParser(description='瓦片生成基准测试')
+    parser.add_argument('--sizes', default='all', help=f"尺寸列表，逗号分隔 ({', '.join(SIZES)}) 或 all")
+    parser.add_argument('--kinds', default='all', help=f"图像类型，逗号分隔 ({', '.join(KINDS)}) 或 all")
+    parser.add_argument('--modes', default='all', help="生成模式，逗号分隔，或 all；--list-modes 查看可用模式")
+    parser.add_argument('--list-modes', action='store_true', help='列出可用的生成模式')
+    parser.add_argument('--repeat', type=int, default=1, help='每个用例重复次数')
+    parser.add_argument('--work-dir', default='bench_tiles_work', help='源图缓存和临时输出目录')
+    parser.add_argument('--output', default='bench_tiles_report.json', help='JSON 报告路径')
+    parser.add_argument('--compare', help='与之前的 JSON 报告对比')
+    parser.add_argument('--keep-output', action='store_true', help='保留生成的瓦片输出')
+    args = parser.parse_args()
+
+    if args.list_modes:
+        print('\n'.join(list_modes()))
+        return
+
+    TileBenchmark(args).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -57,7 +57,7 @@ class SmartBuilder:
             'numpy>=1.24.0',
             'ultralytics>=8.0.0',
             'torch>=2.0.0',
-            'werkzeug>=2.3.0',
+            'aiohttp>=3.11.0',  # 与 requirements.txt 一致，同步服务器需要 send_frame
             'requests>=2.31.0'
         ]
         
@@ -360,7 +360,7 @@ class SmartBuilder:
             args.append(f'--add-binary={python_dll};.')
         
         # 收集依赖
-        collect_packages = ['torch', 'torchvision', 'ultralytics', 'cv2']
+        collect_packages = ['torch', 'torchvision', 'ultralytics', 'cv2', 'aiohttp']
         for package in collect_packages:
             if self.check_package_installed(package):
                 args.append(f'--collect-all={package}')
@@ -371,7 +371,10 @@ class SmartBuilder:
             'PySide6.QtWidgets', 
             'PySide6.QtWebEngineWidgets',
             'PySide6.QtGui',
-            'PySide6.QtNetwork'
+            'PySide6.QtNetwork',
+            # 同步服务器和文件服务器在 main_app 中按需导入
+            'aiohttp',
+            'aiohttp.web',
         ]
         for module in hidden_imports:
             args.append(f'--hidden-import={module}')
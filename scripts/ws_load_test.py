@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同步服务器负载测试 - WutheringWaves Navigator
+打开 N 个模拟地图客户端，回放真实的同步流量：
+- 拖动地图: 每个房间的驱动客户端以 60Hz 连续发送 stateUpdate，持续一小段时间后停顿
+- OCR 自动跳转: 以识别频率持续发送 jumpTo
+- 切换地图: 定期发送 mapChange
+测量端到端广播延迟（发送到各客户端收到）的分位数、消息吞吐量、服务器和负载端的 CPU 与内存，输出可跨实现对比的 JSON 报告。
+完全在本机运行，默认自动启动 src/server.py。
+
+使用方法:
+1. 默认场景: python ws_load_test.py --clients 200
+2. 多房间和二进制协议: python ws_load_test.py --clients 500 --rooms 10 --codec binary
+3. 测试已运行的服务器: python ws_load_test.py --url ws://127.0.0.1:8000/ws --server-pid 1234
+4. 对比其他服务器实现: python ws_load_test.py --server-cmd "python other_server.py --port {port}"
+5. 与旧报告对比: python ws_load_test.py --compare old_report.json
+
+可选依赖: psutil（非 Linux 平台测量服务器 CPU 和内存时需要）
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import asyncio
+import platform
+import argparse
+import itertools
+import subprocess
+from collections import Counter, defaultdict
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+SRC_DIR = SCRIPT_DIR.parent / 'src'
+sys.path.insert(0, str(SRC_DIR))
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+DEFAULT_PORT = 18080
+DRAG_RATE_HZ = 60
+DRAG_BURST_SECONDS = 0.6
+DRAG_PAUSE_SECONDS = 1.5
+OCR_RATE_HZ = 5
+MAP_CHANGE_INTERVAL_SECONDS = 10
+SAMPLE_INTERVAL_SECONDS = 0.5
+SERVER_START_TIMEOUT_SECONDS = 15
+# 测量结束后等待在途消息到达的时间
+DRAIN_SECONDS = 1.0
+
+
+# --- 进程资源采样 ---
+def read_process_usage(pid):
+    """返回 (累计 CPU 秒数, 常驻内存 MB)，无法测量时返回 None"""
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            times = process.cpu_times()
+            return times.user + times.system, process.memory_info().rss / (1024 * 1024)
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        # fields[0] 为状态字段，utime/stime/rss 分别位于 stat 的第 14/15/24 列
+        return (int(fields[11]) + int(fields[12])) / ticks, int(fields[21]) * page_size / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class ProcessSampler:
+    """定期采样一个进程的 CPU 和内存"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.start = None
+        self.end = None
+        self.peak_rss_mb = 0.0
+
+    def sample(self):
+        usage = read_process_usage(self.pid) if self.pid else None
+        if usage is None:
+            return
+        if self.start is None:
+            self.start = (time.perf_counter(), usage[0])
+        self.end = (time.perf_counter(), usage[0])
+        self.peak_rss_mb = max(self.peak_rss_mb, usage[1])
+
+    def result(self):
+        if self.start is None or self.end is None or self.end[0] <= self.start[0]:
+            return None
+        wall = self.end[0] - self.start[0]
+        return {
+            'cpu_percent': round((self.end[1] - self.start[1]) / wall * 100, 1),
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+        }
+
+
+# --- 延迟统计 ---
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize_latencies(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    to_ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        'count': len(values),
+        'mean': to_ms(sum(values) / len(values)),
+        'p50': to_ms(percentile(values, 0.50)),
+        'p90': to_ms(percentile(values, 0.90)),
+        'p99': to_ms(percentile(values, 0.99)),
+        'max': to_ms(values[-1]),
+    }
+
+
+class LatencyTracker:
+    """
+    记录每条驱动消息的发送时间，客户端收到广播时按消息的唯一标记计算延迟
+    lat 使用递增整数（float32 也能精确表示），mapChange 使用唯一的地图名；
+    stateUpdate 被服务器合并时，延迟从窗口内最后一次发送算起。
+    """
+
+    def __init__(self):
+        self.sent_at = {}
+        self.sent = Counter()
+        self.received = Counter()
+        self.latencies = defaultdict(list)
+        self._markers = itertools.count(1)
+        self.measuring = False
+
+    def next_marker(self):
+        return next(self._markers)
+
+    def mark_sent(self, message):
+        key = self.message_key(message)
+        if key is not None:
+            self.sent_at[key] = time.perf_counter()
+        if self.measuring:
+            self.sent[message['type']] += 1
+
+    @staticmethod
+    def message_key(message):
+        message_type = message.get('type')
+        if message_type in ('stateUpdate', 'jumpTo') and 'lat' in message:
+            return message_type, int(round(message['lat']))
+        if message_type == 'mapChange':
+            return message_type, message.get('mapName')
+        return None
+
+    def observe(self, message):
+        now = time.perf_counter()
+        if not self.measuring or not isinstance(message, dict):
+            return
+        message_type = message.get('type')
+        self.received[message_type] += 1
+        sent_at = self.sent_at.get(self.message_key(message))
+        if sent_at is not None:
+            self.latencies[message_type].append(now - sent_at)
+
+
+# --- 模拟客户端 ---
+class SimulatedClient:
+    """一个地图客户端：接收并解码所有广播，驱动客户端同时负责发送流量"""
+
+    def __init__(self, url, codec_name, tracker):
+        from message_codec import CODECS, JSON_CODEC, SUBPROTOCOL_PREFIX
+        self.url = url
+        self.codec = CODECS[codec_name]
+        self.json_codec = JSON_CODEC
+        self.protocols = (SUBPROTOCOL_PREFIX + codec_name, SUBPROTOCOL_PREFIX + JSON_CODEC.name)
+        self.tracker = tracker
+        self.ws = None
+        self.receive_task = None
+        self.disconnected = False
+
+    async def connect(self, session):
+        self.ws = await session.ws_connect(self.url, protocols=self.protocols, max_msg_size=0, heartbeat=None)
+        self.receive_task = asyncio.create_task(self._receive_loop())
+
+    async def _receive_loop(self):
+        import aiohttp
+        async for msg in self.ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                self.tracker.observe(self.json_codec.decode(msg.data))
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                self.tracker.observe(self.codec.decode(msg.data))
+        self.disconnected = True
+
+    async def send(self, message):
+        self.tracker.mark_sent(message)
+        data = self.codec.encode(message) if self.codec.binary else None
+        if data is not None:
+            await self.ws.send_bytes(data)
+        else:
+            await self.ws.send_str(json.dumps(message))
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.receive_task is not None:
+            await asyncio.gather(self.receive_task, return_exceptions=True)
+
+
+async def drive_drag(client, tracker, stop):
+    """拖动: 60Hz 的 stateUpdate 突发，之后停顿"""
+    interval = 1.0 / DRAG_RATE_HZ
+    zoom = 0
+    while not stop.is_set():
+        burst_end = time.perf_counter() + DRAG_BURST_SECONDS
+        while time.perf_counter() < burst_end and not stop.is_set():
+            await client.send({"type": "stateUpdate", "lat": tracker.next_marker(), "lng": 100, "zoom": zoom})
+            await asyncio.sleep(interval)
+        zoom = (zoom + 1) % 4
+        await _sleep_until_stopped(stop, DRAG_PAUSE_SECONDS)
+
+
+async def drive_ocr(client, tracker, stop, rate):
+    """OCR 自动跳转: 固定频率的 jumpTo"""
+    while not stop.is_set():
+        await client.send({"type": "jumpTo", "lat": tracker.next_marker(), "lng": 200})
+        await _sleep_until_stopped(stop, 1.0 / rate)
+
+
+async def drive_map_changes(client, tracker, stop, interval):
+    """定期切换地图"""
+    while not await _sleep_until_stopped(stop, interval):
+        await client.send({"type": "mapChange", "mapName": f"load-test-{tracker.next_marker()}"})
+
+
+async def _sleep_until_stopped(stop, seconds):
+    """等待 seconds 秒，期间收到停止信号时提前返回 True"""
+    try:
+        await asyncio.wait_for(stop.wait(), seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+# --- 服务器 ---
+def start_server(args, port):
+    if args.server_cmd:
+        command = shlex.split(args.server_cmd.format(port=port, python=sys.executable))
+    else:
+        command = [sys.executable, str(SRC_DIR / 'server.py'), '--port', str(port)] + shlex.split(args.server_args)
+    print(f"[SERVER] {' '.join(command)}")
+    return subprocess.Popen(command, cwd=str(SRC_DIR), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_for_server(session, status_url, process):
+    deadline = time.perf_counter() + SERVER_START_TIMEOUT_SECONDS
+    while time.perf_counter() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"服务器进程已退出 (返回码 {process.returncode})")
+        try:
+            async with session.get(status_url) as response:
+                if response.status < 500:
+                    return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("等待服务器启动超时")
+
+
+async def fetch_status(session, status_url):
+    try:
+        async with session.get(status_url) as response:
+            return await response.json() if response.status == 200 else None
+    except Exception:
+        return None
+
+
+# --- 主流程 ---
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.tracker = LatencyTracker()
+
+    def room_url(self, base_url, room_index):
+        if self.args.rooms <= 1:
+            return base_url
+        return f"{base_url}?room=load-{room_index}"
+
+    async def run(self):
+        import aiohttp
+        args = self.args
+        process = None
+        if args.url:
+            ws_url = args.url
+        else:
+            process = start_server(args, args.port)
+            ws_url = f"ws://127.0.0.1:{args.port}/ws"
+        status_url = ws_url.replace('ws://', 'http://', 1).rsplit('/', 1)[0] + '/api/status'
+        server_pid = process.pid if process is not None else args.server_pid
+
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            try:
+                await wait_for_server(session, status_url, process)
+                return await self._run_scenario(session, ws_url, status_url, server_pid)
+            finally:
+                if process is not None:
+                    process.terminate()
+                    try:
+                        process.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+
+    async def _run_scenario(self, session, ws_url, status_url, server_pid):
+        args = self.args
+        clients = [SimulatedClient(self.room_url(ws_url, index % max(args.rooms, 1)), args.codec, self.tracker)
+                   for index in range(args.clients)]
+        print(f"[CONNECT] {args.clients} 个客户端, {args.rooms} 个房间, 编码 {args.codec} ...", end=' ', flush=True)
+        connect_start = time.perf_counter()
+        for start in range(0, len(clients), args.connect_batch):
+            await asyncio.gather(*(client.connect(session) for client in clients[start:start + args.connect_batch]))
+        connect_seconds = time.perf_counter() - connect_start
+        print(f"{connect_seconds:.2f}s")
+
+        # 每个房间的第一个客户端作为驱动客户端
+        drivers = clients[:max(args.rooms, 1)]
+        stop = asyncio.Event()
+        tasks = []
+        for driver in drivers:
+            tasks.append(asyncio.create_task(drive_drag(driver, self.tracker, stop)))
+            if args.ocr_rate > 0:
+                tasks.append(asyncio.create_task(drive_ocr(driver, self.tracker, stop, args.ocr_rate)))
+            if args.map_change_interval > 0:
+                tasks.append(asyncio.create_task(
+                    drive_map_changes(driver, self.tracker, stop, args.map_change_interval)))
+
+        server_sampler = ProcessSampler(server_pid)
+        self_sampler = ProcessSampler(os.getpid())
+        await asyncio.sleep(args.warmup)
+
+        print(f"[RUN] 测量 {args.duration}s ...", flush=True)
+        self.tracker.measuring = True
+        measure_start = time.perf_counter()
+        while time.perf_counter() - measure_start < args.duration:
+            server_sampler.sample()
+            self_sampler.sample()
+            await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
+        server_sampler.sample()
+        self_sampler.sample()
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(DRAIN_SECONDS)
+        self.tracker.measuring = False
+        measured_seconds = time.perf_counter() - measure_start
+
+        status = await fetch_status(session, status_url)
+        disconnected = sum(client.disconnected for client in clients)
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+        received_total = sum(self.tracker.received.values())
+        return {
+            'connect_seconds': round(connect_seconds, 3),
+            'measured_seconds': round(measured_seconds, 3),
+            'sent': dict(self.tracker.sent),
+            'received': dict(self.tracker.received),
+            'messages_per_second': round(received_total / measured_seconds, 1),
+            'sent_per_second': round(sum(self.tracker.sent.values()) / measured_seconds, 1),
+            'latency_ms': {message_type: summarize_latencies(values)
+                           for message_type, values in sorted(self.tracker.latencies.items())},
+            'disconnected_clients': disconnected,
+            'server': server_sampler.result(),
+            'load_generator': self_sampler.result(),
+            'server_queues': {key: value for key, value in (status or {}).get('queues', {}).items()
+                              if key != 'clients'} or None,
+        }
+
+
+def collect_meta(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    import aiohttp
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'aiohttp': aiohttp.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'server': args.url or args.server_cmd or 'src/server.py',
+    }
+
+
+def print_summary(result):
+    print(f"\n[RESULT] 收到 {result['messages_per_second']} 条/秒, 发送 {result['sent_per_second']} 条/秒, "
+          f"断开 {result['disconnected_clients']} 个客户端")
+    for message_type, latency in result['latency_ms'].items():
+        if latency['count']:
+            print(f"  {message_type:<12} n={latency['count']:<8} p50 {latency['p50']:>8.2f}ms  "
+                  f"p90 {latency['p90']:>8.2f}ms  p99 {latency['p99']:>8.2f}ms  max {latency['max']:>8.2f}ms")
+    for name in ('server', 'load_generator'):
+        usage = result[name]
+        if usage:
+            print(f"  {name:<14} CPU {usage['cpu_percent']:>6.1f}%  峰值内存 {usage['peak_rss_mb']} MB")
+
+
+def compare_reports(old_path, new_report):
+    """对比两份报告的吞吐量和延迟分位数"""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old_report = json.load(f)
+    old, new = old_report['result'], new_report['result']
+
+    def delta(old_value, new_value):
+        return f"{(new_value - old_value) / old_value * 100:+6.1f}%" if old_value else '   n/a'
+
+    print(f"\n[COMPARE] {old_report['meta'].get('commit')} -> {new_report['meta'].get('commit')}")
+    print(f"  messages/s  {old['messages_per_second']} -> {new['messages_per_second']} "
+          f"({delta(old['messages_per_second'], new['messages_per_second'])})")
+    for message_type, latency in new['latency_ms'].items():
+        old_latency = old['latency_ms'].get(message_type)
+        if not old_latency or not old_latency.get('count') or not latency.get('count'):
+            continue
+        print(f"  {message_type:<12} p50 {delta(old_latency['p50'], latency['p50'])}  "
+              f"p99 {delta(old_latency['p99'], latency['p99'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同步服务器负载测试')
+    parser.add_argument('--clients', type=int, default=100, help='模拟客户端数量')
+    parser.add_argument('--rooms', type=int, default=1, help='房间数量，客户端平均分配 (1 为默认房间)')
+    parser.add_argument('--codec', default='json', choices=('json', 'msgpack', 'binary'), help='客户端协商的编码')
+    parser.add_argument('--duration', type=float, default=20, help='测量时长（秒）')
+    parser.add_argument('--warmup', type=float, default=2, help='开始测量前的预热时长（秒）')
+    parser.add_argument('--ocr-rate', type=float, default=OCR_RATE_HZ, help='每个房间每秒的 jumpTo 数量 (0 为关闭)')
+    parser.add_argument('--map-change-interval', type=float, default=MAP_CHANGE_INTERVAL_SECONDS,
+                        help='每个房间切换地图的间隔（秒，0 为关闭）')
+    parser.add_argument('--connect-batch', type=int, default=50, help='每批同时建立的连接数')
+    parser.add_argument('--url', help='测试已运行的服务器 (ws://host:port/ws)，不自动启动')
+    parser.add_argument('--server-pid', type=int, help='配合 --url 使用，测量该进程的 CPU 和内存')
+    parser.add_argument('--server-cmd', help='自动启动的服务器命令，{port} 会被替换为端口')
+    parser.add_argument('--server-args', default='', help='传给 src/server.py 的额外参数')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'自动启动服务器的端口 (默认: {DEFAULT_PORT})')
+    parser.add_argument('--output', default='ws_load_report.json', help='JSON 报告路径')
+    parser.add_argument('--compare', help='与之前的 JSON 报告对比')
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+    result = asyncio.run(LoadTest(args).run())
+    report = {'meta': collect_meta(args), 'config': config, 'result': result}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print_summary(result)
+    print(f"\n[DONE] 报告已写入 {args.output}")
+
+    if args.compare:
+        compare_reports(args.compare, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+自动校准
+把带有已知游戏坐标（OCR 识别结果）的小地图截图在本地地图上定位，自动得到校准点并拟合变换：
+- 为地图瓦片金字塔的最大几个级别预先提取 ORB / AKAZE 特征，按级别缓存在 feature_cache/<地图>/ 中，
+  地图重新生成后（maps.json 条目或瓦片文件变化）自动重建
+- 定位时先在各级别上用 LSH 近邻匹配 + 比值检验 + RANSAC 相似变换找到截图的大致位置和比例，
+  再换到分辨率与截图最接近的级别，只在预测区域内精确匹配（图像金字塔由粗到细搜索）
+- 截图中心（或指定的锚点，即玩家图标位置）换算为地图坐标 (lat, lng)，与游戏坐标组成校准点，
+  最后用 calibration_models.fit_calibration() 稳健拟合
+
+地图坐标与 Leaflet 的 CRS.Simple 一致：瓦片地图第 z 级的像素 (u, v) 对应 lat = -v / 2^z, lng = u / 2^z，
+普通图片地图的像素 (u, v) 对应 lat = -v, lng = u。
+
+用法:
+  python auto_calibration.py build <地图名>|--all        预先提取特征
+  python auto_calibration.py calibrate <地图名> samples.json [--model affine]
+samples.json 为 [{"image": 截图路径, "x": 游戏X, "y": 游戏Y}, ...]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import hashlib
+import argparse
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import cv2
+
+from calibration_models import MODEL_AFFINE, CalibrationFit, fit_calibration
+from map_registry import get_map_registry
+from tile_archive import get_archive_path
+from tile_store import TileStore
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DETECTOR_ORB = 'orb'
+DETECTOR_AKAZE = 'akaze'
+DETECTORS = (DETECTOR_ORB, DETECTOR_AKAZE)
+
+FEATURE_CACHE_DIR = 'feature_cache'
+# 特征提取参数变化时递增，使旧缓存失效
+FEATURE_CACHE_VERSION = 1
+TILE_SIZE = 256
+# 从最大级别往下建立索引的级别数（截图比例在这几个级别之间都能匹配）
+INDEX_LEVELS = 4
+# 提取特征时每次拼接 BLOCK_TILES x BLOCK_TILES 个瓦片，并带一圈相邻瓦片作为边框，避免瓦片边缘丢失特征
+BLOCK_TILES = 4
+FEATURES_PER_BLOCK = 1500
+QUERY_FEATURES = 2000
+# Lowe 比值检验
+RATIO_TEST = 0.75
+# 定位成功所需的最少 RANSAC 内点数，以及可以提前结束搜索的内点数
+MIN_INLIERS = 12
+ACCEPT_INLIERS = 40
+RANSAC_REPROJ_THRESHOLD = 4.0
+# 在细级别精确匹配时，预测区域向外扩展的比例
+REFINE_MARGIN = 0.25
+# 截图 1 像素对应的级别像素数的合理范围
+ZOOM_RANGE = (0.1, 10.0)
+# 原尺寸截图匹配失败时依次尝试的截图缩放比例
+QUERY_SCALES = (1.0, 0.5, 2.0)
+
+ProgressCallback = Callable[[str, float], None]
+
+
+def create_detector(name: str = DETECTOR_ORB, n_features: int = FEATURES_PER_BLOCK):
+    """创建特征检测器；两种检测器的描述子都是二进制的，用 Hamming 距离匹配"""
+    if name == DETECTOR_ORB:
+        return cv2.ORB_create(nfeatures=n_features, scaleFactor=1.2, nlevels=8, fastThreshold=10)
+    if name == DETECTOR_AKAZE:
+        if not hasattr(cv2, 'AKAZE_create'):
+            raise ValueError('当前安装的 OpenCV 不包含 AKAZE，请使用 ORB')
+        return cv2.AKAZE_create(threshold=0.0005)
+    raise ValueError(f'未知的特征检测器: {name}')
+
+
+def decode_gray(data: bytes) -> Optional[np.ndarray]:
+    """把图片数据解码为灰度图；OpenCV 不支持的格式（如 AVIF）交给 Pillow"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is not None:
+        return image
+    try:
+        from io import BytesIO
+        from PIL import Image
+        with Image.open(BytesIO(data)) as img:
+            return np.asarray(img.convert('L'))
+    except Exception:
+        return None
+
+
+def read_gray(path: str) -> Optional[np.ndarray]:
+    """读取图片文件为灰度图（支持非 ASCII 路径）"""
+    try:
+        with open(path, 'rb') as f:
+            return decode_gray(f.read())
+    except OSError:
+        return None
+
+
+def to_gray(image: np.ndarray) -> np.ndarray:
+    """截图（BGR / BGRA / 灰度）转为灰度图"""
+    if image.ndim == 2:
+        return image
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def detect_features(detector, image: np.ndarray, limit: int, mask=None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """检测关键点并保留响应最强的 limit 个（按响应从强到弱排列），返回 ((N, 2) 坐标, 描述子)"""
+    keypoints = sorted(detector.detect(image, mask), key=lambda kp: kp.response, reverse=True)[:limit]
+    keypoints, descriptors = detector.compute(image, keypoints)
+    if descriptors is None or not keypoints:
+        return np.zeros((0, 2), dtype=np.float32), None
+    return np.array([kp.pt for kp in keypoints], dtype=np.float32), descriptors
+
+
+class _LevelSource:
+    """按瓦片读取一个金字塔级别的灰度图"""
+
+    def __init__(self, width: int, height: int, read_tile: Callable[[int, int], Optional[np.ndarray]]):
+        self.width = width
+        self.height = height
+        self.tiles_x = math.ceil(width / TILE_SIZE)
+        self.tiles_y = math.ceil(height / TILE_SIZE)
+        self.read_tile = read_tile
+
+    def read_region(self, tx0: int, ty0: int, tx1: int, ty1: int) -> np.ndarray:
+        """拼接瓦片 [tx0, tx1) x [ty0, ty1)，缺失的瓦片为黑色"""
+        canvas = np.zeros(((ty1 - ty0) * TILE_SIZE, (tx1 - tx0) * TILE_SIZE), dtype=np.uint8)
+        for ty in range(ty0, ty1):
+            for tx in range(tx0, tx1):
+                tile = self.read_tile(tx, ty)
+                if tile is None:
+                    continue
+                h, w = min(tile.shape[0], TILE_SIZE), min(tile.shape[1], TILE_SIZE)
+                oy, ox = (ty - ty0) * TILE_SIZE, (tx - tx0) * TILE_SIZE
+                canvas[oy:oy + h, ox:ox + w] = tile[:h, :w]
+        return canvas
+
+
+class LevelIndex:
+    """一个金字塔级别的特征：关键点的级别像素坐标、描述子，以及 1 像素对应的地图坐标长度"""
+
+    def __init__(self, level: int, scale: float, points: np.ndarray, descriptors: np.ndarray):
+        self.level = level
+        self.scale = scale
+        self.points = points
+        self.descriptors = descriptors
+        self._matcher = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.points)
+
+    def matcher(self):
+        """在整个级别上做近似近邻搜索的 LSH 索引（第一次使用时构建）"""
+        with self._lock:
+            if self._matcher is None:
+                index_params = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)  # FLANN_INDEX_LSH
+                matcher = cv2.FlannBasedMatcher(index_params, dict(checks=64))
+                matcher.add([self.descriptors])
+                matcher.train()
+                self._matcher = matcher
+            return self._matcher
+
+    def to_map(self, points: np.ndarray) -> np.ndarray:
+        """级别像素坐标 (N, 2) [u, v] -> 地图坐标 (N, 2) [lat, lng]"""
+        points = np.asarray(points, dtype=np.float64)
+        return np.column_stack((-points[:, 1] * self.scale, points[:, 0] * self.scale))
+
+
+class MatchResult:
+    """截图在某个级别上的定位结果；matrix 为截图像素 -> 级别像素的 2x3 相似变换"""
+
+    def __init__(self, level: LevelIndex, matrix: np.ndarray, inliers: int, matches: int):
+        self.level = level
+        self.matrix = matrix
+        self.inliers = inliers
+        self.matches = matches
+
+    @property
+    def zoom(self) -> float:
+        """截图 1 像素对应的级别像素数"""
+        return float(math.sqrt(abs(np.linalg.det(self.matrix[:, :2]))))
+
+    @property
+    def rotation(self) -> float:
+        """截图相对地图的旋转角度（度）"""
+        return float(math.degrees(math.atan2(self.matrix[1, 0], self.matrix[0, 0])))
+
+    def project(self, points) -> np.ndarray:
+        """截图像素坐标 (N, 2) -> 级别像素坐标"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return points @ self.matrix[:, :2].T + self.matrix[:, 2]
+
+    def locate(self, anchor) -> Tuple[float, float]:
+        """截图中锚点的地图坐标 (lat, lng)"""
+        lat, lng = self.level.to_map(self.project(anchor))[0]
+        return float(lat), float(lng)
+
+
+class MapFeatureIndex:
+    """一张本地地图的多级特征索引，负责磁盘缓存和截图定位"""
+
+    def __init__(self, map_name: str, root_dir: str = SCRIPT_DIR, detector: str = DETECTOR_ORB,
+                 tile_store: Optional[TileStore] = None, index_levels: int = INDEX_LEVELS):
+        if detector not in DETECTORS:
+            raise ValueError(f'未知的特征检测器: {detector}')
+        self.map_name = map_name
+        self.root_dir = root_dir
+        self.detector_name = detector
+        self.index_levels = index_levels
+        self.tiles_dir = os.path.join(root_dir, 'tiles')
+        self.cache_dir = os.path.join(root_dir, FEATURE_CACHE_DIR, map_name)
+        self._tile_store = tile_store
+        self._levels: Optional[List[LevelIndex]] = None
+        self._preferred_level: Optional[int] = None
+        self._lock = threading.Lock()
+
+    # --- 地图信息 ---
+    def _map_entry(self) -> Dict:
+        entry = get_map_registry(os.path.join(self.root_dir, 'maps.json')).get(self.map_name)
+        if entry is None:
+            raise ValueError(f'地图不存在: {self.map_name}')
+        return entry
+
+    def _source_path(self, entry: Dict) -> str:
+        if not entry.get("tiled"):
+            return os.path.join(self.root_dir, 'images', self.map_name)
+        archive = get_archive_path(self.tiles_dir, self.map_name)
+        return archive if os.path.exists(archive) else os.path.join(self.tiles_dir, self.map_name)
+
+    def signature(self, entry: Dict) -> str:
+        """地图条目、瓦片来源的修改时间和提取参数共同决定缓存是否有效"""
+        try:
+            source_mtime = os.stat(self._source_path(entry)).st_mtime_ns
+        except OSError:
+            source_mtime = 0
+        key = json.dumps({
+            "entry": entry, "source_mtime": source_mtime, "detector": self.detector_name,
+            "version": FEATURE_CACHE_VERSION, "block": BLOCK_TILES, "features": FEATURES_PER_BLOCK,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _level_sources(self, entry: Dict) -> List[Tuple[int, float, _LevelSource]]:
+        """要建立索引的级别 (级别, 1 像素的地图坐标长度, 数据源)，由粗到细"""
+        width, height = int(entry["width"]), int(entry["height"])
+        if not entry.get("tiled"):
+            image = read_gray(self._source_path(entry))
+            if image is None:
+                raise ValueError(f'无法读取地图图片: {self.map_name}')
+
+            def read_image_tile(tx, ty):
+                return image[ty * TILE_SIZE:(ty + 1) * TILE_SIZE, tx * TILE_SIZE:(tx + 1) * TILE_SIZE]
+            return [(0, 1.0, _LevelSource(image.shape[1], image.shape[0], read_image_tile))]
+
+        if self._tile_store is None:
+            self._tile_store = TileStore(self.tiles_dir)
+        store, ext = self._tile_store, entry.get("tileExt") or 'png'
+        max_zoom = int(entry.get("maxZoom", 0))
+        sources = []
+        for z in range(max(0, max_zoom - self.index_levels + 1), max_zoom + 1):
+            def read_tile(tx, ty, z=z):
+                tile = store.get_tile(self.map_name, z, tx, ty, ext)
+                return decode_gray(tile.data) if tile is not None else None
+            level_width = int(width / (2 ** (max_zoom - z)))
+            level_height = int(height / (2 ** (max_zoom - z)))
+            sources.append((z, 1.0 / (2 ** z), _LevelSource(level_width, level_height, read_tile)))
+        return sources
+
+    # --- 建立索引 ---
+    def _cache_path(self, level: int) -> str:
+        return os.path.join(self.cache_dir, f'{self.detector_name}_z{level}.npz')
+
+    def _load_cached(self, level: int, scale: float, signature: str) -> Optional[LevelIndex]:
+        try:
+            with np.load(self._cache_path(level)) as cached:
+                if str(cached["signature"]) != signature:
+                    return None
+                return LevelIndex(level, scale, cached["points"], cached["descriptors"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _save_cached(self, index: LevelIndex, signature: str):
+        """写入失败时删除临时文件并抛出 OSError"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(index.level)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, signature=np.array(signature), points=index.points, descriptors=index.descriptors)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _extract_level(self, level: int, scale: float, source: _LevelSource,
+                       progress: Optional[ProgressCallback], cancel_event) -> LevelIndex:
+        # 带边框的画布约为块的两倍大，多检测一些再只保留块内最强的 FEATURES_PER_BLOCK 个
+        detector = create_detector(self.detector_name, FEATURES_PER_BLOCK * 2)
+        all_points, all_descriptors = [], []
+        blocks = [(bx, by) for by in range(0, source.tiles_y, BLOCK_TILES) for bx in range(0, source.tiles_x, BLOCK_TILES)]
+        for done, (bx, by) in enumerate(blocks):
+            if cancel_event is not None and cancel_event.is_set():
+                raise InterruptedError('已取消')
+            tx0, ty0 = max(bx - 1, 0), max(by - 1, 0)
+            tx1, ty1 = min(bx + BLOCK_TILES + 1, source.tiles_x), min(by + BLOCK_TILES + 1, source.tiles_y)
+            canvas = source.read_region(tx0, ty0, tx1, ty1)
+            points, descriptors = detect_features(detector, canvas, FEATURES_PER_BLOCK * 2)
+            if descriptors is not None:
+                points = points + (tx0 * TILE_SIZE, ty0 * TILE_SIZE)
+                # 只保留落在块内的关键点，边框部分属于相邻的块
+                core = ((points[:, 0] >= bx * TILE_SIZE) & (points[:, 0] < (bx + BLOCK_TILES) * TILE_SIZE)
+                        & (points[:, 1] >= by * TILE_SIZE) & (points[:, 1] < (by + BLOCK_TILES) * TILE_SIZE))
+                all_points.append(points[core][:FEATURES_PER_BLOCK])
+                all_descriptors.append(descriptors[core][:FEATURES_PER_BLOCK])
+            if progress is not None:
+                progress(f'提取特征: 级别 {level}', (done + 1) / len(blocks))
+        if not all_points:
+            return LevelIndex(level, scale, np.zeros((0, 2), dtype=np.float32), np.zeros((0, 32), dtype=np.uint8))
+        return LevelIndex(level, scale, np.concatenate(all_points), np.concatenate(all_descriptors))
+
+    def build(self, progress: Optional[ProgressCallback] = None, cancel_event=None) -> List[LevelIndex]:
+        """
+        载入或提取所有级别的特征；缓存有效时只读取磁盘
+        提取耗时和写入缓存失败（本次仍使用内存中的特征）通过 progress 报告。
+        """
+        with self._lock:
+            if self._levels is not None:
+                return self._levels
+            entry = self._map_entry()
+            signature = self.signature(entry)
+            levels = []
+            for level, scale, source in self._level_sources(entry):
+                index = self._load_cached(level, scale, signature)
+                if index is None:
+                    started = time.perf_counter()
+                    index = self._extract_level(level, scale, source, progress, cancel_event)
+                    elapsed = time.perf_counter() - started
+                    try:
+                        self._save_cached(index, signature)
+                        stage = f'已提取级别 {level} 的特征: {len(index)} 个, 耗时 {elapsed:.1f} 秒'
+                    except OSError as e:
+                        stage = f'写入级别 {level} 的特征缓存失败: {e}'
+                    if progress is not None:
+                        progress(stage, 1.0)
+                if len(index) >= MIN_INLIERS:
+                    levels.append(index)
+            self._levels = levels
+            return levels
+
+    def invalidate(self):
+        """丢弃内存中的索引（地图重新生成后调用，下次使用时按新的签名重建）"""
+        with self._lock:
+            self._levels = None
+            self._preferred_level = None
+
+    # --- 定位 ---
+    def _match_level(self, index: LevelIndex, query_points: np.ndarray, query_descriptors: np.ndarray,
+                     region: Optional[Tuple[float, float, float, float]] = None) -> Optional[MatchResult]:
+        """在一个级别上匹配截图特征；region 为 (x0, y0, x1, y1) 时只在该范围内的关键点中搜索"""
+        if region is None:
+            candidates = None
+            pairs = index.matcher().knnMatch(query_descriptors, k=2)
+        else:
+            x0, y0, x1, y1 = region
+            points = index.points
+            candidates = np.nonzero((points[:, 0] >= x0) & (points[:, 0] <= x1)
+                                    & (points[:, 1] >= y0) & (points[:, 1] <= y1))[0]
+            if len(candidates) < MIN_INLIERS:
+                return None
+            matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+            pairs = matcher.knnMatch(query_descriptors, index.descriptors[candidates], k=2)
+
+        query_idx, train_idx = [], []
+        for pair in pairs:
+            if len(pair) == 2 and pair[0].distance < RATIO_TEST * pair[1].distance:
+                query_idx.append(pair[0].queryIdx)
+                train_idx.append(pair[0].trainIdx)
+        if len(query_idx) < MIN_INLIERS:
+            return None
+        train_idx = np.asarray(train_idx)
+        if candidates is not None:
+            train_idx = candidates[train_idx]
+        src = query_points[query_idx]
+        dst = index.points[train_idx]
+        # 小地图相对大地图只有平移、旋转和统一缩放
+        matrix, inlier_mask = cv2.estimateAffinePartial2D(
+            src, dst, method=cv2.RANSAC, ransacReprojThreshold=RANSAC_REPROJ_THRESHOLD,
+            maxIters=2000, confidence=0.995)
+        if matrix is None:
+            return None
+        # 缩放比例离谱的结果是内点恰好落在一小片区域上的误匹配
+        zoom = math.sqrt(abs(np.linalg.det(matrix[:, :2])))
+        if not ZOOM_RANGE[0] <= zoom <= ZOOM_RANGE[1]:
+            return None
+        inliers = int(inlier_mask.sum())
+        if inliers < MIN_INLIERS:
+            return None
+        return MatchResult(index, matrix, inliers, len(query_idx))
+
+    def _search_order(self, levels: List[LevelIndex]) -> List[LevelIndex]:
+        """由粗到细搜索；上一次定位成功的级别优先（同一批截图的比例相同）"""
+        ordered = sorted(levels, key=lambda index: index.level)
+        if self._preferred_level is not None:
+            ordered.sort(key=lambda index: index.level != self._preferred_level)
+        return ordered
+
+    def _refine(self, levels: List[LevelIndex], result: MatchResult, query_points: np.ndarray,
+                query_descriptors: np.ndarray, image_size: Tuple[int, int]) -> MatchResult:
+        """换到分辨率与截图最接近的级别，在预测区域内重新匹配以提高精度"""
+        zoom = result.zoom
+        if zoom <= 0:
+            return result
+        wanted = result.level.level - math.log2(zoom)
+        target = min(levels, key=lambda index: abs(index.level - wanted))
+        if target is result.level:
+            return result
+        w, h = image_size
+        corners = result.project([(0, 0), (w, 0), (0, h), (w, h)]) * (2 ** (target.level - result.level.level))
+        (x0, y0), (x1, y1) = corners.min(axis=0), corners.max(axis=0)
+        margin_x, margin_y = (x1 - x0) * REFINE_MARGIN, (y1 - y0) * REFINE_MARGIN
+        refined = self._match_level(target, query_points, query_descriptors,
+                                    (x0 - margin_x, y0 - margin_y, x1 + margin_x, y1 + margin_y))
+        return refined if refined is not None else result
+
+    def locate(self, image: np.ndarray, mask: Optional[np.ndarray] = None) -> Optional[MatchResult]:
+        """
+        在地图上定位截图，失败时返回 None
+        mask 为与截图同尺寸的 uint8 掩码，非零处参与匹配（例如圆形小地图只取圆内）。
+        """
+        levels = self.build()
+        if not levels:
+            return None
+        gray = to_gray(image)
+        detector = create_detector(self.detector_name, QUERY_FEATURES)
+        # 截图比例超出索引级别覆盖的范围时（例如普通图片地图只有一个级别），再用缩放后的截图匹配
+        for factor in QUERY_SCALES:
+            if factor == 1.0:
+                query, query_mask = gray, mask
+            else:
+                query = cv2.resize(gray, None, fx=factor, fy=factor,
+                                   interpolation=cv2.INTER_AREA if factor < 1 else cv2.INTER_LINEAR)
+                query_mask = None if mask is None else cv2.resize(
+                    mask, (query.shape[1], query.shape[0]), interpolation=cv2.INTER_NEAREST)
+            query_points, query_descriptors = detect_features(detector, query, QUERY_FEATURES, query_mask)
+            if query_descriptors is None or len(query_points) < MIN_INLIERS:
+                continue
+            # 关键点换回原截图的像素坐标，定位结果与缩放无关
+            query_points = query_points / np.float32(factor)
+            best = self._search(levels, query_points, query_descriptors)
+            if best is not None:
+                best = self._refine(levels, best, query_points, query_descriptors, (gray.shape[1], gray.shape[0]))
+                self._preferred_level = best.level.level
+                return best
+        return None
+
+    def _search(self, levels: List[LevelIndex], query_points: np.ndarray,
+                query_descriptors: np.ndarray) -> Optional[MatchResult]:
+        """依次在各级别上匹配，返回内点最多的结果"""
+        best = None
+        for index in self._search_order(levels):
+            result = self._match_level(index, query_points, query_descriptors)
+            if result is not None and (best is None or result.inliers > best.inliers):
+                best = result
+            if best is not None and best.inliers >= ACCEPT_INLIERS:
+                break
+        return best
+
+
+class AutoCalibrator:
+    """
+    收集 (截图, 游戏坐标) 样本并拟合校准模型
+    anchor 为玩家位置在截图中的像素坐标，None 表示截图中心。
+    """
+
+    def __init__(self, feature_index: MapFeatureIndex):
+        self.feature_index = feature_index
+        # (游戏X, 游戏Y, lat, lng, 定位结果)
+        self.samples: List[Tuple[float, float, float, float, MatchResult]] = []
+
+    def add_sample(self, image: np.ndarray, game_x: float, game_y: float,
+                   anchor: Optional[Tuple[float, float]] = None,
+                   mask: Optional[np.ndarray] = None) -> Optional[MatchResult]:
+        """定位一张截图并记录为校准点，定位失败时返回 None"""
+        result = self.feature_index.locate(image, mask)
+        if result is None:
+            return None
+        if anchor is None:
+            anchor = (image.shape[1] / 2.0, image.shape[0] / 2.0)
+        lat, lng = result.locate(anchor)
+        self.samples.append((float(game_x), float(game_y), lat, lng, result))
+        return result
+
+    def points(self) -> Tuple[np.ndarray, np.ndarray]:
+        """返回 ((N, 2) 游戏坐标, (N, 2) 地图坐标)"""
+        src = np.array([(x, y) for x, y, _, _, _ in self.samples], dtype=np.float64).reshape(-1, 2)
+        dst = np.array([(lat, lng) for _, _, lat, lng, _ in self.samples], dtype=np.float64).reshape(-1, 2)
+        return src, dst
+
+    def fit(self, model: str = MODEL_AFFINE, robust: bool = True) -> CalibrationFit:
+        src, dst = self.points()
+        return fit_calibration(model, src, dst, robust=robust)
+
+
+def load_samples(path: str) -> List[Dict]:
+    """读取样本列表 [{"image", "x", "y", 可选 "anchor": [u, v]}]，图片路径相对于样本文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        samples = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    for sample in samples:
+        sample["image"] = os.path.join(base, sample["image"])
+    return samples
+
+
+def _print_progress(stage: str, fraction: float):
+    print(f"\r{stage}: {fraction * 100:5.1f}%", end='', flush=True)
+    if fraction >= 1.0:
+        print()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="用小地图截图自动校准本地地图")
+    parser.add_argument('--root', default=SCRIPT_DIR, help="地图根目录（包含 maps.json 和 tiles/）")
+    parser.add_argument('--detector', choices=DETECTORS, default=DETECTOR_ORB, help="特征检测器 (默认: orb)")
+    sub = parser.add_subparsers(dest='command', required=True)
+    build_parser = sub.add_parser('build', help="预先提取并缓存地图特征")
+    build_parser.add_argument('map_name', nargs='?')
+    build_parser.add_argument('--all', action='store_true', help="处理所有瓦片地图")
+    calibrate_parser = sub.add_parser('calibrate', help="用截图样本拟合校准")
+    calibrate_parser.add_argument('map_name')
+    calibrate_parser.add_argument('samples', help="样本 JSON 文件")
+    calibrate_parser.add_argument('--model', default=MODEL_AFFINE, help="校准模型 (默认: affine)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        if args.all:
+            names = get_map_registry(os.path.join(args.root, 'maps.json')).names()
+        elif args.map_name:
+            names = [args.map_name]
+        else:
+            parser.error('需要地图名或 --all')
+        for name in names:
+            levels = MapFeatureIndex(name, args.root, args.detector).build(_print_progress)
+            print(f"{name}: " + ', '.join(f"级别 {index.level} {len(index)} 个特征" for index in levels))
+        return 0
+
+    calibrator = AutoCalibrator(MapFeatureIndex(args.map_name, args.root, args.detector))
+    for sample in load_samples(args.samples):
+        image = read_gray(sample["image"])
+        if image is None:
+            print(f"无法读取截图: {sample['image']}")
+            continue
+        started = time.perf_counter()
+        result = calibrator.add_sample(image, sample["x"], sample["y"], sample.get("anchor"))
+        elapsed = (time.perf_counter() - started) * 1000
+        if result is None:
+            print(f"定位失败 ({elapsed:.0f} ms): {sample['image']}")
+        else:
+            _, _, lat, lng, _ = calibrator.samples[-1]
+            print(f"({sample['x']}, {sample['y']}) -> ({lat:.4f}, {lng:.4f}) 级别 {result.level.level} "
+                  f"内点 {result.inliers}/{result.matches} 缩放 {result.zoom:.3f} 旋转 {result.rotation:.1f}° "
+                  f"({elapsed:.0f} ms)")
+    if len(calibrator.samples) < 2:
+        print("成功定位的截图少于 2 张，无法校准")
+        return 1
+    fit = calibrator.fit(args.model)
+    print(json.dumps({"fit": fit.to_dict(), "calibration": fit.model.to_dict()}, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同步服务器的发布/订阅背板
+多个服务器工作进程通过背板共享房间状态并互相转发广播，连接到不同进程的客户端看到相同的更新：
+- 背板为每个房间保存权威的地图状态和序号，状态消息 (stateUpdate / mapChange) 由背板统一编号
+- 工作进程只订阅本地有客户端的房间，事件只发给订阅了该房间的进程
+- 工作进程之间同步各自的在线客户端数量，clientCountUpdate 为整个房间的人数
+- 多进程部署时所有房间的状态消息都经过代理，状态日志 (state_journal.py) 由代理记录和恢复
+
+实现:
+- InProcessBackplane: 单进程（默认），事件在调用 publish 时同步分发，不经过任何网络
+- SocketBackplane: 连接到本机的 BackplaneBroker（按行分隔的 JSON over TCP），用于多进程部署
+
+启动代理: python backplane.py --port 8090 [--journal <目录>]
+工作进程: python server.py --port 8081 --broker 127.0.0.1:8090
+"""
+
+import os
+import asyncio
+import itertools
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from message_codec import JSON_CODEC
+from state_journal import StateJournal
+
+DEFAULT_BROKER_HOST = '127.0.0.1'
+DEFAULT_BROKER_PORT = 8090
+# 由背板编号并更新房间状态的消息类型
+SEQUENCED_MESSAGE_TYPES = ('stateUpdate', 'mapChange')
+# 参与 stateUpdate 的状态字段
+STATE_FIELDS = ('lat', 'lng', 'zoom')
+# 与代理断开后重新连接的间隔
+RECONNECT_DELAY_SECONDS = 1.0
+# 单行消息的上限（地图状态消息远小于此值）
+MAX_LINE_BYTES = 1024 * 1024
+# 发往代理的未发送数据超过该值时丢弃新的广播事件，代理处理过慢时内存不再无限增长
+MAX_WRITE_BUFFER_BYTES = 1024 * 1024
+# 没有订阅者后仍保留状态的房间数，房间再次被订阅时序号继续递增
+DORMANT_ROOMS_LIMIT = 1024
+
+_worker_ids = itertools.count(1)
+
+
+def new_worker_id() -> str:
+    """进程内唯一、跨进程不重复的工作进程标识"""
+    return f"{os.getpid()}-{next(_worker_ids)}"
+
+
+class RoomBroker:
+    """
+    房间的权威状态和订阅关系（InProcessBackplane 和 BackplaneBroker 共用）
+    成员对象需要实现 deliver_event(room, message, origin, exclude) 和 deliver_presence(room, worker, count)。
+    指定 journal 时编号后的状态消息写入状态日志。只能在一个事件循环线程中使用。
+    """
+
+    def __init__(self, journal: Optional[StateJournal] = None):
+        # 房间名 -> {"state": 地图状态, "seq": 序号, "members": {工作进程: 成员}, "counts": {工作进程: 人数}}
+        self.rooms: Dict[str, Dict[str, Any]] = {}
+        self.journal = journal
+        # 没有订阅者或从日志恢复的房间: 房间名 -> (状态, 序号)
+        self._dormant: "OrderedDict[str, Any]" = OrderedDict()
+        self.events_published = 0
+
+    def restore(self, rooms: Dict[str, Dict[str, Any]]):
+        """载入 StateJournal.restore() 恢复的房间，房间被订阅时使用"""
+        for name, room in rooms.items():
+            self._keep_dormant(name, dict(room["state"]), room["seq"])
+
+    def _keep_dormant(self, name: str, state: Dict[str, Any], seq: int):
+        self._dormant[name] = (state, seq)
+        self._dormant.move_to_end(name)
+        while len(self._dormant) > DORMANT_ROOMS_LIMIT:
+            self._dormant.popitem(last=False)
+
+    def join(self, worker_id: str, member, room: str, initial_state: Dict[str, Any],
+             initial_seq: int = 0) -> Dict[str, Any]:
+        """
+        订阅房间，返回房间快照；房间不存在时以保留的状态或 initial_state 和 initial_seq 创建（取序号较新的）
+        """
+        entry = self.rooms.get(room)
+        if entry is None:
+            dormant = self._dormant.pop(room, None)
+            if dormant is not None and dormant[1] >= initial_seq:
+                initial_state, initial_seq = dormant
+            entry = {"state": dict(initial_state), "seq": initial_seq, "members": {}, "counts": {}}
+            self.rooms[room] = entry
+        entry["members"][worker_id] = member
+        return {"state": dict(entry["state"]), "seq": entry["seq"], "counts": dict(entry["counts"])}
+
+    def leave(self, worker_id: str, room: str):
+        """取消订阅；没有订阅者的房间被释放"""
+        entry = self.rooms.get(room)
+        if entry is None:
+            return
+        entry["members"].pop(worker_id, None)
+        if entry["counts"].pop(worker_id, None):
+            self._fan_out_presence(entry, room, worker_id, 0)
+        if not entry["members"]:
+            del self.rooms[room]
+            self._keep_dormant(room, entry["state"], entry["seq"])
+
+    def leave_all(self, worker_id: str):
+        for room in [name for name, entry in self.rooms.items() if worker_id in entry["members"]]:
+            self.leave(worker_id, room)
+
+    def publish(self, origin: str, room: str, message: Dict[str, Any], exclude: Optional[int] = None):
+        """状态消息编号并更新房间状态，然后分发给房间的所有订阅者（包括发布者自己）"""
+        entry = self.rooms.get(room)
+        if entry is None:
+            return
+        if message.get('type') in SEQUENCED_MESSAGE_TYPES:
+            fields = {k: v for k, v in message.items() if k not in ('type', 'seq')}
+            if message['type'] == 'stateUpdate':
+                fields = {k: v for k, v in fields.items() if k in STATE_FIELDS}
+            entry["state"].update(fields)
+            entry["seq"] += 1
+            message = {**message, "seq": entry["seq"]}
+            if self.journal is not None:
+                self.journal.record(room, message)
+        self.events_published += 1
+        for member in list(entry["members"].values()):
+            member.deliver_event(room, message, origin, exclude)
+
+    def presence(self, worker_id: str, room: str, count: int):
+        """记录工作进程在房间中的客户端数量，并通知其他订阅者"""
+        entry = self.rooms.get(room)
+        if entry is None:
+            return
+        if count:
+            entry["counts"][worker_id] = count
+        else:
+            entry["counts"].pop(worker_id, None)
+        self._fan_out_presence(entry, room, worker_id, count)
+
+    def _fan_out_presence(self, entry, room, worker_id, count):
+        for member_id, member in list(entry["members"].items()):
+            if member_id != worker_id:
+                member.deliver_presence(room, worker_id, count)
+
+
+class Backplane:
+    """
+    背板接口
+    attach 注册的订阅者需要实现:
+    - on_backplane_event(room, message, from_self, exclude): 房间事件（包括本进程发布的）
+    - on_backplane_presence(room, worker, count): 其他工作进程的客户端数量变化
+    - on_backplane_snapshot(room, snapshot): 重新连接后房间状态的完整快照
+    - backplane_room_state(room): 房间当前的 (状态, 序号)，重新连接后用它重新订阅，房间不存在时返回 None
+    publish / presence / leave 不等待任何 I/O，可以在广播路径上直接调用。
+    """
+    kind = ''
+
+    def __init__(self):
+        self.worker_id = new_worker_id()
+        self.subscriber = None
+        self.events_published = 0
+        self.events_received = 0
+
+    def attach(self, subscriber):
+        self.subscriber = subscriber
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def join(self, room: str, initial_state: Dict[str, Any], initial_seq: int = 0) -> Dict[str, Any]:
+        """订阅房间并返回快照 {"state", "seq", "counts"}；房间在背板中不存在时以给定的状态创建"""
+        raise NotImplementedError
+
+    def leave(self, room: str):
+        raise NotImplementedError
+
+    def publish(self, room: str, message: Dict[str, Any], exclude: Optional[int] = None):
+        """发布房间事件；exclude 为发布进程中不需要收到该事件的客户端 id"""
+        raise NotImplementedError
+
+    def presence(self, room: str, count: int):
+        raise NotImplementedError
+
+    @property
+    def connected(self) -> bool:
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "type": self.kind,
+            "worker_id": self.worker_id,
+            "connected": self.connected,
+            "events_published": self.events_published,
+            "events_received": self.events_received,
+        }
+
+    # --- 投递给订阅者 ---
+    def deliver_event(self, room, message, origin, exclude):
+        self.events_received += 1
+        if self.subscriber is not None:
+            self.subscriber.on_backplane_event(room, message, origin == self.worker_id, exclude)
+
+    def deliver_presence(self, room, worker, count):
+        if self.subscriber is not None:
+            self.subscriber.on_backplane_presence(room, worker, count)
+
+
+class InProcessBackplane(Backplane):
+    """
+    进程内背板：事件在 publish 调用中同步分发
+    多个 WebSocketHub 共享同一个 RoomBroker 时可以在一个进程内模拟多个工作进程。
+    """
+    kind = 'in_process'
+
+    def __init__(self, broker: Optional[RoomBroker] = None):
+        super().__init__()
+        self.broker = broker or RoomBroker()
+
+    async def stop(self):
+        self.broker.leave_all(self.worker_id)
+
+    async def join(self, room, initial_state, initial_seq=0):
+        return self.broker.join(self.worker_id, self, room, initial_state, initial_seq)
+
+    def leave(self, room):
+        self.broker.leave(self.worker_id, room)
+
+    def publish(self, room, message, exclude=None):
+        self.events_published += 1
+        self.broker.publish(self.worker_id, room, message, exclude)
+
+    def presence(self, room, count):
+        self.broker.presence(self.worker_id, room, count)
+
+
+class SocketBackplane(Backplane):
+    """
+    通过 TCP 连接到 BackplaneBroker 的背板
+    写入只进入连接的发送缓冲区，不等待代理确认；发送缓冲区超过 MAX_WRITE_BUFFER_BYTES 时丢弃广播事件
+    （订阅和人数等控制消息总是写入）。与代理断开时自动重连，用房间的当前状态重新订阅、用快照恢复状态。
+    """
+    kind = 'socket'
+
+    def __init__(self, host: str = DEFAULT_BROKER_HOST, port: int = DEFAULT_BROKER_PORT):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+        self._stopping = False
+        self._request_ids = itertools.count(1)
+        self._pending_joins: Dict[int, asyncio.Future] = {}
+        # 已订阅的房间 -> (初始状态, 初始序号)，订阅者不提供当前状态时重连使用
+        self._rooms: Dict[str, Any] = {}
+        # 每个房间最近一次报告的本进程人数，重连后重新报告
+        self._presence: Dict[str, int] = {}
+        self.messages_lost = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def start(self):
+        self._stopping = False
+        self._connected = asyncio.Event()
+        await self._connect()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        self._stopping = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        await self._close_writer()
+        self._rooms.clear()
+        self._presence.clear()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port, limit=MAX_LINE_BYTES)
+        self._send({"op": "hello", "worker": self.worker_id})
+        self._connected.set()
+
+    async def _close_writer(self):
+        writer, self._writer = self._writer, None
+        self._connected.clear()
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    def _send(self, payload: Dict[str, Any], droppable: bool = False) -> bool:
+        """写入发送缓冲区；未连接，或 droppable 的消息遇到发送缓冲区已满时返回 False"""
+        if not self.connected:
+            return False
+        if droppable and self._writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER_BYTES:
+            return False
+        self._writer.write(JSON_CODEC.encode(payload) + b'\n')
+        return True
+
+    def _current_room_state(self, room: str):
+        """房间的当前 (状态, 序号)；订阅者不提供时退回订阅时的初始值"""
+        current = self.subscriber.backplane_room_state(room) if self.subscriber is not None else None
+        return current if current is not None else self._rooms[room]
+
+    async def _read_loop(self):
+        while not self._stopping:
+            try:
+                line = await self._reader.readline()
+                if not line:
+                    raise ConnectionResetError("代理关闭了连接")
+            except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                if self._stopping:
+                    return
+                print(f"背板连接中断: {e!r}，{RECONNECT_DELAY_SECONDS} 秒后重连")
+                await self._reconnect()
+                continue
+            try:
+                self._handle(JSON_CODEC.decode(line))
+            except Exception as e:
+                print(f"处理背板消息出错: {e!r}")
+
+    async def _reconnect(self):
+        await self._close_writer()
+        for future in self._pending_joins.values():
+            if not future.done():
+                future.set_exception(ConnectionError("背板连接中断"))
+        self._pending_joins.clear()
+        while not self._stopping:
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+            try:
+                await self._connect()
+            except OSError:
+                continue
+            # 用房间的当前状态重新订阅（代理重启后以它创建房间），代理返回的快照交给订阅者覆盖本地状态
+            for room in list(self._rooms):
+                state, seq = self._current_room_state(room)
+                self._send({"op": "join", "room": room, "state": state, "seq": seq})
+            for room, count in self._presence.items():
+                self._send({"op": "presence", "room": room, "count": count})
+            print("背板已重新连接")
+            return
+
+    def _handle(self, payload: Dict[str, Any]):
+        op = payload.get('op')
+        if op == 'event':
+            self.deliver_event(payload['room'], payload['message'], payload.get('origin'), payload.get('exclude'))
+        elif op == 'presence':
+            self.deliver_presence(payload['room'], payload['worker'], payload['count'])
+        elif op == 'joined':
+            future = self._pending_joins.pop(payload.get('id'), None)
+            if future is not None:
+                if not future.done():
+                    future.set_result(payload['snapshot'])
+            elif self.subscriber is not None:
+                self.subscriber.on_backplane_snapshot(payload['room'], payload['snapshot'])
+
+    async def join(self, room, initial_state, initial_seq=0):
+        await self._connected.wait()
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending_joins[request_id] = future
+        self._rooms[room] = (dict(initial_state), initial_seq)
+        self._send({"op": "join", "id": request_id, "room": room, "state": initial_state, "seq": initial_seq})
+        return await future
+
+    def leave(self, room):
+        self._rooms.pop(room, None)
+        self._presence.pop(room, None)
+        self._send({"op": "leave", "room": room})
+
+    def publish(self, room, message, exclude=None):
+        if self._send({"op": "publish", "room": room, "message": message, "exclude": exclude}, droppable=True):
+            self.events_published += 1
+        else:
+            self.messages_lost += 1
+
+    def presence(self, room, count):
+        if count:
+            self._presence[room] = count
+        else:
+            self._presence.pop(room, None)
+        self._send({"op": "presence", "room": room, "count": count})
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats.update({"broker": f"{self.host}:{self.port}", "messages_lost": self.messages_lost})
+        return stats
+
+
+class _BrokerConnection:
+    """代理端的一个工作进程连接，作为 RoomBroker 的成员把事件写回该连接"""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.worker_id: Optional[str] = None
+
+    def _send(self, payload: Dict[str, Any]):
+        if not self.writer.is_closing():
+            self.writer.write(JSON_CODEC.encode(payload) + b'\n')
+
+    def deliver_event(self, room, message, origin, exclude):
+        self._send({"op": "event", "room": room, "message": message, "origin": origin, "exclude": exclude})
+
+    def deliver_presence(self, room, worker, count):
+        self._send({"op": "presence", "room": room, "worker": worker, "count": count})
+
+
+class BackplaneBroker:
+    """
+    本机的背板代理：接受工作进程的 TCP 连接，用 RoomBroker 保存房间状态并转发事件
+    指定 journal 时启动前从日志恢复房间状态，之后记录所有房间的状态事件，停止时写入最后的快照。
+    """
+
+    def __init__(self, host: str = DEFAULT_BROKER_HOST, port: int = DEFAULT_BROKER_PORT,
+                 journal: Optional[StateJournal] = None):
+        self.host = host
+        self.port = port
+        self.journal = journal
+        self.broker = RoomBroker(journal)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.connections = 0
+
+    async def start(self):
+        if self.journal is not None:
+            self.broker.restore(self.journal.restore())
+            self.journal.start()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=MAX_LINE_BYTES)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.journal is not None:
+            await asyncio.to_thread(self.journal.stop)
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"背板代理监听于 {self.host}:{self.port}")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = _BrokerConnection(writer)
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    payload = JSON_CODEC.decode(line)
+                except ValueError:
+                    continue
+                self._handle(connection, payload)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self.connections -= 1
+            if connection.worker_id is not None:
+                self.broker.leave_all(connection.worker_id)
+            writer.close()
+
+    def _handle(self, connection: _BrokerConnection, payload: Dict[str, Any]):
+        op = payload.get('op')
+        if op == 'hello':
+            connection.worker_id = str(payload['worker'])
+            return
+        worker_id = connection.worker_id
+        if worker_id is None:
+            return
+        room = payload.get('room')
+        if op == 'publish':
+            self.broker.publish(worker_id, room, payload['message'], payload.get('exclude'))
+        elif op == 'join':
+            snapshot = self.broker.join(worker_id, connection, room, payload.get('state') or {},
+                                        payload.get('seq') or 0)
+            connection._send({"op": "joined", "id": payload.get('id'), "room": room, "snapshot": snapshot})
+        elif op == 'leave':
+            self.broker.leave(worker_id, room)
+        elif op == 'presence':
+            self.broker.presence(worker_id, room, payload['count'])
+
+
+def create_backplane(broker_address: Optional[str] = None) -> Backplane:
+    """broker_address 为 'host:port' 时连接本机代理，否则使用进程内背板"""
+    if not broker_address:
+        return InProcessBackplane()
+    host, _, port = broker_address.rpartition(':')
+    return SocketBackplane(host or DEFAULT_BROKER_HOST, int(port))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="同步服务器多进程部署使用的本机背板代理")
+    parser.add_argument('--host', default=DEFAULT_BROKER_HOST, help=f"监听地址 (默认: {DEFAULT_BROKER_HOST})")
+    parser.add_argument('--port', type=int, default=DEFAULT_BROKER_PORT, help=f"监听端口 (默认: {DEFAULT_BROKER_PORT})")
+    parser.add_argument('--journal', default=None, help="状态日志和快照目录（默认不记录）")
+    args = parser.parse_args()
+    journal = StateJournal(args.journal) if args.journal else None
+    try:
+        asyncio.run(BackplaneBroker(args.host, args.port, journal).serve_forever())
+    except KeyboardInterrupt:
+        pass
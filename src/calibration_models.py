@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+校准模型
+把游戏坐标 (x, y) 映射到地图坐标 (lat, lon) 的几种模型，全部基于 numpy 向量化拟合和批量转换：
+- affine      仿射变换，6 个参数，至少 2 个点（2 个点或共线时为最小范数解，与旧版本一致）
+- homography  单应（透视）变换，8 个参数，至少 4 个点，适合带透视畸变的截图地图
+- polynomial  二次多项式，每个输出 6 个系数，至少 6 个点，适合整体弯曲的手绘地图
+- piecewise   分段仿射：对校准点做 Delaunay 三角剖分，每个三角形内单独仿射插值，
+              凸包之外退回到整体仿射，至少 3 个点，适合局部拉伸不一致的地图
+
+fit_calibration() 用 RANSAC / LMedS 剔除点错的校准点（离群点），再用剩余的内点做最小二乘拟合，
+并返回每个点的残差，方便在界面上指出哪个点有问题。
+"""
+
+import itertools
+import math
+from typing import Dict, Optional, Tuple, Type
+
+import numpy as np
+
+try:
+    from scipy.spatial import Delaunay
+except ImportError:
+    Delaunay = None
+
+MODEL_AFFINE = 'affine'
+MODEL_HOMOGRAPHY = 'homography'
+MODEL_POLYNOMIAL = 'polynomial'
+MODEL_PIECEWISE = 'piecewise'
+
+# RANSAC 假设数上限；所有组合数不超过该值时逐一枚举（结果可重复）
+RANSAC_MAX_ITERATIONS = 500
+# 未指定阈值时，离群判定阈值不小于目标坐标范围（包围盒对角线）的这一比例
+MIN_RELATIVE_THRESHOLD = 0.01
+# LMedS 稳健标准差换算后的离群倍数
+OUTLIER_SIGMAS = 2.5
+# 分段仿射定位三角形时，每批 (点数 × 三角形数) 的上限，控制临时数组的内存
+PIECEWISE_CHUNK_ELEMENTS = 1 << 20
+# 判断点在三角形内时允许的重心坐标误差（让共享边上的点不会落到三角形外）
+BARYCENTRIC_EPSILON = 1e-9
+
+
+def as_points(points) -> np.ndarray:
+    """转换为 (N, 2) 的 float64 数组"""
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim != 2 or points.shape[1] != 2:
+        raise ValueError('坐标数组的形状应为 (N, 2)')
+    return points
+
+
+def is_degenerate(points: np.ndarray) -> bool:
+    """点集是否共线（或重合），此时无法确定二维变换"""
+    if len(points) < 3:
+        return True
+    centered = points - points.mean(axis=0)
+    singular = np.linalg.svd(centered, compute_uv=False)
+    return singular[1] <= singular[0] * 1e-9
+
+
+def _solve_least_squares(design: np.ndarray, targets: np.ndarray, strict: bool = True) -> np.ndarray:
+    """最小二乘解；strict 为 False 时方程欠定也返回最小范数解"""
+    solution, _, rank, _ = np.linalg.lstsq(design, targets, rcond=None)
+    if strict and rank < design.shape[1]:
+        raise ValueError('校准点分布退化（共线或重复），无法确定变换')
+    return solution
+
+
+class CalibrationModel:
+    """校准模型基类：apply() 批量正向转换，inverse() 返回反向模型"""
+    name = ''
+    # 拟合所需的最少点数
+    min_points = 0
+    # RANSAC 每个假设使用的点数
+    sample_size = 0
+
+    @classmethod
+    def fit(cls, src: np.ndarray, dst: np.ndarray) -> 'CalibrationModel':
+        raise NotImplementedError
+
+    def apply(self, points) -> np.ndarray:
+        raise NotImplementedError
+
+    def inverse(self) -> 'CalibrationModel':
+        raise NotImplementedError
+
+    def to_dict(self) -> Dict:
+        raise NotImplementedError
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'CalibrationModel':
+        raise NotImplementedError
+
+    def residuals(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        """每个点的残差（转换结果与目标坐标的欧氏距离）"""
+        diff = self.apply(src) - dst
+        return np.hypot(diff[:, 0], diff[:, 1])
+
+
+class AffineModel(CalibrationModel):
+    """
+    仿射变换: [lat, lon]ᵀ = M[:, :2] · [x, y]ᵀ + M[:, 2]
+    与旧版本一致，点数不足或共线时返回最小范数解而不报错（RANSAC 会跳过共线的样本）
+    """
+    name = MODEL_AFFINE
+    min_points = 2
+    sample_size = 3
+
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64).reshape(2, 3)
+
+    @classmethod
+    def fit(cls, src, dst):
+        src, dst = as_points(src), as_points(dst)
+        design = np.column_stack((src, np.ones(len(src))))
+        return cls(_solve_least_squares(design, dst, strict=False).T)
+
+    def apply(self, points):
+        points = as_points(points)
+        return points @ self.matrix[:, :2].T + self.matrix[:, 2]
+
+    def as_array(self) -> np.ndarray:
+        return np.vstack((self.matrix, (0.0, 0.0, 1.0)))
+
+    def inverse(self):
+        try:
+            inv = np.linalg.inv(self.as_array())
+        except np.linalg.LinAlgError:
+            raise ValueError('仿射矩阵不可逆')
+        return AffineModel(inv[:2])
+
+    def to_dict(self):
+        return {"model": self.name, "matrix": self.matrix.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["matrix"])
+
+
+def _normalization(points: np.ndarray) -> np.ndarray:
+    """Hartley 归一化：平移到质心并缩放到平均距离 √2，返回 3x3 矩阵"""
+    center = points.mean(axis=0)
+    distance = np.hypot(*(points - center).T).mean()
+    scale = math.sqrt(2) / distance if distance > 0 else 1.0
+    return np.array([[scale, 0.0, -scale * center[0]],
+                     [0.0, scale, -scale * center[1]],
+                     [0.0, 0.0, 1.0]])
+
+
+class HomographyModel(CalibrationModel):
+    """单应变换: [lat·w, lon·w, w]ᵀ = H · [x, y, 1]ᵀ"""
+    name = MODEL_HOMOGRAPHY
+    min_points = 4
+    sample_size = 4
+
+    def __init__(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float64).reshape(3, 3)
+        if matrix[2, 2] != 0:
+            matrix = matrix / matrix[2, 2]
+        self.matrix = matrix
+
+    @classmethod
+    def fit(cls, src, dst):
+        """归一化 DLT"""
+        src, dst = as_points(src), as_points(dst)
+        if len(src) < cls.min_points:
+            raise ValueError(f'单应变换至少需要 {cls.min_points} 个校准点')
+        t_src, t_dst = _normalization(src), _normalization(dst)
+        s = src @ t_src[:2, :2].T + t_src[:2, 2]
+        d = dst @ t_dst[:2, :2].T + t_dst[:2, 2]
+        n = len(s)
+        ones, zeros = np.ones(n), np.zeros((n, 3))
+        homogeneous = np.column_stack((s, ones))
+        rows_x = np.hstack((homogeneous, zeros, -d[:, :1] * homogeneous))
+        rows_y = np.hstack((zeros, homogeneous, -d[:, 1:] * homogeneous))
+        design = np.vstack((rows_x, rows_y))
+        _, singular, vt = np.linalg.svd(design)
+        # 第 8 个奇异值接近 0 说明零空间不止一维（如 3 点共线），解不唯一
+        if singular[7] <= singular[0] * 1e-12:
+            raise ValueError('校准点分布退化（共线或重复），无法确定变换')
+        h = vt[-1].reshape(3, 3)
+        matrix = np.linalg.inv(t_dst) @ h @ t_src
+        if abs(matrix[2, 2]) < 1e-15:
+            raise ValueError('单应矩阵退化')
+        return cls(matrix)
+
+    def apply(self, points):
+        points = as_points(points)
+        projected = points @ self.matrix[:, :2].T + self.matrix[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return projected[:, :2] / projected[:, 2:]
+
+    def inverse(self):
+        try:
+            return HomographyModel(np.linalg.inv(self.matrix))
+        except np.linalg.LinAlgError:
+            raise ValueError('单应矩阵不可逆')
+
+    def to_dict(self):
+        return {"model": self.name, "matrix": self.matrix.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["matrix"])
+
+
+class PolynomialModel(CalibrationModel):
+    """
+    二次多项式: 对归一化坐标 (u, v) 有 lat, lon = [1, u, v, u², uv, v²] · coeffs
+    多项式没有解析逆，拟合时同时拟合一个从地图坐标到游戏坐标的反向多项式。
+    """
+    name = MODEL_POLYNOMIAL
+    min_points = 6
+    sample_size = 6
+
+    def __init__(self, offset, scale, coeffs, inverse_model: Optional['PolynomialModel'] = None):
+        self.offset = np.asarray(offset, dtype=np.float64).reshape(2)
+        self.scale = float(scale)
+        self.coeffs = np.asarray(coeffs, dtype=np.float64).reshape(6, 2)
+        self._inverse = inverse_model
+
+    @staticmethod
+    def _terms(points: np.ndarray, offset: np.ndarray, scale: float) -> np.ndarray:
+        u, v = ((points - offset) * scale).T
+        return np.column_stack((np.ones(len(points)), u, v, u * u, u * v, v * v))
+
+    @classmethod
+    def _fit_one(cls, src: np.ndarray, dst: np.ndarray) -> 'PolynomialModel':
+        offset = src.mean(axis=0)
+        spread = np.abs(src - offset).max()
+        scale = 1.0 / spread if spread > 0 else 1.0
+        return cls(offset, scale, _solve_least_squares(cls._terms(src, offset, scale), dst))
+
+    @classmethod
+    def fit(cls, src, dst):
+        src, dst = as_points(src), as_points(dst)
+        if len(src) < cls.min_points:
+            raise ValueError(f'二次多项式至少需要 {cls.min_points} 个校准点')
+        forward = cls._fit_one(src, dst)
+        backward = cls._fit_one(dst, src)
+        forward._inverse, backward._inverse = backward, forward
+        return forward
+
+    def apply(self, points):
+        points = as_points(points)
+        return self._terms(points, self.offset, self.scale) @ self.coeffs
+
+    def inverse(self):
+        if self._inverse is None:
+            raise ValueError('缺少反向多项式')
+        return self._inverse
+
+    def _params(self) -> Dict:
+        return {"offset": self.offset.tolist(), "scale": self.scale, "coeffs": self.coeffs.tolist()}
+
+    def to_dict(self):
+        data = {"model": self.name, **self._params()}
+        if self._inverse is not None:
+            data["inverse"] = self._inverse._params()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        forward = cls(data["offset"], data["scale"], data["coeffs"])
+        if data.get("inverse"):
+            backward = cls(data["inverse"]["offset"], data["inverse"]["scale"], data["inverse"]["coeffs"])
+            forward._inverse, backward._inverse = backward, forward
+        return forward
+
+
+def _circumcircle(a, b, c) -> Tuple[float, float, float]:
+    """三角形外接圆 (圆心x, 圆心y, 半径²)；退化三角形返回无穷大半径"""
+    d = 2 * (a[0] * (b[1] - c[1]) + b[0] * (c[1] - a[1]) + c[0] * (a[1] - b[1]))
+    if d == 0:
+        return 0.0, 0.0, math.inf
+    a2, b2, c2 = a[0] ** 2 + a[1] ** 2, b[0] ** 2 + b[1] ** 2, c[0] ** 2 + c[1] ** 2
+    ux = (a2 * (b[1] - c[1]) + b2 * (c[1] - a[1]) + c2 * (a[1] - b[1])) / d
+    uy = (a2 * (c[0] - b[0]) + b2 * (a[0] - c[0]) + c2 * (b[0] - a[0])) / d
+    return ux, uy, (a[0] - ux) ** 2 + (a[1] - uy) ** 2
+
+
+def delaunay_triangles(points) -> np.ndarray:
+    """
+    Delaunay 三角剖分，返回 (M, 3) 的顶点下标
+    安装了 scipy 时使用 scipy.spatial.Delaunay，否则用 Bowyer-Watson 算法（校准点只有几十个，足够快）。
+    """
+    points = as_points(points)
+    if is_degenerate(points):
+        return np.zeros((0, 3), dtype=np.int64)
+    if Delaunay is not None:
+        return np.asarray(Delaunay(points).simplices, dtype=np.int64)
+
+    # 归一化到单位范围，避免经纬度数值过小导致外接圆判断失准
+    lo = points.min(axis=0)
+    span = (points.max(axis=0) - lo).max()
+    coords = [tuple(p) for p in (points - lo) / span]
+    n = len(coords)
+    # 包含所有点的超级三角形
+    coords += [(-10.0, -10.0), (10.0, -10.0), (0.0, 10.0)]
+    triangles = {(n, n + 1, n + 2): _circumcircle(*coords[n:n + 3])}
+    for i in range(n):
+        px, py = coords[i]
+        bad = [t for t, (cx, cy, r2) in triangles.items() if (px - cx) ** 2 + (py - cy) ** 2 < r2]
+        # 坏三角形区域的边界（只属于一个坏三角形的边）
+        edge_count: Dict[Tuple[int, int], int] = {}
+        for t in bad:
+            del triangles[t]
+            for edge in ((t[0], t[1]), (t[1], t[2]), (t[2], t[0])):
+                key = (min(edge), max(edge))
+                edge_count[key] = edge_count.get(key, 0) + 1
+        for (u, v), count in edge_count.items():
+            if count == 1:
+                triangles[(u, v, i)] = _circumcircle(coords[u], coords[v], coords[i])
+    result = [t for t in triangles if max(t) < n]
+    return np.array(result, dtype=np.int64).reshape(-1, 3)
+
+
+class PiecewiseAffineModel(CalibrationModel):
+    """
+    分段仿射：三角形内按重心坐标在三个顶点的目标坐标间线性插值（在校准点上严格通过），
+    凸包之外使用所有点的整体仿射
+    """
+    name = MODEL_PIECEWISE
+    min_points = 3
+    sample_size = 3
+
+    def __init__(self, src, dst, triangles=None):
+        self.src = as_points(src)
+        self.dst = as_points(dst)
+        if triangles is None:
+            triangles = delaunay_triangles(self.src)
+        self.triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        self.fallback = AffineModel.fit(self.src, self.dst)
+        # 每个三角形: 原点 (T, 2) 和把 (p - 原点) 换算为重心坐标 (λ1, λ2) 的矩阵 (T, 2, 2)
+        corners = self.src[self.triangles]
+        self._origins = corners[:, 0]
+        edges = np.stack((corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=2)
+        det = edges[:, 0, 0] * edges[:, 1, 1] - edges[:, 0, 1] * edges[:, 1, 0]
+        valid = np.abs(det) > 1e-300
+        inv = np.full_like(edges, np.nan)
+        inv[valid] = np.linalg.inv(edges[valid])
+        self._to_barycentric = inv
+
+    @classmethod
+    def fit(cls, src, dst):
+        src, dst = as_points(src), as_points(dst)
+        if len(src) < cls.min_points:
+            raise ValueError(f'分段仿射至少需要 {cls.min_points} 个校准点')
+        return cls(src, dst)
+
+    def apply(self, points):
+        points = as_points(points)
+        result = self.fallback.apply(points)
+        count = len(self.triangles)
+        if count == 0 or len(points) == 0:
+            return result
+        chunk = max(1, PIECEWISE_CHUNK_ELEMENTS // count)
+        corner_dst = self.dst[self.triangles]
+        for start in range(0, len(points), chunk):
+            block = points[start:start + chunk]
+            # (n, T, 2) 的重心坐标 λ1, λ2
+            lam = np.einsum('tij,ntj->nti', self._to_barycentric, block[:, None, :] - self._origins[None])
+            lam0 = 1.0 - lam[..., 0] - lam[..., 1]
+            inside = (lam0 >= -BARYCENTRIC_EPSILON) & (lam >= -BARYCENTRIC_EPSILON).all(axis=2)
+            found = inside.any(axis=1)
+            if not found.any():
+                continue
+            rows = np.nonzero(found)[0]
+            tri = inside[rows].argmax(axis=1)
+            l1, l2 = lam[rows, tri, 0, None], lam[rows, tri, 1, None]
+            corners = corner_dst[tri]
+            result[start + rows] = (1.0 - l1 - l2) * corners[:, 0] + l1 * corners[:, 1] + l2 * corners[:, 2]
+        return result
+
+    def inverse(self):
+        # 同一套三角形在地图坐标中也是一个剖分（三角形没有翻转时），插值方向对调即可
+        return PiecewiseAffineModel(self.dst, self.src, self.triangles)
+
+    def to_dict(self):
+        return {"model": self.name, "src": self.src.tolist(), "dst": self.dst.tolist(),
+                "triangles": self.triangles.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["src"], data["dst"], data.get("triangles"))
+
+
+MODELS: Dict[str, Type[CalibrationModel]] = {
+    MODEL_AFFINE: AffineModel,
+    MODEL_HOMOGRAPHY: HomographyModel,
+    MODEL_POLYNOMIAL: PolynomialModel,
+    MODEL_PIECEWISE: PiecewiseAffineModel,
+}
+
+
+def get_model_class(name: str) -> Type[CalibrationModel]:
+    try:
+        return MODELS[name]
+    except KeyError:
+        raise ValueError(f'未知的校准模型: {name}')
+
+
+def model_from_dict(data: Dict) -> CalibrationModel:
+    return get_model_class(data["model"]).from_dict(data)
+
+
+class CalibrationFit:
+    """
+    拟合结果
+    model      在内点上拟合的模型
+    affine     在内点上拟合的仿射近似（旧格式的 a-f 矩阵）
+    residuals  每个校准点的残差（地图坐标单位；离群点的残差相对于最终模型）
+    inliers    每个校准点是否被采用
+    threshold  离群判定阈值，未做离群检测时为 None
+    """
+
+    def __init__(self, model: CalibrationModel, affine: AffineModel, residuals: np.ndarray,
+                 inliers: np.ndarray, threshold: Optional[float] = None):
+        self.model = model
+        self.affine = affine
+        self.residuals = residuals
+        self.inliers = inliers
+        self.threshold = threshold
+
+    @property
+    def outliers(self) -> np.ndarray:
+        """被剔除的校准点下标"""
+        return np.nonzero(~self.inliers)[0]
+
+    @property
+    def rms(self) -> float:
+        """内点残差的均方根"""
+        used = self.residuals[self.inliers]
+        return float(np.sqrt(np.mean(used ** 2))) if len(used) else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "model": self.model.name,
+            "residuals": self.residuals.tolist(),
+            "inliers": self.inliers.tolist(),
+            "rms": self.rms,
+            "threshold": self.threshold,
+        }
+
+
+def _hypotheses(n: int, size: int, max_iterations: int, rng: np.random.Generator):
+    """点数较少时枚举所有组合，否则随机抽样"""
+    if math.comb(n, size) <= max_iterations:
+        yield from itertools.combinations(range(n), size)
+        return
+    for _ in range(max_iterations):
+        yield tuple(rng.choice(n, size, replace=False))
+
+
+def find_inliers(model_cls: Type[CalibrationModel], src: np.ndarray, dst: np.ndarray,
+                 threshold: Optional[float] = None, max_iterations: int = RANSAC_MAX_ITERATIONS,
+                 seed: Optional[int] = None) -> Tuple[np.ndarray, float]:
+    """
+    稳健地找出内点，返回 (内点掩码, 阈值)
+    指定 threshold 时为 RANSAC（内点最多者胜，相同则残差和较小者胜）；
+    未指定时为 LMedS（第 h 小的残差最小者胜，h = (n + 样本数 + 1) // 2），阈值取稳健标准差的
+    OUTLIER_SIGMAS 倍，且不小于目标坐标范围的 MIN_RELATIVE_THRESHOLD，避免把正常的点击误差当成离群点。
+    点数不超过样本数 + 1 时每个假设都恰好只有一个点不被拟合，无法判断是哪个点错了，不做剔除。
+    """
+    n = len(src)
+    size = model_cls.sample_size
+    all_inliers = np.ones(n, dtype=bool)
+    if n < size + 2:
+        return all_inliers, threshold
+    order = (n + size + 1) // 2 - 1
+    rng = np.random.default_rng(seed)
+    best_score, best_residuals = None, None
+    for sample in _hypotheses(n, size, max_iterations, rng):
+        sample = list(sample)
+        if is_degenerate(src[sample]):
+            continue
+        try:
+            with np.errstate(all='ignore'):
+                residuals = model_cls.fit(src[sample], dst[sample]).residuals(src, dst)
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+        residuals = np.where(np.isfinite(residuals), residuals, np.inf)
+        if threshold is None:
+            score = (float(np.partition(residuals, order)[order]) ** 2,)
+        else:
+            within = residuals <= threshold
+            score = (-int(within.sum()), float(residuals[within].sum()))
+        if best_score is None or score < best_score:
+            best_score, best_residuals = score, residuals
+    if best_residuals is None:
+        return all_inliers, threshold
+
+    if threshold is None:
+        sigma = 1.4826 * (1 + 5.0 / (n - size)) * math.sqrt(best_score[0])
+        extent = float(np.hypot(*np.ptp(dst, axis=0)))
+        threshold = max(OUTLIER_SIGMAS * sigma, MIN_RELATIVE_THRESHOLD * extent)
+    inliers = best_residuals <= threshold
+    if inliers.sum() < max(size, model_cls.min_points):
+        return all_inliers, threshold
+    return inliers, threshold
+
+
+def fit_calibration(model_name: str, src, dst, robust: bool = True, threshold: Optional[float] = None,
+                    max_iterations: int = RANSAC_MAX_ITERATIONS, seed: Optional[int] = None) -> CalibrationFit:
+    """
+    拟合校准模型
+    src 为 (N, 2) 的游戏坐标，dst 为 (N, 2) 的地图坐标 (lat, lon)。
+    robust 为 True 时先剔除离群点；分段仿射在每个点上都严格通过，本身无法暴露离群点，
+    因此用整体仿射做离群检测。
+    """
+    model_cls = get_model_class(model_name)
+    src, dst = as_points(src), as_points(dst)
+    if len(src) != len(dst):
+        raise ValueError('游戏坐标与地图坐标的数量不一致')
+    if len(src) < model_cls.min_points:
+        raise ValueError(f'{model_name} 模型至少需要 {model_cls.min_points} 个校准点')
+
+    inliers, used_threshold = np.ones(len(src), dtype=bool), None
+    if robust:
+        consensus_cls = AffineModel if model_cls is PiecewiseAffineModel else model_cls
+        inliers, used_threshold = find_inliers(consensus_cls, src, dst, threshold, max_iterations, seed)
+    model = model_cls.fit(src[inliers], dst[inliers])
+    affine = model if isinstance(model, AffineModel) else AffineModel.fit(src[inliers], dst[inliers])
+    with np.errstate(all='ignore'):
+        residuals = model.residuals(src, dst)
+    return CalibrationFit(model, affine, residuals, inliers, used_threshold)
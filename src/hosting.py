@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地服务器托管
+静态页面、瓦片、maps.json、REST 状态接口和 WebSocket 同步由同一个 aiohttp 应用在一个端口 (8000) 上提供：
+- 所有请求共用一个事件循环、一个线程池和同一份瓦片缓存，QWebEngine 的页面、瓦片和 WebSocket 共用一组长连接
+- 瓦片读取和静态文件在大小固定的线程池中进行，不再每个连接创建一个线程
+- workers > 1 时启动额外的工作进程共享同一个监听套接字，进程之间的同步经过本进程中的背板代理 (backplane.py)
+- stop() 先停止接受新连接，等待进行中的请求完成（最多 shutdown_timeout 秒）并关闭 WebSocket，再结束工作进程
+- 同步状态日志写在应用数据目录 (data_dir) 中：单进程时由同步中心记录，多进程时由背板代理记录所有房间
+
+路由: /index.html 等静态文件、/tiles/<map>/<z>/<x>/<y>.<ext>、/ws、/api、/api/status
+
+嵌入运行: ServerHost(HostingConfig(...)).start() / stop()，由 main_app 的 LocalServerManager 托管
+独立运行: python hosting.py --workers 4 --threads 16
+"""
+
+import os
+import json
+import queue
+import socket
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+from static_assets import StaticAssets, DEFAULT_CACHE_CONTROL, etag_matches
+from tile_store import TileStore, parse_tile_path, TILE_CACHE_CONTROL
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 开发时页面在仓库的 web/ 目录中，打包后与程序在同一目录
+WEB_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'web')
+INDEX_FILE = 'index.html'
+# 同步 WebSocket 和 /api 没有鉴权，默认只监听本机；
+# 设置 server_allow_lan 为 true 后监听所有地址，局域网设备可以打开 http://<本机地址>:8000/index.html
+DEFAULT_HOST = '127.0.0.1'
+LAN_HOST = '0.0.0.0'
+DEFAULT_PORT = 8000
+# 每个进程中读取瓦片和静态文件的线程数
+DEFAULT_THREADS = min(32, (os.cpu_count() or 1) + 4)
+# 停止时等待进行中的请求和连接关闭的最长时间
+DEFAULT_SHUTDOWN_TIMEOUT = 3.0
+# 启动时等待事件循环就绪的最长时间
+STARTUP_TIMEOUT_SECONDS = 10.0
+# 应用设置 (app_settings.json) 中的键
+SETTING_WORKERS = 'server_workers'
+SETTING_THREADS = 'server_threads'
+SETTING_SHUTDOWN_TIMEOUT = 'server_shutdown_timeout'
+SETTING_ALLOW_LAN = 'server_allow_lan'
+SETTING_DATA_DIR = 'server_data_dir'
+# 应用数据目录名和其中的状态日志目录
+APP_DATA_NAME = 'WutheringWaves-Navigator'
+JOURNAL_DIR_NAME = 'sync_journal'
+
+
+def default_data_dir() -> str:
+    """用户的应用数据目录（Windows 为 %APPDATA%，其他系统为 $XDG_DATA_HOME 或 ~/.local/share），不使用程序所在目录"""
+    if os.name == 'nt':
+        base = os.environ.get('APPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Roaming')
+    else:
+        base = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(base, APP_DATA_NAME)
+
+
+class HostingConfig:
+    """
+    托管参数：监听地址、工作进程数、每个进程的线程数和停止超时；
+    data_dir 为应用数据目录（默认 default_data_dir()），journal 为 False 时不记录同步状态日志
+    """
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 workers: int = 1, threads: Optional[int] = None,
+                 shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT, root_dir: str = SCRIPT_DIR,
+                 data_dir: Optional[str] = None, journal: bool = True):
+        if workers < 1:
+            raise ValueError(f"工作进程数必须大于 0: {workers}")
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = max(1, threads or DEFAULT_THREADS)
+        self.shutdown_timeout = shutdown_timeout
+        self.root_dir = root_dir
+        self.data_dir = data_dir or default_data_dir()
+        self.journal = journal
+
+    @property
+    def journal_dir(self) -> Optional[str]:
+        return os.path.join(self.data_dir, JOURNAL_DIR_NAME) if self.journal else None
+
+    @classmethod
+    def from_settings(cls, settings: Dict[str, Any], **kwargs) -> 'HostingConfig':
+        """
+        从应用设置读取 server_workers / server_threads / server_shutdown_timeout / server_data_dir，缺失或无效时使用默认值；
+        只有 server_allow_lan 明确为 true 时才监听所有地址
+        """
+        def read(key, convert, default):
+            try:
+                value = convert(settings.get(key, default))
+            except (TypeError, ValueError):
+                return default
+            return value if value > 0 else default
+
+        kwargs.setdefault('workers', read(SETTING_WORKERS, int, 1))
+        kwargs.setdefault('threads', read(SETTING_THREADS, int, DEFAULT_THREADS))
+        kwargs.setdefault('shutdown_timeout', read(SETTING_SHUTDOWN_TIMEOUT, float, DEFAULT_SHUTDOWN_TIMEOUT))
+        kwargs.setdefault('host', LAN_HOST if settings.get(SETTING_ALLOW_LAN) is True else DEFAULT_HOST)
+        data_dir = settings.get(SETTING_DATA_DIR)
+        kwargs.setdefault('data_dir', data_dir if isinstance(data_dir, str) and data_dir else None)
+        return cls(**kwargs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.__dict__)
+
+
+def load_hosting_config(settings_file: str, **kwargs) -> HostingConfig:
+    """读取设置文件中的托管参数，文件不存在或无法解析时使用默认值"""
+    try:
+        with open(settings_file, 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+    except (OSError, ValueError):
+        settings = {}
+    return HostingConfig.from_settings(settings if isinstance(settings, dict) else {}, **kwargs)
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """创建并绑定 TCP 套接字（尚未 listen），端口被占用时立即抛出 OSError"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != 'nt':
+        # Windows 上 SO_REUSEADDR 允许多个进程绑定同一端口，不能设置
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind((host, port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+# --- 应用 ---
+def find_index_file(root_dir: str) -> Optional[str]:
+    """地图页面: 优先使用根目录中的 index.html，开发时回退到仓库的 web/index.html"""
+    for directory in (root_dir, WEB_DIR):
+        path = os.path.join(directory, INDEX_FILE)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def resolve_static_path(root_dir: str, relative: str) -> Optional[str]:
+    """把请求路径映射到 root_dir 下的文件，拒绝 ..、反斜杠和盘符等可能逃出根目录的路径"""
+    parts = [part for part in relative.split('/') if part]
+    if not parts or any(part in ('.', '..') or '\\' in part or ':' in part for part in parts):
+        return None
+    return os.path.join(root_dir, *parts)
+
+
+def create_site_app(root_dir: str, tile_store: TileStore, sync_hub=None,
+                    assets: Optional[StaticAssets] = None) -> web.Application:
+    """
+    同一端口上的全部服务（HTTP/1.1 长连接）
+    - /ws、/api、/api/status: WebSocket 同步服务 (server.add_sync_routes)
+    - /tiles/<map>/<z>/<x>/<y>.<ext>: 走 TileStore（归档内存映射 + LRU 缓存 + ETag），缓存未命中时在线程池中读取
+    - / 和 /index.html: 地图页面；其余路径为 root_dir 下的静态文件（maps.json、images/ 等）
+    页面、maps.json 等文本资源经过 StaticAssets：强校验 ETag、304、gzip/brotli 预压缩版本；图片等交给 FileResponse。
+    """
+    from server import add_sync_routes
+
+    assets = assets or StaticAssets()
+    app = web.Application()
+    app['tile_store'] = tile_store
+    app['static_assets'] = assets
+    add_sync_routes(app, sync_hub)
+    index_path = find_index_file(root_dir)
+
+    async def handle_tile(request: web.Request) -> web.StreamResponse:
+        tile_request = parse_tile_path(request.raw_path)
+        if tile_request is None:
+            raise web.HTTPNotFound()
+        tile = tile_store.peek_tile(*tile_request)
+        if tile is None:
+            loop = asyncio.get_running_loop()
+            tile = await loop.run_in_executor(None, tile_store.get_tile, *tile_request)
+        if tile is None:
+            raise web.HTTPNotFound(text="Tile not found")
+        headers = {"ETag": tile.etag, "Cache-Control": TILE_CACHE_CONTROL}
+        if etag_matches(request.headers.get("If-None-Match", ""), tile.etag):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=tile.data, content_type=tile.content_type, headers=headers)
+
+    async def serve_file(request: web.Request, path: Optional[str]) -> web.StreamResponse:
+        if path is None:
+            raise web.HTTPNotFound()
+        asset = assets.peek(path)
+        if asset is None:
+            loop = asyncio.get_running_loop()
+            asset = await loop.run_in_executor(None, assets.load, path)
+        if asset is not None:
+            return assets.respond(request, asset)
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={"Cache-Control": DEFAULT_CACHE_CONTROL})
+
+    async def handle_index(request: web.Request) -> web.StreamResponse:
+        return await serve_file(request, index_path)
+
+    async def handle_static(request: web.Request) -> web.StreamResponse:
+        return await serve_file(request, resolve_static_path(root_dir, request.match_info['path']))
+
+    app.router.add_get('/tiles/{path:.+}', handle_tile)
+    app.router.add_get('/', handle_index)
+    app.router.add_get('/' + INDEX_FILE, handle_index)
+    app.router.add_get('/{path:.+}', handle_static)
+    return app
+
+
+def _create_tile_store(root_dir: str, fill_pending: bool) -> TileStore:
+    """fill_pending 为 True 时由该进程负责后台补全按需渲染的地图（只有主进程应当补全）"""
+    from lazy_tiles import LazyTileManager
+    tiles_dir = os.path.join(root_dir, 'tiles')
+    lazy_tiles = LazyTileManager(tiles_dir, os.path.join(root_dir, 'maps.json'), fill_in_background=fill_pending)
+    tile_store = TileStore(tiles_dir, lazy_tiles=lazy_tiles)
+    if fill_pending:
+        lazy_tiles.start_pending_fills()
+    return tile_store
+
+
+class _Worker:
+    """在当前线程的事件循环中运行应用"""
+
+    def __init__(self, config: HostingConfig, app: web.Application, sock: socket.socket):
+        self.config = config
+        self.app = app
+        self.sock = sock
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._stop_requested = False
+
+    def run(self, on_ready=None, before_serving=None, after_serving=None):
+        """运行到 request_stop() 被调用；before/after_serving 为在事件循环中执行的协程函数"""
+        loop = asyncio.new_event_loop()
+        self.loop = loop
+        executor = ThreadPoolExecutor(self.config.threads, thread_name_prefix='FileServer')
+        loop.set_default_executor(executor)
+        try:
+            loop.run_until_complete(self._serve(on_ready, before_serving, after_serving))
+        finally:
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+
+    async def _serve(self, on_ready, before_serving, after_serving):
+        self._stop_event = asyncio.Event()
+        if before_serving is not None:
+            await before_serving()
+        runner = web.AppRunner(self.app, handle_signals=False, access_log=None,
+                               shutdown_timeout=self.config.shutdown_timeout)
+        try:
+            await runner.setup()
+            await web.SockSite(runner, self.sock).start()
+            if on_ready is not None:
+                on_ready(None)
+            if not self._stop_requested:
+                await self._stop_event.wait()
+        except Exception as e:
+            if on_ready is not None:
+                on_ready(e)
+            raise
+        finally:
+            # 停止接受连接，关闭 WebSocket 并写入状态快照，等待进行中的请求完成
+            await runner.cleanup()
+            if after_serving is not None:
+                await after_serving()
+
+    def request_stop(self):
+        """可在任意线程调用"""
+        self._stop_requested = True
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._set_stop)
+        except RuntimeError:
+            pass  # 事件循环刚刚关闭
+
+    def _set_stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+
+def _worker_process_main(config: HostingConfig, sock: socket.socket, broker_port: int, control: 'multiprocessing.Queue', ready: 'multiprocessing.Queue'):
+    """
+    额外工作进程的入口
+    使用独立的 WebSocketHub（不写状态日志，状态由背板代理保存）和 TileStore（不启动后台补全），
+    开始接受连接后向 ready 队列报告（失败时报告错误信息），通过 control 队列接收 ('invalidate', 地图名) 和 ('stop', None)。
+    """
+    import server
+    from backplane import SocketBackplane
+
+    sync_hub = server.WebSocketHub(server.hub.initial_map_name, backplane=SocketBackplane(port=broker_port))
+    tile_store = _create_tile_store(config.root_dir, fill_pending=False)
+    worker = _Worker(config, create_site_app(config.root_dir, tile_store, sync_hub), sock)
+
+    def read_control():
+        while True:
+            try:
+                command, argument = control.get()
+            except (EOFError, OSError):
+                command, argument = 'stop', None  # 主进程已退出
+            if command == 'invalidate':
+                tile_store.invalidate(argument)
+            elif command == 'stop':
+                worker.request_stop()
+                return
+
+    def on_ready(error):
+        ready.put((os.getpid(), None if error is None else str(error)))
+
+    threading.Thread(target=read_control, name="HostingControl", daemon=True).start()
+    try:
+        worker.run(on_ready)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tile_store.close()
+
+
+class ServerHost:
+    """
+    托管本地服务器
+    start() 绑定端口并在后台线程中启动主工作者（端口被占用时抛出 OSError），workers > 1 时再启动额外的工作进程；
+    stop() 平稳停止全部工作者，超时未结束的工作进程才会被强制终止。
+    """
+
+    def __init__(self, config: Optional[HostingConfig] = None, sync_hub=None,
+                 tile_store: Optional[TileStore] = None):
+        self.config = config or HostingConfig()
+        self._sync_hub = sync_hub
+        self.tile_store = tile_store
+        self._worker: Optional[_Worker] = None
+        self._thread: Optional[threading.Thread] = None
+        self._sock: Optional[socket.socket] = None
+        self._processes: List[multiprocessing.Process] = []
+        self._controls: List[Any] = []
+        self._broker = None
+        self._journal = None
+        self._lock = threading.Lock()
+
+    @property
+    def sync_hub(self):
+        if self._sync_hub is None:
+            from server import hub
+            self._sync_hub = hub
+        return self._sync_hub
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.is_running():
+                return
+            config = self.config
+            if self.tile_store is None:
+                self.tile_store = _create_tile_store(config.root_dir, fill_pending=True)
+            self._sock = bind_socket(config.host, config.port)
+            try:
+                self._start_primary()
+                if config.workers > 1:
+                    self._start_processes()
+            except BaseException:
+                self._stop_locked()
+                raise
+
+    def _start_primary(self):
+        worker = _Worker(self.config, create_site_app(self.config.root_dir, self.tile_store, self.sync_hub),
+                         self._sock)
+        ready = threading.Event()
+        result: List[Optional[BaseException]] = [None]
+
+        def on_ready(error):
+            result[0] = error
+            ready.set()
+
+        def run():
+            try:
+                worker.run(on_ready, self._start_broker, self._stop_broker)
+            except Exception as e:
+                if not ready.is_set():
+                    on_ready(e)
+                else:
+                    print(f"Server host exception: {e}")
+
+        self._worker = worker
+        self._thread = threading.Thread(target=run, name="ServerHost", daemon=True)
+        self._thread.start()
+        if not ready.wait(STARTUP_TIMEOUT_SECONDS):
+            raise TimeoutError("服务器启动超时")
+        if result[0] is not None:
+            raise result[0]
+
+    def _get_journal(self):
+        """状态日志在多次启动之间共用，只在第一次启动时从磁盘恢复"""
+        if self._journal is None and self.config.journal_dir:
+            from state_journal import StateJournal
+            self._journal = StateJournal(self.config.journal_dir)
+        return self._journal
+
+    async def _start_broker(self):
+        """
+        在主事件循环中准备同步：单进程时由同步中心记录状态日志；
+        多进程时运行背板代理，所有房间的状态消息都经过代理，由代理记录状态日志，主工作者直接在进程内接入
+        """
+        journal = self._get_journal()
+        if self.config.workers <= 1:
+            self.sync_hub.journal = journal
+            return
+        from backplane import BackplaneBroker, InProcessBackplane
+        self.sync_hub.journal = None
+        self._broker = BackplaneBroker(port=0, journal=journal)
+        await self._broker.start()
+        self.sync_hub.use_backplane(InProcessBackplane(self._broker.broker))
+
+    async def _stop_broker(self):
+        if self._broker is not None:
+            await self._broker.stop()
+            self._broker = None
+
+    def _start_processes(self):
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        for index in range(1, self.config.workers):
+            control = context.Queue()
+            process = context.Process(target=_worker_process_main, name=f"ServerWorker-{index}",
+                                      args=(self.config, self._sock, self._broker.port, control, ready),
+                                      daemon=True)
+            process.start()
+            self._controls.append(control)
+            self._processes.append(process)
+        # 等待所有工作进程开始接受连接；启动失败的进程直接报错，不留下只有部分进程在运行的服务器
+        try:
+            for _ in self._processes:
+                try:
+                    pid, error = ready.get(timeout=STARTUP_TIMEOUT_SECONDS)
+                except queue.Empty:
+                    raise TimeoutError("服务器工作进程启动超时")
+                if error is not None:
+                    raise RuntimeError(f"服务器工作进程 {pid} 启动失败: {error}")
+        finally:
+            ready.close()
+
+    def stop(self):
+        with self._lock:
+            self._stop_locked()
+
+    def _stop_locked(self):
+        timeout = self.config.shutdown_timeout + 1
+        # 先停止工作进程（它们连接着主事件循环中的背板代理）
+        for control in self._controls:
+            try:
+                control.put(('stop', None))
+            except (OSError, ValueError):
+                pass
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                print(f"{process.name} did not stop in time, terminating")
+                process.terminate()
+                process.join(1)
+        for control in self._controls:
+            control.close()
+        self._processes, self._controls = [], []
+
+        if self._worker is not None:
+            self._worker.request_stop()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                print("Server host did not stop in time")
+        self._worker = None
+        self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def invalidate(self, map_name: str):
+        """地图被删除或重新生成前调用：清除本进程和所有工作进程中该地图的瓦片缓存"""
+        if self.tile_store is not None:
+            self.tile_store.invalidate(map_name)
+        for control in self._controls:
+            try:
+                control.put(('invalidate', map_name))
+            except (OSError, ValueError):
+                pass
+
+    def close(self):
+        """停止服务器并释放瓦片存取层"""
+        self.stop()
+        if self.tile_store is not None:
+            self.tile_store.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.is_running(),
+            "config": self.config.to_dict(),
+            "processes": [{"name": p.name, "pid": p.pid, "alive": p.is_alive()} for p in self._processes],
+            "broker_connections": self._broker.connections if self._broker is not None else 0,
+            "journal": self._journal.stats() if self._journal is not None else None,
+        }
+
+
+# --- 独立启动 ---
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="在一个端口上托管地图页面、瓦片和同步服务器")
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f"监听地址 (默认: {DEFAULT_HOST}，仅本机)")
+    parser.add_argument('--lan', action='store_true', help=f"监听所有地址 ({LAN_HOST})，允许局域网设备访问")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"监听端口 (默认: {DEFAULT_PORT})")
+    parser.add_argument('--workers', type=int, default=1, help="工作进程数 (默认: 1)")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help=f"每个进程读取文件的线程数 (默认: {DEFAULT_THREADS})")
+    parser.add_argument('--shutdown-timeout', type=float, default=DEFAULT_SHUTDOWN_TIMEOUT,
+                        help="停止时等待请求完成的秒数")
+    parser.add_argument('--root', default=SCRIPT_DIR, help="文件服务器根目录 (包含 maps.json 和 tiles/)")
+    parser.add_argument('--data-dir', default=None, help=f"应用数据目录，状态日志写在其中 (默认: {default_data_dir()})")
+    parser.add_argument('--no-journal', action='store_true', help="不记录状态日志，重启后从初始状态开始")
+    args = parser.parse_args()
+
+    host = ServerHost(HostingConfig(host=LAN_HOST if args.lan else args.host, port=args.port, workers=args.workers,
+                                    threads=args.threads, shutdown_timeout=args.shutdown_timeout,
+                                    root_dir=os.path.abspath(args.root), data_dir=args.data_dir,
+                                    journal=not args.no_journal))
+    host.start()
+    print(f"地图页面: http://localhost:{args.port}/index.html  同步: ws://localhost:{args.port}/ws")
+    print(f"工作进程: {args.workers}  每个进程线程数: {host.config.threads}  (Ctrl+C 停止)")
+    stopped = threading.Event()
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        host.close()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量地图导入队列
+每个源文件（或瓦片目录）是一个导入任务，任务在线程池中并发执行：
+- 并发数受 CPU 预算限制（默认保留一个核心给界面和本地服务器）
+- 需要整图解码的大图还受内存预算限制：预算不足时任务保持等待，单张超出预算的图片独占全部预算
+- 每个任务可以单独取消，取消在两个瓦片之间生效，不会留下生成了一半的瓦片
+- 每个任务单独报告进度和状态，一个任务失败不影响其他任务
+- 所有输出写入 base_dir，不修改进程的当前目录
+
+Pillow 的缩放和编码在执行时会释放 GIL，多线程可以同时利用多个核心。
+"""
+
+import os
+import time
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional
+
+from tile_generator import (DEFAULT_TILE_FORMAT, DEFAULT_TILE_STORAGE, TileGenerationCancelled,
+                            check_cancelled, estimate_decode_bytes, process_image)
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+# 进度回调的最小间隔，避免每个瓦片都通知界面
+PROGRESS_INTERVAL_SECONDS = 0.1
+# 同时解码的大图占用内存的上限（字节）
+DEFAULT_DECODE_BUDGET_BYTES = 4 * 1024 ** 3
+# 等待内存预算时检查取消的间隔
+BUDGET_POLL_SECONDS = 0.2
+
+
+def default_cpu_budget() -> int:
+    """默认并发数: CPU 核心数减一，至少为 1"""
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+def get_map_identifier(source_path: str) -> str:
+    """与 process_image 相同的地图ID（不带扩展名的文件名或目录名）"""
+    return os.path.splitext(os.path.basename(os.path.normpath(source_path)))[0]
+
+
+class DecodeBudget:
+    """限制同时解码的大图总内存；超过上限的单个请求按上限计算（只能独占运行）"""
+
+    def __init__(self, max_bytes: int = DEFAULT_DECODE_BUDGET_BYTES):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes: int, cancel_event: Optional[threading.Event] = None) -> int:
+        """等待到有足够的预算，返回实际占用的字节数；等待中被取消时抛出 TileGenerationCancelled"""
+        granted = min(nbytes, self.max_bytes)
+        if granted <= 0:
+            return 0
+        with self._condition:
+            while self.in_use + granted > self.max_bytes:
+                check_cancelled(cancel_event)
+                self._condition.wait(BUDGET_POLL_SECONDS)
+            self.in_use += granted
+        return granted
+
+    def release(self, granted: int):
+        if granted <= 0:
+            return
+        with self._condition:
+            self.in_use -= granted
+            self._condition.notify_all()
+
+
+class ImportJob:
+    """单个导入任务的状态，由工作线程更新，可在任意线程读取"""
+
+    def __init__(self, job_id: int, source_path: str, tile_format: str, storage: str):
+        self.job_id = job_id
+        self.source_path = source_path
+        self.map_name = get_map_identifier(source_path)
+        self.tile_format = tile_format
+        self.storage = storage
+        self.status = JOB_PENDING
+        self.done = 0
+        self.total = 0
+        self.error: Optional[str] = None
+        self.cancel_event = threading.Event()
+        self.future: Optional[Future] = None
+        self._last_report = 0.0
+
+    @property
+    def progress(self) -> float:
+        """0~1 的完成比例"""
+        if self.status == JOB_DONE:
+            return 1.0
+        return self.done / self.total if self.total else 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def cancel(self):
+        """请求取消；尚未开始的任务不会再执行，运行中的任务在下一个瓦片前停止"""
+        self.cancel_event.set()
+
+    def __repr__(self):
+        return f"<ImportJob {self.job_id} {self.map_name} {self.status} {self.progress:.0%}>"
+
+
+class ImportQueue:
+    """
+    导入任务队列
+    on_update(job) 在任务状态变化或进度前进时于工作线程中调用。
+    等待内存预算的任务保持 pending 状态。
+    """
+
+    def __init__(self, base_dir: str, max_workers: Optional[int] = None,
+                 on_update: Optional[Callable[[ImportJob], None]] = None,
+                 decode_budget_bytes: int = DEFAULT_DECODE_BUDGET_BYTES):
+        self.base_dir = base_dir
+        self.max_workers = max_workers or default_cpu_budget()
+        self.on_update = on_update
+        self.decode_budget = DecodeBudget(decode_budget_bytes)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="MapImport")
+        self._jobs: Dict[int, ImportJob] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, source_path: str, tile_format: str = DEFAULT_TILE_FORMAT,
+               storage: str = DEFAULT_TILE_STORAGE) -> ImportJob:
+        """加入一个导入任务；同名地图已有未完成的任务时抛出 ValueError"""
+        with self._lock:
+            job = ImportJob(next(self._ids), source_path, tile_format, storage)
+            for other in self._jobs.values():
+                if other.map_name == job.map_name and not other.finished:
+                    raise ValueError(f"地图 '{job.map_name}' 已在导入队列中")
+            self._jobs[job.job_id] = job
+        job.future = self._executor.submit(self._run_job, job)
+        self._notify(job)
+        return job
+
+    def _run_job(self, job: ImportJob):
+        if job.cancel_event.is_set():
+            self._finish(job, JOB_CANCELLED)
+            return
+        granted = 0
+        try:
+            if not os.path.exists(job.source_path):
+                raise FileNotFoundError(f"文件 '{job.source_path}' 不存在")
+            granted = self.decode_budget.acquire(estimate_decode_bytes(job.source_path, job.storage),
+                                                 job.cancel_event)
+            job.status = JOB_RUNNING
+            self._notify(job)
+            process_image(job.source_path, job.tile_format, job.storage, base_dir=self.base_dir,
+                          cancel_event=job.cancel_event,
+                          progress_callback=lambda done, total: self._on_progress(job, done, total))
+        except TileGenerationCancelled:
+            self._finish(job, JOB_CANCELLED)
+        except Exception as e:
+            job.error = str(e)
+            self._finish(job, JOB_FAILED)
+        else:
+            self._finish(job, JOB_DONE)
+        finally:
+            self.decode_budget.release(granted)
+
+    def _on_progress(self, job: ImportJob, done: int, total: int):
+        job.done, job.total = done, total
+        now = time.monotonic()
+        if done == total or now - job._last_report >= PROGRESS_INTERVAL_SECONDS:
+            job._last_report = now
+            self._notify(job)
+
+    def _finish(self, job: ImportJob, status: str):
+        job.status = status
+        self._notify(job)
+
+    def _notify(self, job: ImportJob):
+        if self.on_update is None:
+            return
+        try:
+            self.on_update(job)
+        except Exception as e:
+            print(f"导入进度回调出错: {e}")
+
+    # --- 查询和控制 ---
+    def jobs(self) -> List[ImportJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def get(self, job_id: int) -> Optional[ImportJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel()
+        return True
+
+    def cancel_all(self):
+        for job in self.jobs():
+            job.cancel()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待所有已提交的任务结束，超时返回 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for job in self.jobs():
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                job.future.exception(timeout=remaining)
+            except FutureTimeoutError:
+                return False
+        return True
+
+    def shutdown(self, cancel: bool = False):
+        """关闭线程池；cancel 为 True 时先取消所有未完成的任务"""
+        if cancel:
+            self.cancel_all()
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="批量导入地图（并发执行，Ctrl+C 取消全部任务）")
+    parser.add_argument('sources', nargs='+', help="图片文件或瓦片目录")
+    parser.add_argument('--format', dest='tile_format', default=DEFAULT_TILE_FORMAT, help="瓦片编码格式")
+    parser.add_argument('--storage', default=DEFAULT_TILE_STORAGE, help="瓦片存储方式")
+    parser.add_argument('--jobs', type=int, default=None, help="并发任务数 (默认: CPU 核心数 - 1)")
+    parser.add_argument('--memory-mb', type=int, default=DEFAULT_DECODE_BUDGET_BYTES // 1024 ** 2,
+                        help="同时解码的大图占用内存上限 (MB)")
+    parser.add_argument('--base-dir', default='.', help="输出目录 (包含 tiles/、images/ 和 maps.json)")
+    args = parser.parse_args()
+
+    queue = ImportQueue(args.base_dir, args.jobs, decode_budget_bytes=args.memory_mb * 1024 ** 2)
+    for source in args.sources:
+        queue.submit(source, args.tile_format, args.storage)
+    try:
+        while not queue.wait(timeout=0.5):
+            pass
+    except KeyboardInterrupt:
+        print("\n正在取消...")
+        queue.cancel_all()
+    queue.shutdown()
+    for job in queue.jobs():
+        print(f"{job.map_name}: {job.status}" + (f" ({job.error})" if job.error else ""))
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按需瓦片渲染
+新导入的地图先只写入 maps.json（标记 "lazy": true），瓦片在第一次被请求时
+从已解码的源图（或其概览）渲染并写入磁盘；后台补全线程以低优先级生成其余瓦片，
+全部完成后去掉 lazy 标记并释放源图。
+每个瓦片只缩放源图中对应的区域，不生成整级缩放图；已解码的源图和概览保存在按字节数限制大小的 LRU 缓存中。
+导入的现成瓦片金字塔（见 pyramid_importer.py）没有源图，缺失的级别由子瓦片合成。
+"""
+
+import io
+import os
+import math
+import time
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from tile_generator import TILE_SIZE, TILE_FORMATS, encode_tile
+from map_registry import get_map_registry
+
+# 后台补全时，距离最近一次前台请求不足该秒数则让出 CPU
+FOREGROUND_IDLE_SECONDS = 0.5
+# 后台补全每生成一个瓦片后的休眠时间
+FILL_INTERVAL_SECONDS = 0.002
+# 每张地图缓存的已解码源图和概览的总字节数上限（最近使用的一幅总是保留，即使超过上限）
+DEFAULT_RENDER_CACHE_BYTES = 1024 * 1024 * 1024
+
+Image.MAX_IMAGE_PIXELS = None
+
+
+class _TileRendererBase(ABC):
+    """按需渲染器的公共部分: 瓦片路径、级别尺寸、持久化和补全顺序"""
+
+    source_path: Optional[str] = None
+
+    def __init__(self, tiles_dir: str, map_entry: Dict[str, Any]):
+        self.tiles_dir = tiles_dir
+        self.map_name = map_entry["name"]
+        self.width = map_entry["width"]
+        self.height = map_entry["height"]
+        self.max_zoom = map_entry["maxZoom"]
+        self.tile_format = map_entry.get("tileFormat", "png")
+        self.tile_ext = TILE_FORMATS[self.tile_format]['ext']
+        self.last_request_time = 0.0
+        self._lock = threading.RLock()
+
+    def level_size(self, z: int):
+        scale = 2 ** (self.max_zoom - z)
+        return int(self.width / scale), int(self.height / scale)
+
+    def level_grid(self, z: int) -> Optional[Tuple[int, int]]:
+        """返回缩放级别 z 的 (列数, 行数)，级别过小时返回 None"""
+        level_width, level_height = self.level_size(z)
+        if level_width == 0 or level_height == 0:
+            return None
+        return math.ceil(level_width / TILE_SIZE), math.ceil(level_height / TILE_SIZE)
+
+    def tile_path(self, z: int, x: int, y: int) -> str:
+        return os.path.join(self.tiles_dir, self.map_name, str(z), str(x), f'{y}.{self.tile_ext}')
+
+    def _in_range(self, z: int, x: int, y: int) -> bool:
+        grid = self.level_grid(z) if 0 <= z <= self.max_zoom else None
+        return grid is not None and 0 <= x < grid[0] and 0 <= y < grid[1]
+
+    @abstractmethod
+    def _render(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """编码一个范围内的瓦片（调用方持有锁）"""
+
+    def _persist(self, tile_path: str, data: bytes):
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        tmp_path = f'{tile_path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, tile_path)
+
+    def render_tile(self, z: int, x: int, y: int, foreground: bool = True) -> Optional[bytes]:
+        """渲染并持久化一个瓦片，坐标超出范围时返回 None"""
+        if foreground:
+            self.last_request_time = time.monotonic()
+        if not self._in_range(z, x, y):
+            return None
+
+        with self._lock:
+            tile_path = self.tile_path(z, x, y)
+            if os.path.exists(tile_path):
+                # 另一个请求或后台线程刚刚生成过
+                with open(tile_path, 'rb') as f:
+                    return f.read()
+            data = self._render(z, x, y)
+            if data is None:
+                return None
+
+        self._persist(tile_path, data)
+        return data
+
+    def fill_levels(self):
+        """后台补全的级别顺序"""
+        return range(self.max_zoom + 1)
+
+    def iter_missing_tiles(self):
+        """按 fill_levels() 的顺序列出尚未生成的瓦片"""
+        for z in self.fill_levels():
+            grid = self.level_grid(z)
+            if grid is None:
+                continue
+            cols, rows = grid
+            for x in range(cols):
+                for y in range(rows):
+                    if not os.path.exists(self.tile_path(z, x, y)):
+                        yield z, x, y
+
+    def release(self):
+        """释放缓存的图像"""
+
+
+class LazyTileRenderer(_TileRendererBase):
+    """
+    单张地图的按需渲染器
+    源图是带内部概览（overview）的多页 TIFF 时，每个级别从尺寸最接近的概览页缩放；
+    单页源图在第一次解码后逐级缩小一半生成概览，低级别只需缩放小图，原图可以被逐出缓存。
+    每个瓦片只从概览中缩放对应区域（resize 的 box 参数，滤波会用到区域外的像素，与整图缩放后裁剪一致）。
+    """
+
+    def __init__(self, tiles_dir: str, map_entry: Dict[str, Any], cache_bytes: int = DEFAULT_RENDER_CACHE_BYTES):
+        super().__init__(tiles_dir, map_entry)
+        self.source_path = os.path.join(tiles_dir, self.map_name, map_entry["source"])
+        self.cache_bytes = cache_bytes
+        # (页号或 ('half', 上一级的键), 宽, 高)，从大到小排列
+        self._overviews: Optional[List[Tuple[Union[int, tuple], int, int]]] = None
+        self._frames: "OrderedDict[Union[int, tuple], Image.Image]" = OrderedDict()
+        self._frame_bytes = 0
+
+    def _list_overviews(self) -> List[Tuple[Union[int, tuple], int, int]]:
+        if self._overviews is None:
+            overviews = get_overview_frames(self.source_path)
+            if overviews is None:
+                # 单页源图：逐级缩小一半，直到不超过一个瓦片
+                overviews = [(0, self.width, self.height)]
+                key, width, height = overviews[0]
+                while max(width, height) > TILE_SIZE:
+                    key, width, height = ('half', key), (width + 1) // 2, (height + 1) // 2
+                    overviews.append((key, width, height))
+            self._overviews = overviews
+        return self._overviews
+
+    def _get_frame(self, key) -> Image.Image:
+        """取出已解码的页或概览（调用方持有锁），缺失时解码或由上一级缩小一半"""
+        frame = self._frames.get(key)
+        if frame is not None:
+            self._frames.move_to_end(key)
+            return frame
+        if isinstance(key, tuple):
+            frame = self._get_frame(key[1]).reduce(2)
+        else:
+            with Image.open(self.source_path) as img:
+                if key:
+                    img.seek(key)
+                frame = img.convert("RGBA")
+        self._frames[key] = frame
+        self._frame_bytes += frame.width * frame.height * 4
+        while self._frame_bytes > self.cache_bytes and len(self._frames) > 1:
+            _, evicted = self._frames.popitem(last=False)
+            self._frame_bytes -= evicted.width * evicted.height * 4
+        return frame
+
+    def _pick_frame(self, level_width: int, level_height: int):
+        """选择不小于目标尺寸的最小页或概览，返回其键"""
+        best_key, best_width = 0, None
+        for key, frame_width, frame_height in self._list_overviews():
+            if frame_width >= level_width and frame_height >= level_height \
+                    and (best_width is None or frame_width < best_width):
+                best_key, best_width = key, frame_width
+        return best_key
+
+    def _render(self, z: int, x: int, y: int) -> Optional[bytes]:
+        level_width, level_height = self.level_size(z)
+        if level_width == 0 or level_height == 0:
+            return None
+        frame = self._get_frame(self._pick_frame(level_width, level_height))
+        left, top = x * TILE_SIZE, y * TILE_SIZE
+        right, bottom = min(left + TILE_SIZE, level_width), min(top + TILE_SIZE, level_height)
+        if frame.size == (level_width, level_height):
+            region = frame.crop((left, top, right, bottom))
+        else:
+            scale_x, scale_y = frame.width / level_width, frame.height / level_height
+            region = frame.resize((right - left, bottom - top), Image.Resampling.LANCZOS,
+                                  box=(left * scale_x, top * scale_y, right * scale_x, bottom * scale_y))
+        if region.size != (TILE_SIZE, TILE_SIZE):
+            # 超出图像范围的部分为透明
+            tile_img = Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+            tile_img.paste(region, (0, 0))
+            region = tile_img
+        return encode_tile(region, self.tile_format)
+
+    def fill_levels(self):
+        # 由高到低补全：每一级的概览都由刚用过的上一级缩小得到，整个补全过程只需解码一次原图
+        return range(self.max_zoom, -1, -1)
+
+    def release(self):
+        """释放缓存的源图和概览"""
+        with self._lock:
+            self._frames.clear()
+            self._frame_bytes = 0
+
+
+class PyramidTileRenderer(_TileRendererBase):
+    """
+    导入的现成瓦片金字塔缺少某些级别时，由下一级的 4 个子瓦片合成缺失瓦片
+    最高级别的瓦片必须已经存在；后台补全从高级别向低级别进行，每个瓦片只需读取 4 个小文件。
+    """
+
+    def _read_or_render(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """读取子瓦片，缺失时递归合成并持久化（调用方持有锁）"""
+        if not self._in_range(z, x, y):
+            return None
+        tile_path = self.tile_path(z, x, y)
+        try:
+            with open(tile_path, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+        data = self._render(z, x, y)
+        if data is not None:
+            self._persist(tile_path, data)
+        return data
+
+    def _render(self, z: int, x: int, y: int) -> Optional[bytes]:
+        if z >= self.max_zoom:
+            return None
+        canvas = Image.new('RGBA', (TILE_SIZE * 2, TILE_SIZE * 2), (0, 0, 0, 0))
+        for dx in (0, 1):
+            for dy in (0, 1):
+                child = self._read_or_render(z + 1, x * 2 + dx, y * 2 + dy)
+                if child is None:
+                    continue
+                with Image.open(io.BytesIO(child)) as child_img:
+                    canvas.paste(child_img.convert('RGBA'), (dx * TILE_SIZE, dy * TILE_SIZE))
+        tile_img = canvas.resize((TILE_SIZE, TILE_SIZE), Image.Resampling.LANCZOS)
+        return encode_tile(tile_img, self.tile_format)
+
+    def fill_levels(self):
+        # 由高到低补全，合成每个瓦片时子瓦片都已在磁盘上
+        return range(self.max_zoom - 1, -1, -1)
+
+
+def get_overview_frames(path: str) -> Optional[List[Tuple[int, int, int]]]:
+    """
+    返回多页 TIFF 中主图和各内部概览页的 (页号, 宽, 高)，不是带概览的图像时返回 None
+    只统计与主图宽高比一致且尺寸逐页减小的页，忽略掩膜等其他子图。
+    """
+    try:
+        with Image.open(path) as img:
+            frame_count = getattr(img, 'n_frames', 1)
+            if frame_count < 2:
+                return None
+            width, height = img.size
+            frames = [(0, width, height)]
+            for index in range(1, frame_count):
+                img.seek(index)
+                frame_width, frame_height = img.size
+                if img.mode == '1' or frame_width >= frames[-1][1] or frame_height == 0:
+                    continue
+                if abs(frame_width / frame_height - width / height) > 0.02 * width / height:
+                    continue
+                frames.append((index, frame_width, frame_height))
+    except (OSError, EOFError, ValueError):
+        return None
+    return frames if len(frames) > 1 else None
+
+
+def create_renderer(tiles_dir: str, map_entry: Dict[str, Any]) -> _TileRendererBase:
+    """按地图配置选择渲染器: 有源图副本时从源图渲染，否则由子瓦片合成"""
+    if map_entry.get("source"):
+        return LazyTileRenderer(tiles_dir, map_entry)
+    return PyramidTileRenderer(tiles_dir, map_entry)
+
+
+class LazyTileManager:
+    """
+    管理所有按需渲染的地图
+    由本地服务器的瓦片存取层调用；每张地图有一个后台补全线程（fill_in_background 为 False 时不补全）。
+    """
+
+    def __init__(self, tiles_dir: str, map_config_file: str, fill_in_background: bool = True):
+        self.tiles_dir = tiles_dir
+        # 多进程托管时只有主进程补全瓦片、更新 maps.json 和删除源图，工作进程只按请求渲染
+        self.fill_in_background = fill_in_background
+        self.registry = get_map_registry(map_config_file)
+        self._renderers: Dict[str, _TileRendererBase] = {}
+        self._fillers: Dict[str, threading.Thread] = {}
+        self._stop_events: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self.registry.subscribe(self._on_registry_changed)
+
+    def _on_registry_changed(self, action: str, map_name: str, entry: Optional[Dict[str, Any]]):
+        """地图被删除、重新导入或补全完成后，丢弃旧的渲染器"""
+        if action in ('updated', 'removed'):
+            self.discard(map_name)
+
+    def get_renderer(self, map_name: str) -> Optional[_TileRendererBase]:
+        with self._lock:
+            renderer = self._renderers.get(map_name)
+            if renderer is not None:
+                return renderer
+            entry = self.registry.get(map_name)
+            if entry is None or not entry.get("lazy"):
+                return None
+            renderer = create_renderer(self.tiles_dir, entry)
+            self._renderers[map_name] = renderer
+        if self.fill_in_background:
+            self.start_fill(map_name)
+        return renderer
+
+    def render_tile(self, map_name: str, z: int, x: int, y: int, ext: str) -> Optional[bytes]:
+        """为瓦片请求渲染缺失的瓦片，地图不是按需渲染时返回 None"""
+        renderer = self.get_renderer(map_name)
+        if renderer is None or ext != renderer.tile_ext:
+            return None
+        try:
+            return renderer.render_tile(z, x, y)
+        except Exception as e:
+            print(f"按需渲染瓦片失败 {map_name}/{z}/{x}/{y}: {e}")
+            return None
+
+    def start_pending_fills(self):
+        """为所有尚未补全的按需地图启动后台线程（服务器启动或导入完成后调用）"""
+        for entry in self.registry.entries():
+            if entry.get("lazy"):
+                self.get_renderer(entry["name"])
+
+    def start_fill(self, map_name: str):
+        if not self.fill_in_background:
+            return
+        with self._lock:
+            filler = self._fillers.get(map_name)
+            if filler is not None and filler.is_alive():
+                return
+            renderer = self._renderers.get(map_name)
+            if renderer is None:
+                return
+            stop_event = threading.Event()
+            filler = threading.Thread(target=self._fill_worker, args=(renderer, stop_event),
+                                      name=f"LazyTileFill-{map_name}", daemon=True)
+            self._fillers[map_name] = filler
+            self._stop_events[map_name] = stop_event
+        filler.start()
+
+    def _fill_worker(self, renderer: _TileRendererBase, stop_event: threading.Event):
+        """后台补全：前台有请求时让路，每个瓦片之间短暂休眠"""
+        print(f"开始后台补全瓦片: {renderer.map_name}")
+        try:
+            for z, x, y in renderer.iter_missing_tiles():
+                while time.monotonic() - renderer.last_request_time < FOREGROUND_IDLE_SECONDS:
+                    if stop_event.wait(FOREGROUND_IDLE_SECONDS):
+                        return
+                if stop_event.is_set():
+                    return
+                renderer.render_tile(z, x, y, foreground=False)
+                stop_event.wait(FILL_INTERVAL_SECONDS)
+        except Exception as e:
+            print(f"后台补全瓦片失败 {renderer.map_name}: {e}")
+            return
+
+        self._mark_complete(renderer)
+        print(f"后台补全完成: {renderer.map_name}")
+
+    def _mark_complete(self, renderer: _TileRendererBase):
+        """所有瓦片已生成：去掉 lazy 标记并删除源图副本"""
+        try:
+            if renderer.map_name not in self.registry:
+                return
+            self.registry.update(renderer.map_name, {}, remove_fields=("lazy", "source"))
+        except OSError as e:
+            print(f"更新 maps.json 失败: {e}")
+            return
+
+        # 注册表的更新通知已经丢弃了该渲染器，这里只需释放内存并删除源图
+        renderer.release()
+        if renderer.source_path and os.path.exists(renderer.source_path):
+            os.remove(renderer.source_path)
+
+    def discard(self, map_name: str):
+        """停止地图的后台补全并释放缓存（删除或重新导入地图前调用）"""
+        with self._lock:
+            stop_event = self._stop_events.pop(map_name, None)
+            filler = self._fillers.pop(map_name, None)
+            renderer = self._renderers.pop(map_name, None)
+        if stop_event:
+            stop_event.set()
+        if filler and filler is not threading.current_thread():
+            filler.join(timeout=2)
+        if renderer:
+            renderer.release()
+
+    def stop_all(self):
+        for map_name in list(self._renderers):
+            self.discard(map_name)
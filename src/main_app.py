@@ -1,22 +1,26 @@
 import sys
 import os
 import numpy as np
+import re
 import json
-import threading
 import time
+import threading
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime
-from werkzeug.serving import make_server
 from PySide6.QtCore import QUrl, Slot, QTimer, Qt, QObject, Signal, QThread, QDateTime
 from PySide6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QWidget, 
                                QPushButton, QLabel, QRadioButton, QButtonGroup, QTextEdit,
                                QLineEdit, QDialog, QTableWidget, QTableWidgetItem, 
                                QGridLayout, QGroupBox, QHeaderView, QMessageBox, QComboBox,
-                               QFileDialog, QProgressDialog, QSpinBox, QCheckBox, QSlider)
+                               QFileDialog, QProgressDialog, QSpinBox, QCheckBox, QSlider,
+                               QInputDialog, QProgressBar)
 from PySide6.QtWebEngineWidgets import QWebEngineView
 from PySide6.QtWebEngineCore import QWebEnginePage, QWebEngineProfile
 from PySide6.QtWebChannel import QWebChannel
 
+from calibration_models import (MODEL_AFFINE, MODEL_HOMOGRAPHY, MODEL_POLYNOMIAL, MODEL_PIECEWISE,
+                                fit_calibration, get_model_class, model_from_dict)
+
 # 多语言管理器导入
 try:
     from language_manager import get_language_manager, tr
@@ -448,47 +452,17 @@ class DisclaimerDialog(QDialog):
         layout.addLayout(button_layout)
 
 # --- 服务器管理模块 ---
-class ServerThread(threading.Thread):
-    """一个可以被停止的服务器线程"""
-    def __init__(self, server):
-        super().__init__()
-        self.server = server
-        self.daemon = True
-        self._stop_requested = False
-
-    def run(self):
-        try:
-            self.server.serve_forever()
-        except Exception as e:
-            if not self._stop_requested:
-                print(f"Server thread exception: {e}")
-
-    def stop(self):
-        """请求停止服务器"""
-        self._stop_requested = True
-        try:
-            self.server.shutdown()
-            self.server.server_close()
-        except Exception as e:
-            print(f"Error stopping server: {e}")
-    
-    def force_stop(self):
-        """强制停止线程"""
-        self._stop_requested = True
-        try:
-            self.server.shutdown()
-            self.server.server_close()
-        except Exception:
-            pass
-
 class LocalServerManager:
-    """在后台线程中启动和管理本地服务器"""
-    def __init__(self):
-        self.flask_server_thread = None
-        self.http_server_thread = None
-        self.flask_app = None
-        self.sock = None
+    """托管本地同步服务器和文件服务器（hosting.ServerHost，在后台事件循环和可选的工作进程中运行）"""
+    def __init__(self, hosting_config=None):
+        self.server_host = None
+        self.hosting_config = hosting_config  # 为 None 时从 app_settings.json 读取
+        self.command_channel = None  # 同步服务器持有的指令队列，界面线程只做入队
         self._is_shutting_down = False  # 添加关闭标志
+        self.tile_store = None  # 瓦片读取层（归档内存映射 + LRU 缓存）
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        from map_registry import get_map_registry
+        self.map_registry = get_map_registry(os.path.join(script_dir, 'maps.json'))
 
     def start_servers(self):
         if self.is_running():
@@ -503,39 +477,27 @@ class LocalServerManager:
             if script_dir not in sys.path:
                 sys.path.insert(0, script_dir)
             
-            # 启动 Flask + WebSocket 服务器
-            from server import app as flask_app, sock
-            self.flask_app = flask_app
-            self.sock = sock
-            
-            # 使用 werkzeug 创建服务器，因为它有 shutdown 方法
-            flask_server = make_server('127.0.0.1', 8080, self.flask_app)
-            self.flask_server_thread = ServerThread(flask_server)
-            self.flask_server_thread.start()
-            print("Flask + WebSocket backend server started in thread (http://127.0.0.1:8080)")
-
-            # 启动简单HTTP文件服务器
-            import os
-            from http.server import SimpleHTTPRequestHandler
-            from socketserver import ThreadingTCPServer
+            from hosting import ServerHost, load_hosting_config
+            from server import hub as sync_hub
+            from tile_store import TileStore
+            from lazy_tiles import LazyTileManager
             
-            # 获取脚本所在目录作为文件服务器的根目录
-            script_dir = os.path.dirname(os.path.abspath(__file__))
+            config = self.hosting_config or load_hosting_config(os.path.join(script_dir, 'app_settings.json'),
+                                                                root_dir=script_dir)
+            if self.tile_store is None:
+                tiles_dir = os.path.join(config.root_dir, 'tiles')
+                lazy_tiles = LazyTileManager(tiles_dir, os.path.join(config.root_dir, 'maps.json'))
+                self.tile_store = TileStore(tiles_dir, lazy_tiles=lazy_tiles)
             
-            # 确保在正确的目录中启动文件服务器
-            class LocalFileHandler(SimpleHTTPRequestHandler):
-                def __init__(self, *args, **kwargs):
-                    super().__init__(*args, directory=script_dir, **kwargs)
-                
-                def log_message(self, format, *args):
-                    pass  # 禁用日志输出
+            # 页面、瓦片和 WebSocket 同步在同一个端口和事件循环中，端口被占用时 start() 直接抛出异常
+            self.command_channel = sync_hub.commands
+            self.server_host = ServerHost(config, sync_hub, self.tile_store)
+            self.server_host.start()
+            print(f"Local server started (http://localhost:{config.port}, ws://localhost:{config.port}/ws), "
+                  f"workers: {config.workers}, threads: {config.threads}")
             
-            # 使用ThreadingTCPServer而不是TCPServer，支持并发且更易停止
-            http_server = ThreadingTCPServer(("", 8000), LocalFileHandler)
-            http_server.daemon_threads = True  # 设置为守护线程，程序退出时自动结束
-            self.http_server_thread = ServerThread(http_server)
-            self.http_server_thread.start()
-            print("Local file server started in thread (http://localhost:8000)")
+            # 继续补全上次未完成的按需渲染地图
+            self.start_lazy_tile_fill()
             
             return True
         except Exception as e:
@@ -544,173 +506,289 @@ class LocalServerManager:
             return False
 
     def stop_servers(self):
-        """安全停止所有服务器"""
+        """平稳停止所有服务器：不再接受新连接，等待进行中的请求完成后关闭"""
         if self._is_shutting_down:
             return  # 防止重复调用
             
         self._is_shutting_down = True
-        
-        # 使用多线程方式异步停止服务器，避免阻塞主线程
-        import threading
-        
-        def stop_flask_server():
-            if self.flask_server_thread and self.flask_server_thread.is_alive():
-                print("Stopping Flask server...")
-                try:
-                    self.flask_server_thread.stop()
-                    if not self.flask_server_thread.join(timeout=0.5):
-                        print("Flask server timeout, force termination")
-                    print("Flask server stopped")
-                except Exception as e:
-                    print(f"Error stopping Flask server: {e}")
-                finally:
-                    self.flask_server_thread = None
-        
-        def stop_http_server():
-            if self.http_server_thread and self.http_server_thread.is_alive():
-                print("Stopping file server...")
-                try:
-                    self.http_server_thread.stop()
-                    if not self.http_server_thread.join(timeout=0.5):
-                        print("File server timeout, force termination")
-                    print("File server stopped")
-                except Exception as e:
-                    print(f"Error stopping file server: {e}")
-                finally:
-                    self.http_server_thread = None
-        
-        # 并行停止两个服务器
-        flask_stopper = threading.Thread(target=stop_flask_server, daemon=True)
-        http_stopper = threading.Thread(target=stop_http_server, daemon=True)
-        
-        flask_stopper.start()
-        http_stopper.start()
-        
-        # 等待停止完成，但设置总超时时间
-        flask_stopper.join(timeout=1)
-        http_stopper.join(timeout=1)
-        
-        # 强制清理
-        if flask_stopper.is_alive():
-            print("Flask stop thread timeout, force cleanup")
-            self.flask_server_thread = None
-            
-        if http_stopper.is_alive():
-            print("HTTP stop thread timeout, force cleanup") 
-            self.http_server_thread = None
-                
-        self._is_shutting_down = False
+        try:
+            if self.server_host is not None:
+                print("Stopping servers...")
+                self.server_host.stop()
+        except Exception as e:
+            print(f"Error stopping servers: {e}")
+        finally:
+            self.server_host = None
+            # 释放归档文件句柄和瓦片缓存；下次启动时重新创建，不复用已关闭的存取层
+            if self.tile_store:
+                self.tile_store.close()
+                self.tile_store = None
+            self._is_shutting_down = False
         print("All servers stopped")
             
     def is_running(self):
         """检查服务器是否正在运行"""
         try:
-            return (not self._is_shutting_down and 
-                    self.flask_server_thread is not None and 
-                    self.flask_server_thread.is_alive())
+            return (not self._is_shutting_down and
+                    self.server_host is not None and
+                    self.server_host.is_running())
         except Exception:
             return False
 
+    def invalidate_tiles(self, map_name):
+        """地图被删除或重新生成前调用：释放归档句柄并清除所有工作进程中的瓦片缓存"""
+        if self.server_host is not None:
+            self.server_host.invalidate(map_name)
+        elif self.tile_store:
+            self.tile_store.invalidate(map_name)
+
+    def start_lazy_tile_fill(self):
+        """为 maps.json 中尚未补全的按需渲染地图启动后台补全线程"""
+        if self.tile_store and self.tile_store.lazy_tiles:
+            self.tile_store.lazy_tiles.start_pending_fills()
+
     def get_local_maps(self):
-        """从 maps.json 读取本地地图列表"""
-        try:
-            import os
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            maps_json_path = os.path.join(script_dir, 'maps.json')
-            with open(maps_json_path, 'r', encoding='utf-8') as f:
-                return [item['name'] for item in json.load(f)]
-        except (FileNotFoundError, json.JSONDecodeError):
-            return []
+        """从地图注册表读取本地地图列表（maps.json 未变化时不重新解析）"""
+        return self.map_registry.names()
 
     def broadcast_command(self, command):
-        """通过 WebSocket 向本地地图客户端广播指令"""
-        if not self.is_running():
+        """通过 WebSocket 向本地地图客户端广播指令（只放入服务器的指令队列，立即返回）"""
+        channel = self.command_channel
+        if channel is None or not self.is_running():
             print("Error: Server not running, cannot broadcast command.")
             return False
-            
-        try:
-            import os
-            import sys
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            if script_dir not in sys.path:
-                sys.path.insert(0, script_dir)
-                
-            from server import broadcast
-            broadcast(command)
-            print(f"Broadcasted command: {command}")
-            return True
-        except Exception as e:
-            print(f"Failed to broadcast command: {e}")
+        if not channel.submit(command):
+            print("Error: Sync server event loop not ready.")
             return False
+        return True
 
 # --- 地图生成工作线程 ---
+# 导入任务状态 -> (翻译键, 默认文本)，显示时再翻译，切换语言后新的状态使用新语言
+IMPORT_STATUS_NAMES = {
+    'pending': ('import_status_pending', '等待中'),
+    'running': ('import_status_running', '处理中'),
+    'done': ('import_status_done', '完成'),
+    'failed': ('import_status_failed', '失败'),
+    'cancelled': ('import_status_cancelled', '已取消'),
+}
+
 class MapGeneratorWorker(QThread):
-    """地图生成工作线程，防止UI卡死"""
-    progress_updated = Signal(int)  # 进度更新信号
-    status_updated = Signal(str)    # 状态更新信号
+    """地图导入工作线程：把所有文件提交到导入队列并汇总各任务的进度，防止UI卡死"""
+    progress_updated = Signal(int)  # 总进度信号
+    job_updated = Signal(int, str, str, int)  # 单个任务 (任务ID, 地图名, 状态, 进度百分比)
     finished = Signal(bool, str)    # 完成信号 (成功/失败, 消息)
     
-    def __init__(self, image_paths):
+    def __init__(self, image_paths, tile_format='png', tile_storage='directory', max_workers=None):
         super().__init__()
         self.image_paths = image_paths
+        self.tile_format = tile_format
+        self.tile_storage = tile_storage
+        self.max_workers = max_workers
+        self.queue = None
+        self._cancel_requested = False
         
     def run(self):
-        """在后台线程中执行地图生成"""
+        """在后台线程中提交导入任务并等待全部结束"""
         try:
             import os
-            # 切换到正确的工作目录
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            original_cwd = os.getcwd()
-            os.chdir(script_dir)
+            try:
+                from import_queue import ImportQueue, JOB_DONE, JOB_FAILED, JOB_CANCELLED
+            except ImportError:
+                self.finished.emit(False, tr('tile_generator_missing', 'tile_generator模块不存在，只能处理直接复制到maps目录的地图文件'))
+                return
             
+            # 输出直接写入脚本目录，不再切换进程的工作目录
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            self.queue = ImportQueue(script_dir, self.max_workers, on_update=self._on_job_update)
             try:
-                # 检查是否存在tile_generator模块
-                try:
-                    from tile_generator import process_image, get_image_info
-                except ImportError:
-                    # 如果没有tile_generator模块，则只处理直接复制的情况
-                    self.error_occurred.emit(tr('tile_generator_missing', 'tile_generator模块不存在，只能处理直接复制到maps目录的地图文件'))
-                    return
-                
-                total_files = len(self.image_paths)
-                
-                for i, image_path in enumerate(self.image_paths):
-                    self.status_updated.emit(tr('processing_file', '正在处理: {filename}', filename=os.path.basename(image_path)))
-                    
-                    # 检查文件信息
-                    file_size_mb, width, height = get_image_info(image_path)
-                    if not file_size_mb:
-                        continue
-                        
-                    # 处理图片
-                    map_name = os.path.splitext(os.path.basename(image_path))[0]
+                for image_path in self.image_paths:
                     try:
-                        process_image(image_path)
-                    except Exception as e:
-                        self.finished.emit(False, tr('processing_failed', '处理 {map_name} 失败: {error}', map_name=map_name, error=str(e)))
-                        return
-                        
-                    # 更新进度
-                    progress = int((i + 1) / total_files * 100)
-                    self.progress_updated.emit(progress)
-                    
-                self.finished.emit(True, tr('processing_complete', '成功处理了 {count} 个地图文件', count=total_files))
-                
+                        self.queue.submit(image_path, self.tile_format, self.tile_storage)
+                    except ValueError as e:
+                        print(e)
+                if self._cancel_requested:
+                    self.queue.cancel_all()
+                self.queue.wait()
             finally:
-                # 恢复原来的工作目录
-                os.chdir(original_cwd)
+                self.queue.shutdown()
+            
+            jobs = self.queue.jobs()
+            done = [job for job in jobs if job.status == JOB_DONE]
+            failed = [job for job in jobs if job.status == JOB_FAILED]
+            cancelled = [job for job in jobs if job.status == JOB_CANCELLED]
+            
+            lines = [tr('processing_complete', '成功处理了 {count} 个地图文件', count=len(done))]
+            for job in failed:
+                lines.append(tr('processing_failed', '处理 {map_name} 失败: {error}', map_name=job.map_name, error=job.error))
+            if cancelled:
+                lines.append(tr('processing_cancelled', '已取消: {maps}', maps=', '.join(job.map_name for job in cancelled)))
+            self.finished.emit(not failed, '\n'.join(lines))
             
         except Exception as e:
             self.finished.emit(False, tr('processing_error', '处理过程中出现错误: {error}', error=str(e)))
+    
+    def _on_job_update(self, job):
+        """导入队列的回调（在导入线程中调用），转换为Qt信号"""
+        jobs = self.queue.jobs() if self.queue else [job]
+        percent = int(job.progress * 100)
+        self.job_updated.emit(job.job_id, job.map_name, job.status, percent)
+        self.progress_updated.emit(int(sum(j.progress for j in jobs) / len(jobs) * 100))
+    
+    def cancel(self):
+        """取消所有任务，正在生成的瓦片完成后即停止"""
+        self._cancel_requested = True
+        if self.queue:
+            self.queue.cancel_all()
+    
+    def cancel_job(self, job_id):
+        """取消单个任务"""
+        return self.queue.cancel(job_id) if self.queue else False
+
+class ImportProgressDialog(QDialog):
+    """导入进度对话框：每个任务一行（状态、进度条、单独取消），底部为总进度和全部取消"""
+    cancel_job_requested = Signal(int)
+    cancel_all_requested = Signal()
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(tr('import_dialog_title', '生成地图'))
+        self.setModal(True)
+        self.resize(560, 300)
+        self._rows = {}  # 任务ID -> 行号
+        self._closing = False
+        
+        layout = QVBoxLayout(self)
+        self.job_table = QTableWidget(0, 4)
+        self.job_table.setHorizontalHeaderLabels([tr('map', '地图'), tr('status', '状态'),
+                                                  tr('import_progress', '进度'), ""])
+        self.job_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        self.job_table.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeMode.Stretch)
+        self.job_table.verticalHeader().setVisible(False)
+        self.job_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        layout.addWidget(self.job_table)
+        
+        self.total_bar = QProgressBar()
+        self.total_bar.setRange(0, 100)
+        layout.addWidget(self.total_bar)
+        
+        button_layout = QHBoxLayout()
+        button_layout.addStretch()
+        self.cancel_all_btn = QPushButton(tr('import_cancel_all', '全部取消'))
+        self.cancel_all_btn.clicked.connect(self.reject)
+        button_layout.addWidget(self.cancel_all_btn)
+        layout.addLayout(button_layout)
+    
+    @Slot(int, str, str, int)
+    def update_job(self, job_id, map_name, status, percent):
+        """更新（或新增）一个任务所在的行"""
+        row = self._rows.get(job_id)
+        if row is None:
+            row = self.job_table.rowCount()
+            self._rows[job_id] = row
+            self.job_table.insertRow(row)
+            self.job_table.setItem(row, 0, QTableWidgetItem(map_name))
+            self.job_table.setItem(row, 1, QTableWidgetItem())
+            bar = QProgressBar()
+            bar.setRange(0, 100)
+            self.job_table.setCellWidget(row, 2, bar)
+            cancel_btn = QPushButton(tr('cancel', '取消'))
+            cancel_btn.clicked.connect(lambda: self.cancel_job_requested.emit(job_id))
+            self.job_table.setCellWidget(row, 3, cancel_btn)
+        key, default = IMPORT_STATUS_NAMES.get(status, (status, status))
+        self.job_table.item(row, 1).setText(tr(key, default))
+        self.job_table.cellWidget(row, 2).setValue(percent)
+        # 已结束的任务不能再取消
+        self.job_table.cellWidget(row, 3).setEnabled(status in ('pending', 'running'))
+    
+    def reject(self):
+        """Esc、关闭按钮和“全部取消”：请求取消所有任务，等任务结束后由 finish() 关闭"""
+        if self._closing:
+            super().reject()
+            return
+        self.cancel_all_btn.setEnabled(False)
+        self.cancel_all_btn.setText(tr('import_cancelling', '正在取消...'))
+        self.cancel_all_requested.emit()
+    
+    def finish(self):
+        """所有任务结束后关闭对话框"""
+        self._closing = True
+        self.close()
+
+# --- 自动校准工作线程 ---
+class AutoCalibrationWorker(QThread):
+    """在后台载入（或首次提取）地图特征并逐张定位截图，防止UI卡死"""
+    progress_updated = Signal(str, int)  # (阶段, 进度百分比)
+    point_found = Signal(float, float, float, float, int)  # (游戏X, 游戏Y, 纬度, 经度, 内点数)
+    finished = Signal(bool, str)  # (是否有截图定位成功, 消息)
+    
+    def __init__(self, map_name, samples, tile_store=None):
+        super().__init__()
+        self.map_name = map_name
+        self.samples = samples  # [(截图路径, 游戏X, 游戏Y), ...]
+        self.tile_store = tile_store
+        self.cancel_event = threading.Event()
+    
+    def run(self):
+        try:
+            from auto_calibration import MapFeatureIndex, AutoCalibrator, read_gray
+        except ImportError as e:
+            self.finished.emit(False, tr('auto_calibration_unavailable', '自动校准不可用（需要 OpenCV）: {error}', error=str(e)))
+            return
+        try:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            index = MapFeatureIndex(self.map_name, script_dir, tile_store=self.tile_store)
+            index.build(lambda stage, fraction: self.progress_updated.emit(stage, int(fraction * 100)),
+                        self.cancel_event)
+            calibrator = AutoCalibrator(index)
+            failed = []
+            for i, (path, x, y) in enumerate(self.samples):
+                if self.cancel_event.is_set():
+                    break
+                self.progress_updated.emit(tr('auto_calibration_locating', '正在定位截图 {index}/{count}',
+                                              index=i + 1, count=len(self.samples)),
+                                           int(i * 100 / len(self.samples)))
+                image = read_gray(path)
+                result = calibrator.add_sample(image, x, y) if image is not None else None
+                if result is None:
+                    failed.append(os.path.basename(path))
+                    continue
+                _, _, lat, lng, _ = calibrator.samples[-1]
+                self.point_found.emit(x, y, lat, lng, result.inliers)
+            message = tr('auto_calibration_result', '成功定位 {found} 张截图', found=len(calibrator.samples))
+            if failed:
+                message += '\n' + tr('auto_calibration_failed', '无法定位: {files}', files=', '.join(failed))
+            self.finished.emit(bool(calibrator.samples), message)
+        except InterruptedError:
+            self.finished.emit(False, tr('auto_calibration_cancelled', '已取消自动校准'))
+        except Exception as e:
+            self.finished.emit(False, tr('auto_calibration_error', '自动校准出错: {error}', error=str(e)))
+    
+    def cancel(self):
+        self.cancel_event.set()
 
 # --- 校准数据管理类 ---
 class CalibrationDataManager:
-    """管理校准矩阵数据的持久化存储"""
+    """
+    管理校准矩阵数据的持久化存储
+    - calibration_data.json 只在第一次使用和文件 (mtime, size) 变化时读取，其余时候直接使用内存中的数据
+    - 读取过的校准按键缓存为可直接使用的 TransformMatrix（非仿射模型也已重建），重复加载不再解析
+    - 保存和删除立即更新内存，由后台线程写临时文件后原子替换，连续修改合并为一次写入
+    - version 在校准数据每次变化（本进程修改或重新读取文件）后递增
+    """
     
-    def __init__(self):
-        import os
+    def __init__(self, calibration_file=None):
         script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.calibration_file = os.path.join(script_dir, "calibration_data.json")
+        self.calibration_file = calibration_file or os.path.join(script_dir, "calibration_data.json")
+        self.version = 0
+        self.write_errors = 0
+        self._lock = threading.RLock()
+        self._data = None
+        self._signature = None
+        self._matrices = {}
+        # 等待写入的数据快照，以及正在写入的线程
+        self._pending = None
+        self._writer = None
+        self._written = threading.Condition(self._lock)
         
     def get_map_key(self, mode, provider_or_map_name, area_id=None):
         """生成地图的唯一标识键"""
@@ -719,41 +797,128 @@ class CalibrationDataManager:
         else:
             return f"local_{provider_or_map_name}"
     
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.calibration_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    def _ensure_loaded(self):
+        """返回内存中的校准数据，文件被其他程序修改过时重新读取（调用方持有锁）"""
+        signature = self._file_signature()
+        if self._data is not None and (signature == self._signature or self._pending is not None):
+            return self._data
+        data = {}
+        if signature is not None:
+            try:
+                with open(self.calibration_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if not isinstance(data, dict):
+                    data = {}
+            except (OSError, ValueError) as e:
+                print(f"Failed to read calibration data: {e}")
+                data = {}
+        self._data = data
+        self._signature = signature
+        self._matrices.clear()
+        self.version += 1
+        return data
+    
+    @staticmethod
+    def _build_matrix(calibration_data):
+        """把一条校准记录转换为 TransformMatrix"""
+        matrix_data = calibration_data["matrix"]
+        model = None
+        if calibration_data.get("model"):
+            try:
+                model = model_from_dict(calibration_data["model"])
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Failed to load calibration model, using affine matrix: {e}")
+        return TransformMatrix(
+            matrix_data["a"], matrix_data["b"], matrix_data["c"],
+            matrix_data["d"], matrix_data["e"], matrix_data["f"],
+            model=model
+        )
+    
+    def _update(self, map_key, calibration_data):
+        """修改内存中的一条记录并安排写入（调用方持有锁）；calibration_data 为 None 时删除"""
+        data = dict(self._ensure_loaded())
+        if calibration_data is None:
+            data.pop(map_key, None)
+        else:
+            data[map_key] = calibration_data
+        self._data = data
+        self._matrices.pop(map_key, None)
+        self.version += 1
+        self._pending = data
+        if self._writer is None or not self._writer.is_alive():
+            # 非守护线程：程序退出前会写完最后一份数据
+            self._writer = threading.Thread(target=self._write_loop, name="CalibrationWriter")
+            self._writer.start()
+    
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                data = self._pending
+                if data is None:
+                    self._writer = None
+                    self._written.notify_all()
+                    return
+            tmp_path = self.calibration_file + '.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=2, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.calibration_file)
+            except OSError as e:
+                with self._lock:
+                    self.write_errors += 1
+                print(f"❌ Failed to write calibration data: {e}")
+            with self._lock:
+                # 写入期间又有新的修改时继续写最新的数据
+                if self._pending is data:
+                    self._pending = None
+                    self._signature = self._file_signature()
+    
+    def flush(self, timeout=5.0):
+        """等待后台写入完成，返回是否已全部写入"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._pending is not None or self._writer is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._written.wait(remaining)
+        return True
+    
     def save_calibration(self, mode, provider_or_map_name, transform_matrix, area_id=None):
-        """保存校准数据"""
+        """保存校准数据（内存立即更新，文件由后台线程写入）"""
         try:
-            print(f"[DEBUG] Starting to save calibration data: mode={mode}, provider={provider_or_map_name}, area_id={area_id}")
-            
-            # 读取现有数据
-            data = self.load_all_calibrations()
-            print(f"[DEBUG] Current calibration data count: {len(data)}")
-            
-            # 生成地图键
             map_key = self.get_map_key(mode, provider_or_map_name, area_id)
-            print(f"[DEBUG] Generated map key: {map_key}")
-            
-            # 保存校准数据
             calibration_data = {
                 "mode": mode,
                 "provider_or_map_name": provider_or_map_name,
                 "area_id": area_id,
                 "matrix": {
-                    "a": transform_matrix.a,
-                    "b": transform_matrix.b,
-                    "c": transform_matrix.c,
-                    "d": transform_matrix.d,
-                    "e": transform_matrix.e,
-                    "f": transform_matrix.f
+                    "a": float(transform_matrix.a),
+                    "b": float(transform_matrix.b),
+                    "c": float(transform_matrix.c),
+                    "d": float(transform_matrix.d),
+                    "e": float(transform_matrix.e),
+                    "f": float(transform_matrix.f)
                 },
                 "timestamp": datetime.now().isoformat()
             }
-            
-            data[map_key] = calibration_data
-            print(f"[DEBUG] Calibration data added to memory, now has {len(data)} entries")
-            
-            # 写入文件
-            with open(self.calibration_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            # 非仿射模型另存完整参数，matrix 中保留仿射近似供旧版本读取
+            if getattr(transform_matrix, 'model', None) is not None:
+                calibration_data["model"] = transform_matrix.model.to_dict()
+            
+            with self._lock:
+                self._update(map_key, calibration_data)
+                if isinstance(transform_matrix, TransformMatrix):
+                    self._matrices[map_key] = transform_matrix
                 
             print(f"✅ Calibration data saved: {map_key}")
             return True
@@ -765,59 +930,43 @@ class CalibrationDataManager:
             return False
     
     def load_calibration(self, mode, provider_or_map_name, area_id=None):
-        """加载特定地图的校准数据"""
+        """加载特定地图的校准数据，返回缓存的 TransformMatrix"""
+        map_key = self.get_map_key(mode, provider_or_map_name, area_id)
         try:
-            data = self.load_all_calibrations()
-            map_key = self.get_map_key(mode, provider_or_map_name, area_id)
-            
-            if map_key in data:
-                calibration_data = data[map_key]
-                matrix_data = calibration_data["matrix"]
-                
-                # 重建变换矩阵
-                transform_matrix = TransformMatrix(
-                    matrix_data["a"], matrix_data["b"], matrix_data["c"],
-                    matrix_data["d"], matrix_data["e"], matrix_data["f"]
-                )
-                
-                print(f"Loaded calibration data: {map_key}")
-                return transform_matrix
-            
-            return None
+            with self._lock:
+                data = self._ensure_loaded()
+                matrix = self._matrices.get(map_key)
+                if matrix is None and map_key in data:
+                    matrix = self._build_matrix(data[map_key])
+                    self._matrices[map_key] = matrix
+                    print(f"Loaded calibration data: {map_key}")
+                return matrix
             
         except Exception as e:
             print(f"Failed to load calibration data: {e}")
             return None
     
     def load_all_calibrations(self):
-        """加载所有校准数据"""
-        try:
-            if os.path.exists(self.calibration_file):
-                with open(self.calibration_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {}
-        except Exception:
-            return {}
+        """加载所有校准数据（返回副本）"""
+        with self._lock:
+            return dict(self._ensure_loaded())
     
     def has_calibration(self, mode, provider_or_map_name, area_id=None):
         """检查是否存在校准数据"""
-        data = self.load_all_calibrations()
         map_key = self.get_map_key(mode, provider_or_map_name, area_id)
-        return map_key in data
+        with self._lock:
+            return map_key in self._ensure_loaded()
     
     def delete_calibration(self, mode, provider_or_map_name, area_id=None):
         """删除校准数据"""
         try:
-            data = self.load_all_calibrations()
             map_key = self.get_map_key(mode, provider_or_map_name, area_id)
-            
-            if map_key in data:
-                del data[map_key]
-                with open(self.calibration_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
-                print(f"Deleted calibration data: {map_key}")
-                return True
-            return False
+            with self._lock:
+                if map_key not in self._ensure_loaded():
+                    return False
+                self._update(map_key, None)
+            print(f"Deleted calibration data: {map_key}")
+            return True
             
         except Exception as e:
             print(f"Failed to delete calibration data: {e}")
@@ -833,54 +982,136 @@ class CalibrationPoint:
         self.lon = lon
 
 class TransformMatrix:
-    """变换矩阵"""
-    def __init__(self, a=0, b=0, c=0, d=0, e=0, f=0):
+    """
+    变换矩阵
+    a-f 为仿射矩阵；使用单应、多项式或分段仿射模型校准时 model 为该模型（见 calibration_models），
+    转换以 model 为准，a-f 保留在同一批内点上拟合的仿射近似。
+    """
+    def __init__(self, a=0, b=0, c=0, d=0, e=0, f=0, model=None):
         self.a = a  # lat = a*x + b*y + c
         self.b = b
         self.c = c
         self.d = d  # lon = d*x + e*y + f
         self.e = e
         self.f = f
+        self.model = model
+        self._array = None
+        self._inverse = None
+    
+    @classmethod
+    def from_fit(cls, fit):
+        """由 fit_calibration() 的结果构造"""
+        model = None if fit.model is fit.affine else fit.model
+        return cls(*fit.affine.matrix[0], *fit.affine.matrix[1], model=model)
+    
+    @property
+    def model_name(self):
+        return self.model.name if self.model is not None else MODEL_AFFINE
+    
+    def as_array(self):
+        """返回 3x3 齐次矩阵: [lat, lon, 1]ᵀ = M · [x, y, 1]ᵀ（只读，构造一次后缓存）"""
+        if self._array is None:
+            array = np.array([[self.a, self.b, self.c],
+                              [self.d, self.e, self.f],
+                              [0.0, 0.0, 1.0]], dtype=np.float64)
+            array.flags.writeable = False
+            self._array = array
+        return self._array
+    
+    def inverse(self):
+        """返回把地理坐标转换回游戏坐标的逆矩阵（计算一次后缓存）"""
+        if self._inverse is not None:
+            return self._inverse
+        try:
+            inv = np.linalg.inv(self.as_array())
+        except np.linalg.LinAlgError:
+            raise ValueError(tr('matrix_not_invertible', '变换矩阵不可逆，无法从地图坐标换算游戏坐标'))
+        model = self.model.inverse() if self.model is not None else None
+        self._inverse = TransformMatrix(*inv[0], *inv[1], model=model)
+        self._inverse._inverse = self
+        return self._inverse
 
 class CalibrationSystem:
     """地图校准系统核心逻辑"""
     
     @staticmethod
-    def calculate_transform_matrix(points):
-        """基于校准点计算仿射变换矩阵"""
-        if len(points) < 2:
-            raise ValueError(tr('calibration_min_points', '至少需要2个校准点'))
-        
-        # 构建线性方程组 Ax = b
-        n = len(points)
-        A = np.zeros((2*n, 6))
-        b = np.zeros(2*n)
-        
-        for i, point in enumerate(points):
-            # lat = a*x + b*y + c
-            A[2*i] = [point.x, point.y, 1, 0, 0, 0]
-            b[2*i] = point.lat
-            
-            # lon = d*x + e*y + f
-            A[2*i+1] = [0, 0, 0, point.x, point.y, 1]
-            b[2*i+1] = point.lon
-        
-        # 使用最小二乘法求解
+    def fit_points(points, model=MODEL_AFFINE, robust=False, threshold=None):
+        """
+        用指定模型拟合校准点，返回 CalibrationFit（模型、每个点的残差和是否被采用）
+        robust 为 True 时先剔除点错的校准点（由校准窗口的"自动剔除离群点"开启，默认使用全部点）；threshold 为离群判定阈值（地图坐标单位），None 时自动估计
+        """
+        min_points = get_model_class(model).min_points
+        if len(points) < min_points:
+            raise ValueError(tr('calibration_model_min_points', '{model} 模型至少需要 {count} 个校准点',
+                                model=model, count=min_points))
+        src = np.array([(point.x, point.y) for point in points], dtype=np.float64)
+        dst = np.array([(point.lat, point.lon) for point in points], dtype=np.float64)
         try:
-            x = np.linalg.lstsq(A, b, rcond=None)[0]
-            return TransformMatrix(x[0], x[1], x[2], x[3], x[4], x[5])
+            return fit_calibration(model, src, dst, robust=robust, threshold=threshold)
         except np.linalg.LinAlgError:
             raise ValueError(tr('transform_matrix_error', '无法计算变换矩阵，请检查校准点数据'))
     
+    @staticmethod
+    def calculate_transform_matrix(points, model=MODEL_AFFINE, robust=False, threshold=None):
+        """基于校准点计算变换矩阵（默认为仿射变换，使用全部校准点；robust 为 True 时剔除离群点）"""
+        if len(points) < 2:
+            raise ValueError(tr('calibration_min_points', '至少需要2个校准点'))
+        fit = CalibrationSystem.fit_points(points, model, robust, threshold)
+        return TransformMatrix.from_fit(fit)
+    
     @staticmethod
     def transform(x, y, matrix):
         """使用变换矩阵将游戏坐标转换为地理坐标"""
         if matrix is None:
             raise ValueError(tr('matrix_not_initialized', '变换矩阵未初始化'))
         
+        if getattr(matrix, 'model', None) is not None:
+            lat, lon = matrix.model.apply(np.array([[x, y]], dtype=np.float64))[0]
+            return float(lat), float(lon)
         lat = matrix.a * x + matrix.b * y + matrix.c
         lon = matrix.d * x + matrix.e * y + matrix.f
         return lat, lon
+    
+    @staticmethod
+    def inverse_transform(lat, lon, matrix):
+        """将地理坐标转换回游戏坐标"""
+        if matrix is None:
+            raise ValueError(tr('matrix_not_initialized', '变换矩阵未初始化'))
+        return CalibrationSystem.transform(lat, lon, matrix.inverse())
+    
+    @staticmethod
+    def transform_points(points, matrix):
+        """
+        批量转换: points 为形如 (N, 2) 的游戏坐标数组 [[x, y], ...]（可以多出 z 列，会被忽略），
+        返回 (N, 2) 的 [[lat, lon], ...]，整批只做一次矩阵乘法
+        """
+        if matrix is None:
+            raise ValueError(tr('matrix_not_initialized', '变换矩阵未初始化'))
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] < 2:
+            raise ValueError(tr('points_shape_error', '坐标数组的形状应为 (N, 2)'))
+        if getattr(matrix, 'model', None) is not None:
+            return matrix.model.apply(points[:, :2])
+        m = matrix.as_array()
+        return points[:, :2] @ m[:2, :2].T + m[:2, 2]
+    
+    @staticmethod
+    def inverse_transform_points(points, matrix):
+        """批量逆转换: (N, 2) 的 [[lat, lon], ...] -> (N, 2) 的游戏坐标 [[x, y], ...]"""
+        if matrix is None:
+            raise ValueError(tr('matrix_not_initialized', '变换矩阵未初始化'))
+        return CalibrationSystem.transform_points(points, matrix.inverse())
+    
+    @staticmethod
+    def transform_arrays(xs, ys, matrix):
+        """批量转换分开存放的坐标数组，返回 (lats, lons)"""
+        result = CalibrationSystem.transform_points(np.column_stack((np.ravel(xs), np.ravel(ys))), matrix)
+        return result[:, 0], result[:, 1]
+    
+    @staticmethod
+    def transform_route(route, matrix):
+        """转换整条录制路线 (RouteData)，返回 (N, 2) 的 [[lat, lon], ...]"""
+        return CalibrationSystem.transform_points(route.to_array()[:, :2], matrix)
 
 
 # --- 后端通信类 ---
@@ -898,7 +1129,10 @@ class MapBackend(QObject):
 class CalibrationWindow(QDialog):
     calibrationFinished = Signal(object)  # 传递变换矩阵
 
-    def __init__(self, parent=None, current_map_provider="官方地图", current_map_url=None):
+    # 截图文件名中的游戏坐标，如 shot_x1234_y-567.png
+    SAMPLE_NAME_PATTERN = re.compile(r'x(-?\d+(?:\.\d+)?)[ _,]*y(-?\d+(?:\.\d+)?)', re.IGNORECASE)
+
+    def __init__(self, parent=None, current_map_provider="官方地图", current_map_url=None, local_map_name=None):
         super().__init__(parent)
         self.setWindowTitle(tr('map_calibration', '地图校准'))
         self.setGeometry(200, 200, 1200, 800)
@@ -911,6 +1145,8 @@ class CalibrationWindow(QDialog):
         self.current_zoom = 1
         self.current_map_provider = current_map_provider  # 记录当前地图提供商
         self.current_map_url = current_map_url  # 记录当前具体URL（包含副本信息）
+        self.local_map_name = local_map_name  # 本地地图名（只有本地地图支持自动校准）
+        self.auto_worker = None
         
         self.setup_ui()
         self.setup_web_channel()
@@ -1013,20 +1249,40 @@ class CalibrationWindow(QDialog):
         self.calib_btn1 = QPushButton(tr('set_calibration_point_1', '设定校准点 1'))
         self.calib_btn2 = QPushButton(tr('set_calibration_point_2', '设定校准点 2'))
         self.calib_btn3 = QPushButton(tr('set_calibration_point_3', '设定校准点 3'))
+        self.add_point_btn = QPushButton(tr('add_calibration_point', '添加更多校准点'))
+        self.auto_calib_btn = QPushButton(tr('auto_calibration_from_screenshots', '从截图自动校准...'))
+        self.auto_calib_btn.setToolTip(tr('auto_calibration_tooltip',
+                                          '选择带游戏坐标的小地图截图（文件名如 x1234_y-567.png），自动在本地地图上定位'))
+        self.auto_calib_btn.setEnabled(bool(self.local_map_name))
         self.finish_btn = QPushButton(tr('calculate_and_finish_calibration', '计算并完成校准'))
         self.finish_btn.setEnabled(False)
         
+        # 校准模型：点数越多可选的模型越精细
+        self.model_combo = QComboBox()
+        self.model_combo.addItem(tr('calibration_model_affine', '仿射变换 (≥2点)'), MODEL_AFFINE)
+        self.model_combo.addItem(tr('calibration_model_homography', '透视变换 (≥4点)'), MODEL_HOMOGRAPHY)
+        self.model_combo.addItem(tr('calibration_model_polynomial', '二次多项式 (≥6点)'), MODEL_POLYNOMIAL)
+        self.model_combo.addItem(tr('calibration_model_piecewise', '分段仿射 (≥3点)'), MODEL_PIECEWISE)
+        # 默认使用全部校准点，勾选后才剔除离群点
+        self.outlier_check = QCheckBox(tr('calibration_reject_outliers', '自动剔除离群点'))
+        self.outlier_check.setChecked(False)
+        
         calib_layout.addWidget(self.calib_btn1)
         calib_layout.addWidget(self.calib_btn2)
         calib_layout.addWidget(self.calib_btn3)
+        calib_layout.addWidget(self.add_point_btn)
+        calib_layout.addWidget(self.auto_calib_btn)
+        calib_layout.addWidget(QLabel(tr('calibration_model', '校准模型:')))
+        calib_layout.addWidget(self.model_combo)
+        calib_layout.addWidget(self.outlier_check)
         calib_layout.addWidget(self.finish_btn)
         
         # 校准数据表格
         table_group = QGroupBox(tr('calibration_data', '校准数据'))
         table_layout = QVBoxLayout(table_group)
         
-        self.data_table = QTableWidget(0, 5)
-        self.data_table.setHorizontalHeaderLabels([tr('number', '序号'), tr('game_x', '游戏X'), tr('game_y', '游戏Y'), tr('latitude', '纬度(Lat)'), tr('longitude', '经度(Lon)')])
+        self.data_table = QTableWidget(0, 6)
+        self.data_table.setHorizontalHeaderLabels([tr('number', '序号'), tr('game_x', '游戏X'), tr('game_y', '游戏Y'), tr('latitude', '纬度(Lat)'), tr('longitude', '经度(Lon)'), tr('residual', '残差')])
         self.data_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
         table_layout.addWidget(self.data_table)
         
@@ -1045,6 +1301,9 @@ class CalibrationWindow(QDialog):
         self.calib_btn1.clicked.connect(lambda: self.add_calibration_point(1))
         self.calib_btn2.clicked.connect(lambda: self.add_calibration_point(2))
         self.calib_btn3.clicked.connect(lambda: self.add_calibration_point(3))
+        self.add_point_btn.clicked.connect(lambda: self.add_calibration_point(len(self.calibration_points) + 1))
+        self.auto_calib_btn.clicked.connect(self.start_auto_calibration)
+        self.model_combo.currentIndexChanged.connect(self.update_finish_button)
         self.finish_btn.clicked.connect(self.finish_calibration)
 
     def setup_web_channel(self):
@@ -1149,18 +1408,8 @@ class CalibrationWindow(QDialog):
             QMessageBox.warning(self, "地图未就绪", "请等待地图加载完成!")
             return
 
-        # 创建校准点
-        point = CalibrationPoint(x, y, self.current_lat, self.current_lng)
-        self.calibration_points.append(point)
-
-        # 添加到表格
-        row = self.data_table.rowCount()
-        self.data_table.insertRow(row)
-        self.data_table.setItem(row, 0, QTableWidgetItem(str(point_num)))
-        self.data_table.setItem(row, 1, QTableWidgetItem(f"{x:.2f}"))
-        self.data_table.setItem(row, 2, QTableWidgetItem(f"{y:.2f}"))
-        self.data_table.setItem(row, 3, QTableWidgetItem(f"{self.current_lat:.6f}"))
-        self.data_table.setItem(row, 4, QTableWidgetItem(f"{self.current_lng:.6f}"))
+        # 创建校准点并添加到表格
+        self.append_calibration_point(CalibrationPoint(x, y, self.current_lat, self.current_lng), str(point_num))
 
         # 清空输入框
         self.x_input.clear()
@@ -1175,20 +1424,117 @@ class CalibrationWindow(QDialog):
             self.calib_btn3.setEnabled(False)
 
         # 检查是否可以完成校准
-        if len(self.calibration_points) >= 2:
-            self.finish_btn.setEnabled(True)
+        self.update_finish_button()
 
         self.log(f"已添加校准点 {point_num}: ({x}, {y}) -> ({self.current_lat:.6f}, {self.current_lng:.6f})")
 
+    def append_calibration_point(self, point, label):
+        """记录校准点并添加到表格"""
+        self.calibration_points.append(point)
+        row = self.data_table.rowCount()
+        self.data_table.insertRow(row)
+        self.data_table.setItem(row, 0, QTableWidgetItem(label))
+        self.data_table.setItem(row, 1, QTableWidgetItem(f"{point.x:.2f}"))
+        self.data_table.setItem(row, 2, QTableWidgetItem(f"{point.y:.2f}"))
+        self.data_table.setItem(row, 3, QTableWidgetItem(f"{point.lat:.6f}"))
+        self.data_table.setItem(row, 4, QTableWidgetItem(f"{point.lon:.6f}"))
+
+    def start_auto_calibration(self):
+        """选择截图，按文件名或手动输入得到游戏坐标，然后在后台定位"""
+        file_paths, _ = QFileDialog.getOpenFileNames(
+            self, tr('select_minimap_screenshots', '选择小地图截图'), "",
+            "Images (*.png *.jpg *.jpeg *.bmp *.webp)")
+        if not file_paths:
+            return
+        samples = []
+        for path in file_paths:
+            name = os.path.basename(path)
+            match = self.SAMPLE_NAME_PATTERN.search(os.path.splitext(name)[0])
+            if match:
+                samples.append((path, float(match.group(1)), float(match.group(2))))
+                continue
+            text, ok = QInputDialog.getText(self, tr('game_coordinate_input', '游戏坐标输入'),
+                                            tr('enter_screenshot_coordinates', '{name} 的游戏坐标 (X, Y):', name=name))
+            if not ok:
+                continue
+            try:
+                x, y = (float(v) for v in text.replace('，', ',').replace(',', ' ').split())
+            except ValueError:
+                QMessageBox.warning(self, "输入错误", f"无效的坐标，已跳过 {name}")
+                continue
+            samples.append((path, x, y))
+        if not samples:
+            return
+        
+        parent_window = self.parent()
+        server_manager = getattr(parent_window, 'server_manager', None)
+        tile_store = getattr(server_manager, 'tile_store', None)
+        
+        self.auto_progress = QProgressDialog(tr('auto_calibration_loading', '正在载入地图特征...'), "取消", 0, 100, self)
+        self.auto_progress.setWindowTitle(tr('auto_calibration', '自动校准'))
+        self.auto_progress.setMinimumDuration(0)
+        self.auto_progress.setModal(True)
+        
+        self.auto_worker = AutoCalibrationWorker(self.local_map_name, samples, tile_store)
+        self.auto_worker.progress_updated.connect(self.on_auto_calibration_progress)
+        self.auto_worker.point_found.connect(self.on_auto_calibration_point)
+        self.auto_worker.finished.connect(self.on_auto_calibration_finished)
+        self.auto_progress.canceled.connect(self.auto_worker.cancel)
+        self.auto_calib_btn.setEnabled(False)
+        self.auto_worker.start()
+        self.auto_progress.show()
+
+    @Slot(str, int)
+    def on_auto_calibration_progress(self, stage, percent):
+        self.auto_progress.setLabelText(stage)
+        self.auto_progress.setValue(percent)
+
+    @Slot(float, float, float, float, int)
+    def on_auto_calibration_point(self, x, y, lat, lng, inliers):
+        label = f"A{len(self.calibration_points) + 1}"
+        self.append_calibration_point(CalibrationPoint(x, y, lat, lng), label)
+        self.log(f"自动校准点 {label}: ({x}, {y}) -> ({lat:.6f}, {lng:.6f}), 内点 {inliers}")
+
+    @Slot(bool, str)
+    def on_auto_calibration_finished(self, success, message):
+        self.auto_progress.close()
+        self.auto_calib_btn.setEnabled(True)
+        self.update_finish_button()
+        if success:
+            QMessageBox.information(self, tr('auto_calibration', '自动校准'), message)
+        else:
+            QMessageBox.warning(self, tr('auto_calibration', '自动校准'), message)
+
+    def update_finish_button(self):
+        """校准点数达到所选模型的最少点数时才允许计算"""
+        min_points = get_model_class(self.model_combo.currentData()).min_points
+        self.finish_btn.setEnabled(len(self.calibration_points) >= max(2, min_points))
+
+    def show_residuals(self, fit):
+        """在表格中显示每个点的残差，被剔除的点标红"""
+        for row, residual in enumerate(fit.residuals):
+            item = QTableWidgetItem(f"{residual:.6f}")
+            if not fit.inliers[row]:
+                item.setForeground(Qt.GlobalColor.red)
+                item.setToolTip(tr('calibration_point_rejected', '该点与其他点不一致，已被剔除'))
+            self.data_table.setItem(row, 5, item)
+
     def finish_calibration(self):
         try:
-            self.transform_matrix = CalibrationSystem.calculate_transform_matrix(self.calibration_points)
+            fit = CalibrationSystem.fit_points(self.calibration_points, self.model_combo.currentData(),
+                                               robust=self.outlier_check.isChecked())
+            self.show_residuals(fit)
+            self.transform_matrix = TransformMatrix.from_fit(fit)
             
             # 发射校准完成信号
             self.calibrationFinished.emit(self.transform_matrix)
             
-            QMessageBox.information(self, "校准完成", 
-                f"校准成功完成!\n使用了 {len(self.calibration_points)} 个校准点")
+            message = (f"校准成功完成!\n使用了 {len(self.calibration_points)} 个校准点\n"
+                       f"模型: {self.model_combo.currentText()}\n均方根残差: {fit.rms:.6f}")
+            if len(fit.outliers):
+                rejected = ', '.join(str(index + 1) for index in fit.outliers)
+                message += f"\n已剔除离群的校准点: {rejected}"
+            QMessageBox.information(self, "校准完成", message)
             
             self.accept()
             
@@ -1202,6 +1548,11 @@ class CalibrationWindow(QDialog):
             if hasattr(self, 'capture_timer') and self.capture_timer:
                 self.capture_timer.stop()
             
+            # 停止自动校准线程
+            if self.auto_worker is not None and self.auto_worker.isRunning():
+                self.auto_worker.cancel()
+                self.auto_worker.wait(3000)
+            
             # 清理独立页面资源
             if hasattr(self, 'web_view') and self.web_view:
                 self.web_view.close()
@@ -1480,11 +1831,10 @@ class MapCalibrationMainWindow(QMainWindow):
         try:
             if hasattr(self, 'map_worker') and self.map_worker and self.map_worker.isRunning():
                 print("正在停止地图生成工作线程...")
-                # 直接terminate，不等待
-                self.map_worker.terminate()
-                # 只等待很短时间
-                if not self.map_worker.wait(500):
-                    print("工作线程已强制终止")
+                # 请求取消，导入任务在当前瓦片完成后停止并清理未完成的输出
+                self.map_worker.cancel()
+                if not self.map_worker.wait(3000):
+                    print("导入任务仍在结束当前瓦片，不再等待")
                 self.map_worker = None
             print("工作线程已停止")
         except Exception as e:
@@ -1494,7 +1844,7 @@ class MapCalibrationMainWindow(QMainWindow):
         """关闭所有对话框"""
         try:
             if hasattr(self, 'progress_dialog') and self.progress_dialog:
-                self.progress_dialog.close()
+                self.progress_dialog.finish()
                 self.progress_dialog = None
             print("对话框已关闭")
         except Exception as e:
@@ -1595,11 +1945,14 @@ class MapCalibrationMainWindow(QMainWindow):
         self.local_map_combo = QComboBox()
         self.add_map_btn = QPushButton(tr("button_add_map", "添加地图"))
         self.add_map_btn.setToolTip(tr("tooltip_add_map", "选择图片文件生成地图"))
+        self.import_tiles_btn = QPushButton(tr("button_import_tiles", "导入瓦片包"))
+        self.import_tiles_btn.setToolTip(tr("tooltip_import_tiles", "直接导入现成的 z/x/y 瓦片目录，不重新切图"))
         self.delete_map_btn = QPushButton(tr("delete", "删除地图"))
         self.delete_map_btn.setToolTip(tr("tooltip_delete_map", "删除当前选择的本地地图"))
         self.delete_map_btn.setStyleSheet("QPushButton { background-color: #dc3545; color: white; }")
         local_map_layout.addWidget(self.local_map_combo)
         local_map_layout.addWidget(self.add_map_btn)
+        local_map_layout.addWidget(self.import_tiles_btn)
         local_map_layout.addWidget(self.delete_map_btn)
         self.local_map_group.setVisible(False)  # 默认隐藏
         
@@ -2236,8 +2589,7 @@ class MapCalibrationMainWindow(QMainWindow):
                 self.server_status_label.setStyleSheet("color: orange;")
             
             self.safe_log("正在启动本地图片服务器...")
-            self.safe_log("- Flask + WebSocket 服务器 (端口: 8080)")
-            self.safe_log("- HTTP 文件服务器 (端口: 8000)")
+            self.safe_log("- 地图页面、瓦片和 WebSocket 同步 (端口: 8000)")
             
             if self.server_manager.start_servers():
                 self.safe_log("✓ 本地图片服务器启动成功")
@@ -2396,6 +2748,7 @@ class MapCalibrationMainWindow(QMainWindow):
         self.radio_online_map_group.buttonClicked.connect(self.load_current_map)
         self.local_map_combo.currentIndexChanged.connect(self.load_current_map)
         self.add_map_btn.clicked.connect(self.add_local_maps)
+        self.import_tiles_btn.clicked.connect(self.import_tile_pyramid)
         self.delete_map_btn.clicked.connect(self.delete_local_map)
         
         self.web_view.urlChanged.connect(self.on_url_changed)
@@ -3034,7 +3387,8 @@ class MapCalibrationMainWindow(QMainWindow):
         
         self.log(f"启动校准窗口 - 提供商: {current_provider}, 当前URL: {current_url}")
         
-        calibration_window = CalibrationWindow(self, current_provider, current_url)
+        local_map_name = map_name if self.current_mode != 'online' else None
+        calibration_window = CalibrationWindow(self, current_provider, current_url, local_map_name)
         calibration_window.calibrationFinished.connect(self.on_calibration_finished)
         calibration_window.exec()
 
@@ -3064,20 +3418,73 @@ class MapCalibrationMainWindow(QMainWindow):
         if not file_paths:
             return
             
-        self.log(f"准备处理 {len(file_paths)} 个地图文件...")
+        # 选择瓦片编码格式（仅对需要瓦片化的大图生效）
+        try:
+            from tile_generator import get_available_tile_formats
+            # jpeg 仅用于导入现成的 JPEG 瓦片包，切图时不提供（不支持透明边缘）
+            tile_formats = [f for f in get_available_tile_formats() if f != 'jpeg']
+        except ImportError:
+            tile_formats = ['png']
+        settings = self.load_app_settings()
+        last_format = settings.get('tile_format', 'png')
+        current_index = tile_formats.index(last_format) if last_format in tile_formats else 0
+        tile_format, ok = QInputDialog.getItem(
+            self,
+            "瓦片格式",
+            "选择瓦片编码格式:\npng - 无损RGBA（兼容性最好）\npng8 - 调色板量化PNG\nwebp - 有损WebP（体积最小）\nwebp_lossless - 无损WebP\navif - AVIF（需Pillow支持）",
+            tile_formats,
+            current_index,
+            False
+        )
+        if not ok:
+            return
+        
+        # 选择瓦片存储方式：单文件归档便于复制和删除，按需渲染可以立即浏览
+        tile_storages = ['directory', 'archive', 'lazy']
+        last_storage = settings.get('tile_storage', 'directory')
+        tile_storage, ok = QInputDialog.getItem(
+            self,
+            "瓦片存储方式",
+            "选择瓦片存储方式:\ndirectory - 每个瓦片一个文件\narchive - 整张地图存为单个归档文件（推荐大地图）\nlazy - 导入后立即可浏览，瓦片在浏览时生成并由后台补全",
+            tile_storages,
+            tile_storages.index(last_storage) if last_storage in tile_storages else 0,
+            False
+        )
+        if not ok:
+            return
+        settings['tile_format'] = tile_format
+        settings['tile_storage'] = tile_storage
+        self.save_app_settings(settings)
+        
+        self.log(f"准备处理 {len(file_paths)} 个地图文件 (瓦片格式: {tile_format}, 存储: {tile_storage})...")
+        self.start_map_generation(file_paths, tile_format, tile_storage)
+        
+    def import_tile_pyramid(self):
+        """导入现成的瓦片目录（z/x/y.ext），瓦片直接链接到地图目录"""
+        tiles_dir = QFileDialog.getExistingDirectory(self, "选择瓦片目录 (包含 z/x/y 子目录)")
+        if not tiles_dir:
+            return
+        tile_format = self.load_app_settings().get('tile_format', 'png')
+        self.log(f"准备导入瓦片目录: {tiles_dir}")
+        self.start_map_generation([tiles_dir], tile_format, 'directory')
+        
+    def start_map_generation(self, file_paths, tile_format, tile_storage):
+        """在工作线程中处理地图文件或瓦片目录，并显示进度对话框"""
+        # 重新生成同名地图前释放其归档文件句柄并清除瓦片缓存
+        for file_path in file_paths:
+            map_name = os.path.splitext(os.path.basename(os.path.normpath(file_path)))[0]
+            self.server_manager.invalidate_tiles(map_name)
         
-        # 创建进度对话框
-        self.progress_dialog = QProgressDialog("正在处理地图文件...", "取消", 0, 100, self)
-        self.progress_dialog.setWindowTitle("生成地图")
-        self.progress_dialog.setMinimumDuration(0)
-        self.progress_dialog.setModal(True)
+        # 创建进度对话框（每个任务一行，可以单独取消）
+        self.progress_dialog = ImportProgressDialog(self)
         
         # 创建并启动工作线程
-        self.map_worker = MapGeneratorWorker(file_paths)
-        self.map_worker.progress_updated.connect(self.progress_dialog.setValue)
-        self.map_worker.status_updated.connect(self.progress_dialog.setLabelText)
+        self.map_worker = MapGeneratorWorker(file_paths, tile_format, tile_storage)
+        self.map_worker.progress_updated.connect(self.progress_dialog.total_bar.setValue)
+        self.map_worker.job_updated.connect(self.progress_dialog.update_job)
         self.map_worker.finished.connect(self.on_map_generation_finished)
-        self.progress_dialog.canceled.connect(self.cancel_map_generation)
+        self.progress_dialog.cancel_job_requested.connect(self.cancel_map_job)
+        self.progress_dialog.cancel_all_requested.connect(self.cancel_map_generation)
         
         self.map_worker.start()
         self.progress_dialog.show()
@@ -3085,21 +3492,30 @@ class MapCalibrationMainWindow(QMainWindow):
     def cancel_map_generation(self):
         """取消地图生成"""
         if hasattr(self, 'map_worker') and self.map_worker.isRunning():
-            self.map_worker.terminate()
-            self.map_worker.wait()
-            self.log("地图生成已取消")
+            # 不再强行终止线程：导入任务在两个瓦片之间停止，完成后照常发出 finished 信号
+            self.map_worker.cancel()
+            self.log("正在取消地图生成...")
+    
+    @Slot(int)
+    def cancel_map_job(self, job_id):
+        """取消单个导入任务，其他任务继续"""
+        if hasattr(self, 'map_worker') and self.map_worker.cancel_job(job_id):
+            self.log(tr('import_cancelling_job', '正在取消导入任务 {job_id}...', job_id=job_id))
             
     @Slot(bool, str)
     def on_map_generation_finished(self, success, message):
         """地图生成完成处理"""
-        self.progress_dialog.close()
+        self.progress_dialog.finish()
+        
+        # 批量导入时部分任务失败不影响其他地图，两种情况都刷新
+        # 按需渲染的地图由服务器在后台补全瓦片
+        self.server_manager.start_lazy_tile_fill()
+        if self.current_mode == 'local':
+            self.update_local_map_list()
         
         if success:
             self.log(f"地图生成完成: {message}")
             QMessageBox.information(self, "成功", message)
-            # 刷新本地地图列表
-            if self.current_mode == 'local':
-                self.update_local_map_list()
         else:
             self.log(f"地图生成失败: {message}")
             QMessageBox.critical(self, "失败", message)
@@ -3151,6 +3567,8 @@ class MapCalibrationMainWindow(QMainWindow):
             tiles_dir = os.path.join(script_dir, "tiles")
             # 对于瓦片地图，文件夹名称是去掉扩展名的
             map_folder_name = os.path.splitext(map_name)[0] if '.' in map_name else map_name
+            # 先停止后台补全、释放归档句柄并清除瓦片缓存
+            self.server_manager.invalidate_tiles(map_folder_name)
             tile_folder = os.path.join(tiles_dir, map_folder_name)
             if os.path.exists(tile_folder):
                 import shutil
@@ -3159,30 +3577,21 @@ class MapCalibrationMainWindow(QMainWindow):
             else:
                 self.log(f"⚠️ 瓦片地图文件夹不存在: {tile_folder}")
             
-            # 3. 从maps.json中移除地图记录
-            maps_json_file = os.path.join(script_dir, "maps.json")
-            if os.path.exists(maps_json_file):
-                try:
-                    with open(maps_json_file, 'r', encoding='utf-8') as f:
-                        maps_data = json.load(f)
-                    
-                    # maps.json是一个数组，需要找到对应的地图记录并移除
-                    original_count = len(maps_data)
-                    maps_data = [item for item in maps_data if item.get('name') != map_name]
-                    
-                    if len(maps_data) < original_count:
-                        # 写回文件
-                        with open(maps_json_file, 'w', encoding='utf-8') as f:
-                            json.dump(maps_data, f, indent=4, ensure_ascii=False)
-                        
-                        self.log(f"✅ 已从maps.json中移除地图记录: {map_name}")
-                    else:
-                        self.log(f"⚠️ maps.json中没有找到地图记录: {map_name}")
-                        
-                except Exception as e:
-                    self.log(f"❌ 更新maps.json失败: {e}")
-            else:
-                self.log(f"⚠️ maps.json文件不存在: {maps_json_file}")
+            # 单文件归档存储的地图只需删除一个文件（先关闭服务器持有的句柄）
+            from tile_archive import get_archive_path
+            archive_file = get_archive_path(tiles_dir, map_folder_name)
+            if os.path.exists(archive_file):
+                os.remove(archive_file)
+                self.log(f"✅ 已删除瓦片归档文件: {archive_file}")
+            
+            # 3. 从maps.json中移除地图记录（通过注册表原子写入）
+            try:
+                if self.server_manager.map_registry.remove(map_name):
+                    self.log(f"✅ 已从maps.json中移除地图记录: {map_name}")
+                else:
+                    self.log(f"⚠️ maps.json中没有找到地图记录: {map_name}")
+            except Exception as e:
+                self.log(f"❌ 更新maps.json失败: {e}")
             
             # 4. 清除相关校准数据
             if self.calibration_manager.has_calibration('local', map_name):
@@ -3191,6 +3600,13 @@ class MapCalibrationMainWindow(QMainWindow):
                 else:
                     self.log(f"⚠️ 清除校准数据失败: {map_name}")
             
+            # 清除自动校准的特征缓存
+            feature_cache = os.path.join(script_dir, "feature_cache", map_name)
+            if os.path.isdir(feature_cache):
+                import shutil
+                shutil.rmtree(feature_cache, ignore_errors=True)
+                self.log(f"✅ 已删除特征缓存: {feature_cache}")
+            
             # 5. 更新本地地图列表
             self.update_local_map_list()
             
@@ -3927,8 +4343,8 @@ class MapCalibrationMainWindow(QMainWindow):
                     start_game = svg_data["points"]["start"]["game"]
                     end_game = svg_data["points"]["end"]["game"]
                     
-                    start_lat, start_lng = CalibrationSystem.transform(start_game[0], start_game[1], self.transform_matrix)
-                    end_lat, end_lng = CalibrationSystem.transform(end_game[0], end_game[1], self.transform_matrix)
+                    (start_lat, start_lng), (end_lat, end_lng) = CalibrationSystem.transform_points(
+                        [start_game[:2], end_game[:2]], self.transform_matrix).tolist()
                     
                     self.log(f"起点坐标转换: ({start_game[0]}, {start_game[1]}) -> ({start_lat:.6f}, {start_lng:.6f})")
                     self.log(f"终点坐标转换: ({end_game[0]}, {end_game[1]}) -> ({end_lat:.6f}, {end_lng:.6f})")
@@ -4366,6 +4782,10 @@ class MapCalibrationMainWindow(QMainWindow):
             # 清理路线录制器资源
             self._cleanup_route_recorder()
             
+            # 等待校准数据写入磁盘
+            if hasattr(self, 'calibration_manager'):
+                self.calibration_manager.flush()
+            
             # 调用父类的closeEvent
             super().closeEvent(event)
             
@@ -4374,6 +4794,10 @@ class MapCalibrationMainWindow(QMainWindow):
             event.accept()  # 确保窗口能正常关闭
 
 if __name__ == "__main__":
+    # 服务器工作进程以 spawn 方式启动，打包后的程序需要在这里接管子进程
+    import multiprocessing
+    multiprocessing.freeze_support()
+    
     # 确保工作目录是脚本所在目录
     import os
     script_dir = os.path.dirname(os.path.abspath(__file__))
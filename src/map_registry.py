@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+地图注册表
+maps.json 的唯一读写入口：
+- 内存中保存按地图名索引的副本，文件未变化（mtime/大小相同）时不再重新解析
+- 修改时先获取文件锁并重新读取磁盘内容，再写临时文件并原子替换，多个导入同时进行也不会损坏文件
+- 修改后通知订阅者 (action, map_name, entry)，action 为 'added' / 'updated' / 'removed'
+"""
+
+import os
+import json
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+LOCK_SUFFIX = '.lock'
+# Windows 下 maps.json 可能正被文件服务器读取，替换失败时重试
+REPLACE_RETRIES = 10
+REPLACE_RETRY_DELAY = 0.05
+
+
+class _FileLock:
+    """跨进程文件锁（Windows 使用 msvcrt，其他平台使用 fcntl）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._handle = None
+
+    def __enter__(self):
+        self._handle = open(self.path, 'a+b')
+        if os.name == 'nt':
+            import msvcrt
+            self._handle.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK 重试约 10 秒后仍失败会抛出异常，继续等待
+                    time.sleep(REPLACE_RETRY_DELAY)
+        else:
+            import fcntl
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._handle.seek(0)
+                msvcrt.locking(self._handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._handle.close()
+            self._handle = None
+
+
+class MapRegistry:
+    """maps.json 的内存索引和原子写入"""
+
+    def __init__(self, config_file: str):
+        self.config_file = os.path.abspath(config_file)
+        self._lock = threading.RLock()
+        self._entries: List[Dict[str, Any]] = []
+        self._index: Dict[str, Dict[str, Any]] = {}
+        self._signature = None
+        self._subscribers: List[Callable[[str, str, Optional[Dict[str, Any]]], None]] = []
+
+    # --- 读取 ---
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        """文件被其他进程修改过时重新加载（调用方持有锁）"""
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        entries = []
+        if signature is not None:
+            try:
+                with open(self.config_file, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except json.JSONDecodeError:
+                print(f"警告: '{self.config_file}' 文件为空或格式错误，将创建新的配置。")
+                entries = []
+            except OSError as e:
+                print(f"读取地图配置失败: {e}")
+                return
+        self._set_entries(entries)
+        self._signature = signature
+
+    def _set_entries(self, entries):
+        self._entries = [entry for entry in entries if isinstance(entry, dict) and "name" in entry]
+        self._index = {entry["name"]: entry for entry in self._entries}
+
+    def get(self, map_name: str) -> Optional[Dict[str, Any]]:
+        """返回地图配置的副本，不存在时返回 None"""
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(map_name)
+            return dict(entry) if entry is not None else None
+
+    def names(self) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return [entry["name"] for entry in self._entries]
+
+    def entries(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._refresh()
+            return [dict(entry) for entry in self._entries]
+
+    def __contains__(self, map_name: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return map_name in self._index
+
+    # --- 修改 ---
+    def update(self, map_name: str, fields: Dict[str, Any], remove_fields=()) -> Dict[str, Any]:
+        """新增或更新一张地图；fields 中为 None 的键和 remove_fields 中的键会被删除"""
+        def mutate(index, entries):
+            entry = index.get(map_name)
+            action = 'updated'
+            if entry is None:
+                entry = {"name": map_name}
+                entries.append(entry)
+                index[map_name] = entry
+                action = 'added'
+            for key, value in fields.items():
+                if value is None:
+                    entry.pop(key, None)
+                else:
+                    entry[key] = value
+            for key in remove_fields:
+                entry.pop(key, None)
+            return action, dict(entry)
+
+        return self._modify(map_name, mutate)
+
+    def remove(self, map_name: str) -> bool:
+        """删除地图配置，返回是否存在"""
+        def mutate(index, entries):
+            entry = index.pop(map_name, None)
+            if entry is None:
+                return None, None
+            entries.remove(entry)
+            return 'removed', None
+
+        return self._modify(map_name, mutate) is not None
+
+    def _modify(self, map_name, mutate):
+        with self._lock, _FileLock(self.config_file + LOCK_SUFFIX):
+            # 在锁内重新读取，合并其他进程刚写入的修改
+            self._signature = None
+            self._refresh()
+            action, result = mutate(self._index, self._entries)
+            if action is None:
+                return None
+            self._write()
+        self._notify(action, map_name, result)
+        return result if result is not None else True
+
+    def _write(self):
+        """写临时文件后原子替换（调用方持有锁）"""
+        directory = os.path.dirname(self.config_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.config_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        for attempt in range(REPLACE_RETRIES):
+            try:
+                os.replace(tmp_path, self.config_file)
+                break
+            except PermissionError:
+                if attempt == REPLACE_RETRIES - 1:
+                    os.remove(tmp_path)
+                    raise
+                time.sleep(REPLACE_RETRY_DELAY)
+        self._signature = self._file_signature()
+
+    # --- 订阅 ---
+    def subscribe(self, callback: Callable[[str, str, Optional[Dict[str, Any]]], None]):
+        """订阅修改通知，回调在执行修改的线程中调用"""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _notify(self, action, map_name, entry):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(action, map_name, entry)
+            except Exception as e:
+                print(f"地图注册表订阅者出错: {e}")
+
+
+_registries: Dict[str, MapRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_map_registry(config_file: str) -> MapRegistry:
+    """获取 maps.json 对应的注册表（同一文件在进程内只有一个实例）"""
+    path = os.path.abspath(config_file)
+    with _registries_lock:
+        registry = _registries.get(path)
+        if registry is None:
+            registry = MapRegistry(path)
+            _registries[path] = registry
+        return registry
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WebSocket 消息编解码
+- JSON 为默认编码（安装了 orjson 时使用 orjson），msgpack 为可选的二进制编码
+- binary 为定长结构体协议，只覆盖高频的位置、跳转、平移和缩放消息，其余消息仍以 JSON 文本帧发送
+- 客户端通过 WebSocket 子协议 (ww.json / ww.msgpack / ww.binary) 或 ?codec= 参数协商编码
+- EncodedMessage 对每种编码只序列化一次，同一条广播的所有客户端共享同一份字节
+"""
+
+import json
+import struct
+from typing import Any, Dict, Iterable, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_JSON = 'json'
+CODEC_MSGPACK = 'msgpack'
+CODEC_BINARY = 'binary'
+SUBPROTOCOL_PREFIX = 'ww.'
+
+
+class MessageCodec:
+    """编码器基类，binary 为 True 时以二进制帧发送"""
+    name = ''
+    binary = False
+
+    def encode(self, message: Dict[str, Any]) -> Optional[bytes]:
+        """返回编码结果；该编码无法表示的消息返回 None，由调用方改用 JSON 发送"""
+        raise NotImplementedError
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        raise NotImplementedError
+
+
+class JsonCodec(MessageCodec):
+    name = CODEC_JSON
+    binary = False
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(message)
+        return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackCodec(MessageCodec):
+    name = CODEC_MSGPACK
+    binary = True
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+# --- 定长二进制协议（小端序，与 web/index.html 中的 decodeBinaryMessage 对应）---
+# stateUpdate: 操作码, 字段掩码, seq, lat, lng, zoom
+# jumpTo:      操作码, lat, lng
+# panBy:       操作码, x, y（未给出的方向为 0）
+# zoomIn / zoomOut: 只有操作码
+OP_STATE_UPDATE = 1
+OP_JUMP_TO = 2
+OP_PAN_BY = 3
+OP_ZOOM_IN = 4
+OP_ZOOM_OUT = 5
+_STATE_STRUCT = struct.Struct('<BBIfff')
+_POINT_STRUCT = struct.Struct('<Bff')
+_OPCODE_STRUCT = struct.Struct('<B')
+STATE_MASK_FIELDS = (('lat', 1), ('lng', 2), ('zoom', 4))
+MAX_SEQ = 0xFFFFFFFF
+
+
+class BinaryCodec(MessageCodec):
+    """位置类消息使用定长结构体（9~18 字节），其他消息返回 None 以 JSON 发送"""
+    name = CODEC_BINARY
+    binary = True
+
+    def encode(self, message: Dict[str, Any]) -> Optional[bytes]:
+        message_type = message.get('type')
+        try:
+            if message_type == 'stateUpdate':
+                if not set(message) <= {'type', 'lat', 'lng', 'zoom', 'seq'}:
+                    return None
+                seq = message.get('seq', 0)
+                if not 0 <= seq <= MAX_SEQ:
+                    return None
+                mask = 0
+                for field, bit in STATE_MASK_FIELDS:
+                    if field in message:
+                        mask |= bit
+                return _STATE_STRUCT.pack(OP_STATE_UPDATE, mask, seq, message.get('lat', 0),
+                                          message.get('lng', 0), message.get('zoom', 0))
+            if message_type == 'jumpTo':
+                if set(message) != {'type', 'lat', 'lng'}:
+                    return None
+                return _POINT_STRUCT.pack(OP_JUMP_TO, message['lat'], message['lng'])
+            if message_type == 'panBy':
+                if not set(message) <= {'type', 'x', 'y'}:
+                    return None
+                return _POINT_STRUCT.pack(OP_PAN_BY, message.get('x', 0), message.get('y', 0))
+            if message_type in ('zoomIn', 'zoomOut') and len(message) == 1:
+                return _OPCODE_STRUCT.pack(OP_ZOOM_IN if message_type == 'zoomIn' else OP_ZOOM_OUT)
+        except (struct.error, TypeError, OverflowError, ValueError):
+            # 值不是数字或超出范围（如超出 float32 范围的坐标），改用 JSON 发送
+            return None
+        return None
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            return JSON_CODEC.decode(data)
+        opcode = data[0]
+        if opcode == OP_STATE_UPDATE:
+            _, mask, seq, lat, lng, zoom = _STATE_STRUCT.unpack(data)
+            message = {"type": "stateUpdate"}
+            values = {'lat': lat, 'lng': lng, 'zoom': zoom}
+            for field, bit in STATE_MASK_FIELDS:
+                if mask & bit:
+                    message[field] = values[field]
+            return message
+        if opcode == OP_JUMP_TO:
+            _, lat, lng = _POINT_STRUCT.unpack(data)
+            return {"type": "jumpTo", "lat": lat, "lng": lng}
+        if opcode == OP_PAN_BY:
+            _, x, y = _POINT_STRUCT.unpack(data)
+            return {"type": "panBy", "x": x, "y": y}
+        if opcode == OP_ZOOM_IN:
+            return {"type": "zoomIn"}
+        if opcode == OP_ZOOM_OUT:
+            return {"type": "zoomOut"}
+        raise ValueError(f"未知的操作码: {opcode}")
+
+
+JSON_CODEC = JsonCodec()
+CODECS: Dict[str, MessageCodec] = {CODEC_JSON: JSON_CODEC, CODEC_BINARY: BinaryCodec()}
+if msgpack is not None:
+    CODECS[CODEC_MSGPACK] = MsgpackCodec()
+
+
+def available_subprotocols():
+    """服务器支持的子协议，按优先顺序排列（二进制编码优先）"""
+    return tuple(SUBPROTOCOL_PREFIX + name for name in sorted(CODECS, key=lambda name: not CODECS[name].binary))
+
+
+def negotiate_codec(subprotocol: Optional[str] = None, requested: Optional[Iterable[str]] = None) -> MessageCodec:
+    """根据协商出的子协议或 ?codec= 参数选择编码，未知或未请求时使用 JSON"""
+    if subprotocol and subprotocol.startswith(SUBPROTOCOL_PREFIX):
+        codec = CODECS.get(subprotocol[len(SUBPROTOCOL_PREFIX):])
+        if codec is not None:
+            return codec
+    for name in requested or ():
+        codec = CODECS.get(name)
+        if codec is not None:
+            return codec
+    return JSON_CODEC
+
+
+class EncodedMessage:
+    """一条待发送的消息，每种编码的结果在第一次使用时生成并缓存"""
+    __slots__ = ('message', 'type', '_frames')
+
+    def __init__(self, message: Dict[str, Any]):
+        self.message = message
+        self.type = message.get('type')
+        self._frames: Dict[str, Optional[bytes]] = {}
+
+    def frame(self, codec: MessageCodec) -> Optional[bytes]:
+        """返回该编码的帧数据，编码无法表示该消息时返回 None"""
+        try:
+            return self._frames[codec.name]
+        except KeyError:
+            data = codec.encode(self.message)
+            self._frames[codec.name] = data
+            return data
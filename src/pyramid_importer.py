@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多分辨率源导入
+地图包已经自带瓦片金字塔或带内部概览的 TIFF 时，直接链接（或复制）到瓦片目录，不再重新编码：
+- 现成的 z/x/y.<ext> 瓦片目录: 逐个硬链接到 tiles/<地图>/，源级别号映射到本项目的缩放级别，
+  x/y 以最高级别左上角瓦片为原点重新编号（如只覆盖一个区域的 Web 墨卡托瓦片包），
+  缺失的低级别登记为按需渲染，由服务器从子瓦片合成
+- 带概览页的多页 TIFF: 链接为源图副本并登记为按需渲染，每个级别从最接近的概览页裁剪
+
+使用方法:
+python pyramid_importer.py 瓦片目录或TIFF [...] [--copy] [--format webp]
+"""
+
+import os
+import shutil
+from typing import Dict, Optional, Tuple, Any
+
+from PIL import Image
+
+from tile_generator import (TILE_SIZE, TILE_FORMATS, DEFAULT_TILE_FORMAT, TILE_STORAGE_DIRECTORY,
+                            LAZY_SOURCE_NAME, TileGenerationCancelled, calculate_max_zoom, check_cancelled,
+                            get_output_paths, remove_map_tiles, update_map_config)
+from lazy_tiles import get_overview_frames
+
+# 瓦片文件扩展名 -> 瓦片格式
+TILE_EXT_FORMATS = {'png': 'png', 'webp': 'webp', 'avif': 'avif', 'jpg': 'jpeg', 'jpeg': 'jpeg'}
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+IMPORT_LINK = 'link'
+IMPORT_COPY = 'copy'
+
+
+def link_or_copy(src: str, dst: str, mode: str = IMPORT_LINK):
+    """优先创建硬链接（同一分区上几乎不耗时），跨分区或文件系统不支持时退回复制"""
+    if mode == IMPORT_LINK:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+def scan_tile_directory(path: str) -> Optional[Dict[str, Any]]:
+    """
+    扫描 z/x/y.<ext> 结构的瓦片目录，不是瓦片目录时返回 None
+    返回 {"ext": 扩展名, "levels": {z: {(x, y): 文件路径}}}
+    """
+    if not os.path.isdir(path):
+        return None
+    levels: Dict[int, Dict[Tuple[int, int], str]] = {}
+    ext = None
+    for z_entry in os.scandir(path):
+        if not (z_entry.is_dir() and z_entry.name.isdigit()):
+            continue
+        tiles = {}
+        for x_entry in os.scandir(z_entry.path):
+            if not (x_entry.is_dir() and x_entry.name.isdigit()):
+                continue
+            for y_entry in os.scandir(x_entry.path):
+                stem, dot, tile_ext = y_entry.name.rpartition('.')
+                tile_ext = tile_ext.lower()
+                if not dot or not stem.isdigit() or tile_ext not in TILE_EXT_FORMATS:
+                    continue
+                if ext is None:
+                    ext = tile_ext
+                elif tile_ext != ext:
+                    raise ValueError(f"瓦片目录中混用了多种格式: {ext} / {tile_ext}")
+                tiles[(int(x_entry.name), int(stem))] = y_entry.path
+        if tiles:
+            levels[int(z_entry.name)] = tiles
+    if not levels:
+        return None
+    return {"ext": ext, "levels": levels}
+
+
+def _content_extent(tile_path: str, axis: int) -> int:
+    """瓦片在某个方向上的有效像素范围（透明边缘不计入），不透明瓦片返回 TILE_SIZE"""
+    with Image.open(tile_path) as tile:
+        if tile.size != (TILE_SIZE, TILE_SIZE):
+            raise ValueError(f"瓦片尺寸为 {tile.size[0]}x{tile.size[1]}，只支持 {TILE_SIZE} 像素瓦片")
+        if 'A' not in tile.getbands() and tile.mode != 'P':
+            return TILE_SIZE
+        bbox = tile.convert('RGBA').getchannel('A').getbbox()
+    return bbox[axis + 2] if bbox else TILE_SIZE
+
+
+def level_origin(top_level: Dict[Tuple[int, int], str]) -> Tuple[int, int]:
+    """最高级别左上角瓦片的编号，导入后的瓦片以它为 (0, 0)"""
+    return min(x for x, _ in top_level), min(y for _, y in top_level)
+
+
+def estimate_image_size(top_level: Dict[Tuple[int, int], str]) -> Tuple[int, int]:
+    """根据最高级别的瓦片范围（相对左上角瓦片）和右/下边缘瓦片的透明区域估算原图尺寸"""
+    min_x, min_y = level_origin(top_level)
+    max_x = max(x for x, _ in top_level)
+    max_y = max(y for _, y in top_level)
+    right_tile = next(p for (x, _), p in sorted(top_level.items()) if x == max_x)
+    bottom_tile = next(p for (_, y), p in sorted(top_level.items()) if y == max_y)
+    width = (max_x - min_x) * TILE_SIZE + _content_extent(right_tile, 0)
+    height = (max_y - min_y) * TILE_SIZE + _content_extent(bottom_tile, 1)
+    return width, height
+
+
+def plan_levels(levels: Dict[int, Dict[Tuple[int, int], str]], offset: int) -> Dict[int, Tuple[int, int]]:
+    """
+    每个可以直接链接的源级别 -> 该级别的原点瓦片编号
+    最高级别的原点 (ox, oy) 在低 d 级的级别中对应 (ox >> d, oy >> d)，只有 ox、oy 能被 2^d 整除时
+    瓦片边界才对齐；不对齐的级别（以及映射到负缩放级别的级别）不链接，由子瓦片合成
+    """
+    source_max = max(levels)
+    origin_x, origin_y = level_origin(levels[source_max])
+    plan = {}
+    for source_z in levels:
+        shift = source_max - source_z
+        if source_z + offset < 0 or origin_x % (1 << shift) or origin_y % (1 << shift):
+            continue
+        plan[source_z] = (origin_x >> shift, origin_y >> shift)
+    return plan
+
+
+def import_tile_directory(path: str, map_identifier: str, mode: str = IMPORT_LINK, base_dir=None,
+                          cancel_event=None, progress_callback=None) -> bool:
+    """导入现成的瓦片目录，返回是否成功；取消时删除已链接的瓦片并抛出 TileGenerationCancelled"""
+    scanned = scan_tile_directory(path)
+    if scanned is None:
+        print(f"错误: '{path}' 不是 z/x/y 结构的瓦片目录。")
+        return False
+
+    levels = scanned["levels"]
+    tile_ext = scanned["ext"]
+    tile_format = TILE_EXT_FORMATS[tile_ext]
+    source_max = max(levels)
+    width, height = estimate_image_size(levels[source_max])
+    max_zoom = calculate_max_zoom(width, height)
+    # 源金字塔的级别号可能不从 0 开始（如 Web 墨卡托的 10~17 级），以最高级别对齐；
+    # 瓦片编号同样不从 0 开始，每个级别减去该级别的原点
+    offset = max_zoom - source_max
+    plan = plan_levels(levels, offset)
+    origin_x, origin_y = plan[source_max]
+
+    print(f"\n正在导入瓦片目录 '{path}' (地图ID: '{map_identifier}'):")
+    print(f"  - 估算尺寸: {width}x{height} 像素, 源级别 {min(levels)}~{source_max} -> 缩放级别 0~{max_zoom}")
+    if origin_x or origin_y:
+        print(f"  - 源瓦片编号从 ({origin_x}, {origin_y}) 开始，已重新编号为从 (0, 0) 开始")
+
+    remove_map_tiles(map_identifier, base_dir)
+    tile_folder = os.path.join(get_output_paths(base_dir)[0], map_identifier)
+    if tile_ext != TILE_FORMATS[tile_format]['ext']:
+        print(f"  - 瓦片扩展名将统一为 .{TILE_FORMATS[tile_format]['ext']}")
+    tile_ext = TILE_FORMATS[tile_format]['ext']
+
+    total = sum(1 for source_z, (base_x, base_y) in plan.items()
+                for x, y in levels[source_z] if x >= base_x and y >= base_y)
+    linked = 0
+    try:
+        for source_z, (base_x, base_y) in plan.items():
+            z = source_z + offset
+            for (source_x, source_y), tile_path in levels[source_z].items():
+                check_cancelled(cancel_event)
+                x, y = source_x - base_x, source_y - base_y
+                if x < 0 or y < 0:
+                    # 在地图范围左侧或上方
+                    continue
+                tile_dir = os.path.join(tile_folder, str(z), str(x))
+                os.makedirs(tile_dir, exist_ok=True)
+                link_or_copy(tile_path, os.path.join(tile_dir, f'{y}.{tile_ext}'), mode)
+                linked += 1
+                if progress_callback:
+                    progress_callback(linked, total)
+    except TileGenerationCancelled:
+        remove_map_tiles(map_identifier, base_dir)
+        print(f"  - 已取消 '{map_identifier}' 的导入。")
+        raise
+
+    present = {z + offset for z in plan}
+    missing = [z for z in range(max_zoom + 1) if z not in present]
+    print(f"  - 已{'链接' if mode == IMPORT_LINK else '复制'} {linked} 个瓦片。")
+    if missing:
+        print(f"  - 缺失级别 {missing} 将在浏览时由子瓦片合成并由后台补全。")
+    update_map_config(map_identifier, True, width, height, max_zoom, tile_format,
+                      TILE_STORAGE_DIRECTORY, lazy=bool(missing), base_dir=base_dir)
+    return True
+
+
+def import_tiff_overviews(path: str, map_identifier: str, tile_format: str = DEFAULT_TILE_FORMAT,
+                          mode: str = IMPORT_LINK, base_dir=None, progress_callback=None) -> bool:
+    """导入带内部概览的 TIFF，返回是否成功"""
+    frames = get_overview_frames(path)
+    if frames is None:
+        print(f"错误: '{path}' 不包含内部概览。")
+        return False
+    _, width, height = frames[0]
+    max_zoom = calculate_max_zoom(width, height)
+
+    print(f"\n正在导入多分辨率 TIFF '{path}' (地图ID: '{map_identifier}'):")
+    print(f"  - 尺寸: {width}x{height} 像素, {len(frames) - 1} 个概览页, 最大缩放级别: {max_zoom}")
+
+    remove_map_tiles(map_identifier, base_dir)
+    tile_folder = os.path.join(get_output_paths(base_dir)[0], map_identifier)
+    os.makedirs(tile_folder, exist_ok=True)
+    source_name = LAZY_SOURCE_NAME + os.path.splitext(path)[1].lower()
+    link_or_copy(path, os.path.join(tile_folder, source_name), mode)
+
+    print(f"  - 瓦片 ({tile_format}) 将从最接近的概览页按需生成并由后台补全。")
+    update_map_config(map_identifier, True, width, height, max_zoom, tile_format,
+                      TILE_STORAGE_DIRECTORY, lazy_source=source_name, base_dir=base_dir)
+    if progress_callback:
+        progress_callback(1, 1)
+    return True
+
+
+def is_pyramid_source(path: str) -> bool:
+    """路径是瓦片目录或带内部概览的 TIFF 时返回 True"""
+    if os.path.isdir(path):
+        return True
+    return path.lower().endswith(TIFF_EXTENSIONS) and get_overview_frames(path) is not None
+
+
+def import_pyramid(path: str, tile_format: str = DEFAULT_TILE_FORMAT, mode: str = IMPORT_LINK,
+                   map_identifier: Optional[str] = None, base_dir=None, cancel_event=None,
+                   progress_callback=None) -> bool:
+    """导入瓦片目录或带概览的 TIFF；tile_format 只用于 TIFF 按需生成的瓦片"""
+    path = os.path.normpath(path)
+    if map_identifier is None:
+        map_identifier = os.path.splitext(os.path.basename(path))[0]
+    if os.path.isdir(path):
+        return import_tile_directory(path, map_identifier, mode, base_dir, cancel_event, progress_callback)
+    return import_tiff_overviews(path, map_identifier, tile_format, mode, base_dir, progress_callback)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="导入现成的瓦片目录或带内部概览的 TIFF，不重新编码")
+    parser.add_argument('sources', nargs='+', help="瓦片目录 (z/x/y.ext) 或多页 TIFF")
+    parser.add_argument('--copy', action='store_true', help="复制文件而不是创建硬链接")
+    parser.add_argument('--format', dest='tile_format', default=DEFAULT_TILE_FORMAT,
+                        choices=list(TILE_FORMATS), help="TIFF 按需生成瓦片的编码格式 (默认: png)")
+    args = parser.parse_args()
+
+    for source in args.sources:
+        import_pyramid(source, args.tile_format, IMPORT_COPY if args.copy else IMPORT_LINK)
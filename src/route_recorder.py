@@ -8,7 +8,9 @@
 
 import json
 import os
+import itertools
 from datetime import datetime
+import numpy as np
 from typing import List, Dict, Any, Optional
 from PySide6.QtCore import QObject, Signal, QTimer
 from PySide6.QtWidgets import QMessageBox, QFileDialog
@@ -84,6 +86,11 @@ class RouteData:
             except:
                 self.duration = "00:00:00"
     
+    def to_array(self) -> np.ndarray:
+        """返回 (N, 3) 的 [[x, y, z], ...] 浮点数组，供批量坐标转换使用"""
+        coordinates = itertools.chain.from_iterable((p.x, p.y, p.z) for p in self.points)
+        return np.fromiter(coordinates, dtype=np.float64, count=3 * len(self.points)).reshape(-1, 3)
+    
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典格式"""
         return {
@@ -1,114 +1,856 @@
-import json
-import copy
-from flask import Flask, jsonify
-from flask_sock import Sock
-
-# --- 1. 初始化应用 ---
-app = Flask(__name__)
-app.config["SECRET_KEY"] = "a_very_secret_key"
-sock = Sock(app)
-
-# --- 2. 全局状态管理 ---
-clients = set()
-try:
-    with open('maps.json', 'r', encoding='utf-8') as f:
-        initial_map_name = json.load(f)[0]['name']
-except (FileNotFoundError, IndexError):
-    initial_map_name = "default_map"
-
-map_state = {
-    "lat": 0, "lng": 0, "zoom": 0, "mapName": initial_map_name
-}
-
-# --- 3. 核心功能：广播消息 ---
-def broadcast(message_dict):
-    message_json = json.dumps(message_dict)
-    for client in copy.copy(clients):
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+地图同步服务器
+基于 asyncio (aiohttp) 的 WebSocket 中心：
+- 所有连接在同一个事件循环中处理，不再为每个客户端占用一个阻塞线程
+- 每个客户端有独立的发送队列和发送任务，广播只是把消息放入各个队列，不等待任何一个客户端
+- 发送队列有长度上限，慢客户端按丢弃策略处理，不会拖慢其他客户端和广播的调用方
+- 每条广播对每种编码只序列化一次，所有客户端共享同一份帧数据；客户端可协商 msgpack 等二进制编码
+- 可协商定长结构体的 binary 协议：位置、跳转、平移、缩放消息为 1~18 字节的二进制帧，其他消息以 JSON 文本帧发送
+- 断开的客户端在一次延迟处理中统一移除，只广播一次客户端数量
+- 高频的 stateUpdate 在一个短时间窗口内合并为一条只含变化字段的增量，不回发给发送者，并带有递增序号 seq
+- 客户端通过 /ws?room=<名称> 加入独立的房间，每个房间有自己的地图状态、序号和客户端集合，广播只发往本房间
+- 房间事件经过可替换的背板 (backplane.py) 分发，多个服务器进程连接同一个代理时共享房间状态和广播
+- 状态事件由后台线程写入日志和快照 (state_journal.py)，重启后恢复；重连的客户端用 ?since=<seq> 只补发错过的变化
+- 本进程（Qt 界面线程）的指令放入服务器持有的线程安全队列，由事件循环中的发送任务批量处理，调用方不等待
+- 消息类型保持不变: stateUpdate / mapChange / panBy / zoomIn / zoomOut / jumpTo，以及 /api/status
+
+独立运行: python server.py [--broker 127.0.0.1:8090]
+嵌入运行: hosting.ServerHost 用 add_sync_routes() 把同步服务挂到文件服务器所在的应用上，共用一个端口
+"""
+
+import os
+import re
+import asyncio
+import argparse
+import itertools
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+from aiohttp import web, WSMsgType
+
+from backplane import Backplane, create_backplane
+from map_registry import get_map_registry
+from state_journal import StateJournal
+from message_codec import (EncodedMessage, JSON_CODEC, MessageCodec, available_subprotocols,
+                           negotiate_codec)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+
+# 更新服务器状态后广播的消息（stateUpdate 先合并，mapChange 立即广播）
+STATE_MESSAGE_TYPES = ('stateUpdate', 'mapChange')
+# 直接转发给所有地图客户端的指令
+COMMAND_MESSAGE_TYPES = ('panBy', 'zoomIn', 'zoomOut', 'jumpTo')
+
+# 发送队列满时的丢弃策略:
+# drop_oldest - 丢弃队列中最旧的消息
+# latest_state - 丢弃队列中已被新消息取代的同类状态消息（只保留最新状态），没有时再丢弃最旧的消息
+# disconnect - 断开该客户端，由其重新连接后从 initialState 恢复
+DROP_OLDEST = 'drop_oldest'
+DROP_LATEST_STATE = 'latest_state'
+DROP_DISCONNECT = 'disconnect'
+DROP_POLICIES = (DROP_OLDEST, DROP_LATEST_STATE, DROP_DISCONNECT)
+DEFAULT_DROP_POLICY = DROP_LATEST_STATE
+DEFAULT_QUEUE_SIZE = 256
+# 新消息到来时可以取代队列中旧消息的类型
+SUPERSEDABLE_TYPES = ('stateUpdate', 'clientCountUpdate')
+# 单条消息发送超过该时间视为客户端已失去响应，断开连接
+SEND_TIMEOUT_SECONDS = 10.0
+
+# stateUpdate 合并窗口：窗口内收到的所有更新合并为一条增量广播
+COALESCE_INTERVAL_SECONDS = 0.05
+# 参与合并的状态字段
+STATE_FIELDS = ('lat', 'lng', 'zoom')
+
+# 未指定 ?room= 的客户端和 main_app 的指令使用的房间
+DEFAULT_ROOM = 'default'
+ROOM_NAME_PATTERN = re.compile(r'[\w.-]{1,64}')
+# 房间释放后仍计入 /api/status 总数的计数器
+ROOM_COUNTERS = ('messages_received', 'messages_broadcast', 'state_updates_received', 'state_updates_broadcast')
+# 每个房间保留的最近状态事件数，重连客户端错过的事件在此范围内时只补发变化
+REPLAY_HISTORY_SIZE = 1024
+# 释放后仍保留状态的房间数，房间再次创建时序号继续递增
+DORMANT_ROOMS_LIMIT = 1024
+# 本进程指令队列的上限，事件循环长时间无响应时丢弃最旧的指令
+COMMAND_QUEUE_SIZE = 1024
+
+
+class ClientConnection:
+    """
+    一个 WebSocket 客户端及其有界发送队列，发送由独立的任务完成
+    队列中保存共享的 EncodedMessage，发送时取该客户端编码对应的帧数据。
+    """
+
+    def __init__(self, client_id: int, ws: web.WebSocketResponse,
+                 max_queue: int = DEFAULT_QUEUE_SIZE, drop_policy: str = DEFAULT_DROP_POLICY,
+                 codec: MessageCodec = JSON_CODEC, on_failed=None):
+        self.id = client_id
+        self.ws = ws
+        self.codec = codec
+        self.on_failed = on_failed
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+        self.pending: Deque = deque()
+        self._wakeup = asyncio.Event()
+        self.sender_task: Optional[asyncio.Task] = None
+        self.room: Optional['Room'] = None
+        self.closed = False
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.disconnected_slow = False
+
+    def enqueue(self, message: EncodedMessage):
+        """放入发送队列，立即返回；队列已满时按丢弃策略处理"""
+        if self.closed:
+            return
+        if len(self.pending) >= self.max_queue and not self._make_room(message.type):
+            return
+        self.pending.append(message)
+        self._wakeup.set()
+
+    def _make_room(self, message_type: Optional[str]) -> bool:
+        """队列已满：腾出一个位置，返回 False 表示客户端被断开"""
+        if self.drop_policy == DROP_DISCONNECT:
+            print(f"客户端 {self.id} 发送队列已满，断开连接")
+            self.messages_dropped += len(self.pending) + 1
+            self.disconnected_slow = True
+            self.close()
+            asyncio.ensure_future(self.ws.close(code=1013, message=b'Too slow'))
+            if self.on_failed:
+                self.on_failed(self)
+            return False
+        if self.drop_policy == DROP_LATEST_STATE and message_type in SUPERSEDABLE_TYPES:
+            # 队列中同类的旧状态都已被新消息取代，全部丢弃，指令类消息保留
+            kept = deque(item for item in self.pending if item.type != message_type)
+            superseded = len(self.pending) - len(kept)
+            if superseded:
+                self.pending = kept
+                self.messages_dropped += superseded
+                return True
+        self.pending.popleft()
+        self.messages_dropped += 1
+        return True
+
+    async def run_sender(self):
+        """
+        逐条发送队列中的消息；无论因何结束（发送失败、超时、编码异常），
+        都会停止队列并登记移除，不会留下没有发送任务的客户端
+        """
         try:
-            client.send(message_json)
+            while not self.closed:
+                if not self.pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                message = self.pending.popleft()
+                await asyncio.wait_for(self._send(message), SEND_TIMEOUT_SECONDS)
+                self.messages_sent += 1
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"发送消息失败，移除客户端: {e}")
-            clients.remove(client)
-            # 当因发送失败而移除客户端时，也广播客户端数量变化
-            broadcast_client_count()
-
-def broadcast_client_count():
-    """专门用于广播当前客户端数量"""
-    count_message = {"type": "clientCountUpdate", "count": len(clients)}
-    broadcast(count_message)
-
-# --- 4. WebSocket 路由 ---
-@sock.route('/ws')
-def ws_handle(ws):
-    print("一个客户端已连接")
-    clients.add(ws)
-    # 广播客户端数量变化
-    broadcast_client_count()
-    
-    # 向新客户端发送当前完整状态
-    initial_message = {"type": "initialState", **map_state}
-    try:
-        ws.send(json.dumps(initial_message))
-    except Exception as e:
-        print(f"发送初始状态失败: {e}")
-        clients.remove(ws)
-        broadcast_client_count() # 更新数量
-        return
-
-    try:
+            print(f"发送消息失败，断开客户端 {self.id}: {e!r}")
+        finally:
+            self.close()
+            if self.on_failed:
+                self.on_failed(self)
+        if not self.ws.closed:
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
+
+    async def _send(self, message: EncodedMessage):
+        data = message.frame(self.codec)
+        if data is None:
+            # 该编码不覆盖的消息类型（如 binary 协议下的 mapChange）以 JSON 文本帧发送
+            await self.ws.send_frame(message.frame(JSON_CODEC), WSMsgType.TEXT)
+        elif self.codec.binary:
+            await self.ws.send_bytes(data)
+        else:
+            # 已编码的 UTF-8 JSON 直接作为文本帧发送，不再解码再编码
+            await self.ws.send_frame(data, WSMsgType.TEXT)
+
+    def close(self):
+        """停止发送任务（队列中剩余的消息被丢弃）"""
+        self.closed = True
+        self.pending.clear()
+        self._wakeup.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "room": self.room.name if self.room is not None else None,
+            "codec": self.codec.name,
+            "queue_depth": len(self.pending),
+            "sent": self.messages_sent,
+            "dropped": self.messages_dropped,
+        }
+
+
+class Room:
+    """
+    一个同步会话：独立的客户端集合、地图状态、状态序号和 stateUpdate 合并窗口
+    本地产生的事件交给 publish（背板）分发，背板返回的事件再由 apply_event 广播给本进程的客户端；
+    广播只遍历本房间的客户端，开销与房间人数成正比，与其他房间无关。
+    只能在事件循环线程中使用。
+    """
+
+    def __init__(self, name: str, initial_map_name: str = "default_map", publish=None, record=None):
+        self.name = name
+        # publish(房间名, 消息, 不需要收到的客户端 id)
+        self.publish = publish
+        # record(房间名, 消息)，把状态事件交给状态日志
+        self.record = record
+        # 最近的状态事件（按序号递增），用于补发
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=REPLAY_HISTORY_SIZE)
+        self.clients: Set[ClientConnection] = set()
+        # 背板订阅任务，完成后房间状态与背板一致
+        self.subscription: Optional[asyncio.Future] = None
+        # 其他工作进程在本房间的客户端数量
+        self.remote_counts: Dict[str, int] = {}
+        self.map_state: Dict[str, Any] = {
+            "lat": 0, "lng": 0, "zoom": 0, "mapName": initial_map_name
+        }
+        self.messages_received = 0
+        self.messages_broadcast = 0
+        # 状态消息序号（stateUpdate 增量和 mapChange 共用）
+        self.sequence = 0
+        # 合并窗口内的待广播字段: 字段 -> (值, 来源客户端)
+        self._pending_state: Dict[str, Any] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._broadcast_state: Dict[str, Any] = {k: self.map_state[k] for k in STATE_FIELDS}
+        self.state_updates_received = 0
+        self.state_updates_broadcast = 0
+
+    def close(self):
+        """取消尚未触发的合并广播（房间被释放或服务器停止时调用）"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending_state.clear()
+
+    def restore(self, state: Dict[str, Any], sequence: int, history=()):
+        """恢复状态日志或释放前保存的状态"""
+        self.map_state.update(state)
+        self._broadcast_state = {k: self.map_state[k] for k in STATE_FIELDS if k in self.map_state}
+        self.sequence = sequence
+        self.history.clear()
+        self.history.extend(history)
+
+    def load_snapshot(self, snapshot: Dict[str, Any], worker_id: str):
+        """用背板的房间快照覆盖本地状态"""
+        self.map_state.update(snapshot.get("state") or {})
+        self._broadcast_state = {k: self.map_state[k] for k in STATE_FIELDS if k in self.map_state}
+        sequence = snapshot.get("seq", self.sequence)
+        if sequence != self.sequence:
+            # 未订阅期间背板上发生过的事件不在本地历史中，无法补发
+            self.history.clear()
+        self.sequence = sequence
+        self.remote_counts = {worker: count for worker, count in (snapshot.get("counts") or {}).items()
+                              if worker != worker_id}
+
+    # --- 广播 ---
+    def broadcast(self, message: Dict[str, Any], exclude_id: Optional[int] = None):
+        """放入本房间每个客户端（id 为 exclude_id 的除外）的发送队列；每种编码只在第一个客户端发送时序列化一次"""
+        encoded = EncodedMessage(message)
+        for client in self.clients:
+            if client.id != exclude_id:
+                client.enqueue(encoded)
+        self.messages_broadcast += 1
+
+    def _publish(self, message: Dict[str, Any], exclude: Optional[ClientConnection] = None):
+        self.publish(self.name, message, exclude.id if exclude is not None else None)
+
+    def apply_event(self, message: Dict[str, Any], exclude_id: Optional[int] = None):
+        """背板分发的事件：更新本地状态副本，广播给本进程的客户端"""
+        message_type = message.get('type')
+        if message_type in STATE_MESSAGE_TYPES:
+            fields = {k: v for k, v in message.items() if k not in ('type', 'seq')}
+            if message_type == 'stateUpdate':
+                fields = {k: v for k, v in fields.items() if k in STATE_FIELDS}
+            self.map_state.update(fields)
+            self._broadcast_state.update({k: fields[k] for k in STATE_FIELDS if k in fields})
+            self.sequence = message.get('seq', self.sequence)
+            self.history.append(message)
+            if self.record is not None:
+                self.record(self.name, message)
+        self.broadcast(message, exclude_id)
+
+    # --- 补发 ---
+    def events_since(self, since: int) -> Optional[List[Dict[str, Any]]]:
+        """序号大于 since 的状态事件；历史中已没有这些事件（或序号来自重启前）时返回 None"""
+        if since == self.sequence:
+            return []
+        if since > self.sequence or not self.history:
+            return None
+        if self.history[0].get('seq', 0) > since + 1 or self.history[-1].get('seq') != self.sequence:
+            return None
+        return [message for message in self.history if message.get('seq', 0) > since]
+
+    def catch_up(self, client: ClientConnection, since: Optional[int] = None):
+        """
+        让客户端追上当前状态：错过的事件仍在历史中时合并为一条消息补发，否则发送完整的 initialState
+        错过的事件中有 mapChange 时补发 mapChange（附带完整状态），否则只补发变化的位置字段。
+        """
+        events = self.events_since(since) if since is not None else None
+        if events is None:
+            client.enqueue(EncodedMessage({"type": "initialState", **self.map_state, "seq": self.sequence}))
+            return
+        if not events:
+            return
+        if any(message.get('type') == 'mapChange' for message in events):
+            merged = {**self.map_state, "type": "mapChange"}
+        else:
+            merged = {"type": "stateUpdate"}
+            for message in events:
+                merged.update({k: v for k, v in message.items() if k in STATE_FIELDS})
+        merged["seq"] = self.sequence
+        client.enqueue(EncodedMessage(merged))
+
+    def queue_state_update(self, client: Optional[ClientConnection], data: Dict[str, Any]):
+        """记录一次 stateUpdate，合并窗口结束时统一广播"""
+        self.state_updates_received += 1
+        for field in STATE_FIELDS:
+            if field in data:
+                self._pending_state[field] = (data[field], client)
+                self.map_state[field] = data[field]
+        if self._flush_handle is None and self._pending_state:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                COALESCE_INTERVAL_SECONDS, self.flush_state_updates)
+
+    def flush_state_updates(self):
+        """广播合并后的增量；所有字段都来自同一个客户端时不回发给它"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending_state = self._pending_state, {}
+        delta = {field: value for field, (value, _) in pending.items()
+                 if self._broadcast_state.get(field) != value}
+        if not delta:
+            return
+        self._broadcast_state.update(delta)
+        sources = {source for _, source in pending.values()}
+        exclude = sources.pop() if len(sources) == 1 else None
+        # 序号由背板统一分配
+        self._publish({"type": "stateUpdate", **delta}, exclude)
+        self.state_updates_broadcast += 1
+
+    @property
+    def total_clients(self) -> int:
+        """房间在所有工作进程中的客户端总数"""
+        return len(self.clients) + sum(self.remote_counts.values())
+
+    def broadcast_client_count(self):
+        self.broadcast({"type": "clientCountUpdate", "count": self.total_clients})
+
+    def handle_message(self, client: Optional[ClientConnection], data: Dict[str, Any]):
+        """处理发往本房间的消息；client 为 None 表示来自本进程（如 OCR 自动跳转）"""
+        if not isinstance(data, dict):
+            return
+        if client is not None:
+            self.messages_received += 1
+        message_type = data.get('type')
+        if message_type == 'stateUpdate':
+            self.queue_state_update(client, data)
+        elif message_type == 'mapChange':
+            # 先发出切换前的位置增量，保证顺序
+            self.flush_state_updates()
+            fields = {k: v for k, v in data.items() if k not in ('type', 'seq')}
+            self._publish({**fields, "type": "mapChange"}, client)
+        elif message_type in COMMAND_MESSAGE_TYPES:
+            self._publish(data)
+        elif message_type == 'replay' and client is not None:
+            since = data.get('since')
+            self.catch_up(client, since if isinstance(since, int) else None)
+        elif client is None:
+            self._publish(data)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "clients_count": len(self.clients),
+            "remote_clients_count": sum(self.remote_counts.values()),
+            "map_state": self.map_state,
+            "sequence": self.sequence,
+            "history_size": len(self.history),
+            "messages_received": self.messages_received,
+            "messages_broadcast": self.messages_broadcast,
+            "updates_received": self.state_updates_received,
+            "updates_broadcast": self.state_updates_broadcast,
+            "queue_depth": sum(len(client.pending) for client in self.clients),
+        }
+
+
+class CommandChannel:
+    """
+    本进程其他线程发往房间的指令队列
+    submit 只做一次 deque.append（线程安全），并且只在发送任务空闲时唤醒事件循环一次；
+    发送任务一次取出所有积压的指令交给 dispatch(room, message)。
+    """
+
+    def __init__(self, dispatch, max_size: int = COMMAND_QUEUE_SIZE):
+        self.dispatch = dispatch
+        self.max_size = max_size
+        self._queue: Deque = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._wakeup_pending = False
+        self._task: Optional[asyncio.Task] = None
+        self.submitted = 0
+        self.dispatched = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        loop = self._loop
+        return loop is not None and not loop.is_closed()
+
+    def submit(self, message: Dict[str, Any], room: str = DEFAULT_ROOM) -> bool:
+        """放入队列并立即返回（可在任意线程调用）；服务器未运行时返回 False"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return False
+        if len(self._queue) >= self.max_size:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append((room, message))
+        self.submitted += 1
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            try:
+                loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                return False  # 事件循环刚刚关闭
+        return True
+
+    def start(self):
+        """在事件循环线程中启动发送任务"""
+        self._wakeup = asyncio.Event()
+        self._wakeup_pending = False
+        self._task = asyncio.create_task(self._run())
+        self._loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        self._loop = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._queue.clear()
+
+    async def _run(self):
         while True:
-            message = ws.receive()
-            if message is None:
-                break
-            
-            data = json.loads(message)
-            print(f"收到消息: {data}")
-
-            # 更新服务器状态并广播
-            if data['type'] == 'stateUpdate':
-                map_state.update(data)
-                broadcast(data)
-            elif data['type'] == 'mapChange':
-                map_state.update(data)
-                broadcast(data)
-            # --- 新增的指令处理 ---
-            elif data['type'] == 'panBy':
-                broadcast(data)  # 直接将指令广播给所有地图客户端
-            elif data['type'] == 'zoomIn':
-                broadcast(data)  # 直接广播
-            elif data['type'] == 'zoomOut':
-                broadcast(data)  # 直接广播
-            elif data['type'] == 'jumpTo':
-                broadcast(data)  # 广播跳转指令
-
-    except Exception as e:
-        print(f"WebSocket连接出现错误: {e}")
-    finally:
-        print("一个客户端已断开")
-        if ws in clients:
-            clients.remove(ws)
-            # 广播客户端数量变化
-            broadcast_client_count()
-
-# --- 5. API 路由 ---
-@app.route('/')
-def index():
-    return jsonify({
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # 先清除标志再取队列，之后提交的指令会重新唤醒
+            self._wakeup_pending = False
+            while self._queue:
+                room, message = self._queue.popleft()
+                try:
+                    self.dispatch(room, message)
+                except Exception as e:
+                    print(f"处理本地指令出错: {e!r}")
+                self.dispatched += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._queue),
+            "submitted": self.submitted,
+            "dispatched": self.dispatched,
+            "dropped": self.dropped,
+        }
+
+
+class WebSocketHub:
+    """
+    管理所有房间和地图客户端
+    客户端通过 /ws?room=<名称> 加入房间，不指定时加入默认房间；main_app 的指令默认发往默认房间。
+    房间在本进程有客户端时订阅背板，除默认房间外，最后一个客户端离开后房间即被释放。
+    除 broadcast_threadsafe 外，所有方法都只能在事件循环线程中调用。
+    """
+
+    def __init__(self, initial_map_name: str = "default_map", queue_size: int = DEFAULT_QUEUE_SIZE,
+                 drop_policy: str = DEFAULT_DROP_POLICY, backplane: Optional[Backplane] = None,
+                 journal: Optional[StateJournal] = None):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"未知的丢弃策略: {drop_policy}")
+        self.initial_map_name = initial_map_name
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.backplane: Backplane = None
+        self.use_backplane(backplane or create_backplane())
+        self.journal = journal
+        # 本进程其他线程（main_app 的 OCR 自动跳转、方向按钮等）发来的指令
+        self.commands = CommandChannel(self.dispatch_local)
+        # 已释放或从日志恢复但尚无客户端的房间: 房间名 -> (状态, 序号, 历史)
+        self._dormant: "OrderedDict[str, Any]" = OrderedDict()
+        self.rooms: Dict[str, Room] = {}
+        self.default_room = self.get_room(DEFAULT_ROOM)
+        # 所有房间的客户端
+        self.clients: Set[ClientConnection] = set()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client_ids = itertools.count(1)
+        # 已断开客户端的丢弃计数，保证 /api/status 中的总数不会因断开而减少
+        self.dropped_from_closed = 0
+        self.slow_disconnects = 0
+        # 已释放房间的计数，同样计入总数
+        self._released_totals = dict.fromkeys(ROOM_COUNTERS, 0)
+        self.rooms_released = 0
+        # 等待移除的断开客户端，在下一轮事件循环中统一处理
+        self._closing: Set[ClientConnection] = set()
+        self._reap_scheduled = False
+
+    @property
+    def map_state(self) -> Dict[str, Any]:
+        """默认房间的地图状态"""
+        return self.default_room.map_state
+
+    def use_backplane(self, backplane: Backplane):
+        """更换背板，需在服务器启动前调用"""
+        self.backplane = backplane
+        backplane.attach(self)
+
+    def _publish(self, room: str, message: Dict[str, Any], exclude_id: Optional[int] = None):
+        self.backplane.publish(room, message, exclude_id)
+
+    def _record(self, room: str, message: Dict[str, Any]):
+        if self.journal is not None:
+            self.journal.record(room, message)
+
+    # --- 房间 ---
+    def get_room(self, name: str) -> Room:
+        """返回指定房间，不存在时创建（尚未订阅背板）"""
+        room = self.rooms.get(name)
+        if room is None:
+            room = Room(name, self.initial_map_name, self._publish, self._record)
+            dormant = self._dormant.pop(name, None)
+            if dormant is not None:
+                room.restore(*dormant)
+            self.rooms[name] = room
+        return room
+
+    def _subscribe(self, room: Room) -> asyncio.Future:
+        """订阅房间的背板事件并载入快照；订阅失败时下次调用重新订阅"""
+        subscription = room.subscription
+        if subscription is None or (subscription.done() and subscription.exception() is not None):
+            room.subscription = subscription = asyncio.ensure_future(self._join_backplane(room))
+        return subscription
+
+    async def _join_backplane(self, room: Room):
+        snapshot = await self.backplane.join(room.name, room.map_state, room.sequence)
+        room.load_snapshot(snapshot, self.backplane.worker_id)
+
+    async def join_room(self, name: str) -> Room:
+        """返回已订阅背板的房间，不存在时创建"""
+        room = self.get_room(name)
+        await self._subscribe(room)
+        return room
+
+    def _release_room(self, room: Room):
+        """释放没有客户端的房间（默认房间始终保留）"""
+        if room.clients or room is self.default_room or self.rooms.get(room.name) is not room:
+            return
+        room.close()
+        del self.rooms[room.name]
+        if room.subscription is not None and room.subscription.done():
+            self.backplane.leave(room.name)
+        self._keep_dormant(room.name, dict(room.map_state), room.sequence, list(room.history))
+        for counter in ROOM_COUNTERS:
+            self._released_totals[counter] += getattr(room, counter)
+        self.rooms_released += 1
+
+    def _keep_dormant(self, name: str, state: Dict[str, Any], sequence: int, history):
+        self._dormant[name] = (state, sequence, history)
+        self._dormant.move_to_end(name)
+        while len(self._dormant) > DORMANT_ROOMS_LIMIT:
+            self._dormant.popitem(last=False)
+
+    def _restore_journal(self):
+        """从状态日志恢复房间（只在第一次启动时读取磁盘）"""
+        for name, restored in self.journal.restore().items():
+            if name in self.rooms:
+                self.rooms[name].restore(restored["state"], restored["seq"], restored["history"])
+            else:
+                self._keep_dormant(name, restored["state"], restored["seq"], restored["history"])
+
+    # --- 应用生命周期 ---
+    async def on_startup(self, app: web.Application):
+        if self.journal is not None:
+            self._restore_journal()
+            self.journal.start()
+        await self.backplane.start()
+        await self.join_room(DEFAULT_ROOM)
+        self.loop = asyncio.get_running_loop()
+        self.commands.start()
+
+    async def on_shutdown(self, app: web.Application):
+        """停止服务器时主动关闭所有连接，避免等待客户端超时"""
+        self.loop = None
+        await self.commands.stop()
+        for room in self.rooms.values():
+            room.close()
+        for client in list(self.clients):
+            client.close()
+            await client.ws.close(code=1001, message=b'Server shutdown')
+            client.room.clients.discard(client)
+        self.clients.clear()
+        for room in list(self.rooms.values()):
+            self._release_room(room)
+        await self.backplane.stop()
+        if self.journal is not None:
+            # 写入剩余事件和最后的快照
+            await asyncio.to_thread(self.journal.stop)
+        # 重新启动时默认房间重新订阅背板
+        self.default_room.subscription = None
+        self.default_room.remote_counts.clear()
+
+    # --- 背板回调 ---
+    def on_backplane_event(self, room: str, message: Dict[str, Any], from_self: bool, exclude: Optional[int]):
+        target = self.rooms.get(room)
+        if target is not None:
+            # 客户端 id 只在本进程内唯一，只排除本进程发出的事件的发送者
+            target.apply_event(message, exclude if from_self else None)
+
+    def on_backplane_presence(self, room: str, worker: str, count: int):
+        target = self.rooms.get(room)
+        if target is None:
+            return
+        if count:
+            target.remote_counts[worker] = count
+        else:
+            target.remote_counts.pop(worker, None)
+        target.broadcast_client_count()
+
+    def backplane_room_state(self, room: str):
+        target = self.rooms.get(room)
+        if target is None:
+            return None
+        return dict(target.map_state), target.sequence
+
+    def on_backplane_snapshot(self, room: str, snapshot: Dict[str, Any]):
+        target = self.rooms.get(room)
+        if target is not None:
+            target.load_snapshot(snapshot, self.backplane.worker_id)
+            target.broadcast({"type": "initialState", **target.map_state, "seq": target.sequence})
+
+    # --- 广播 ---
+    def broadcast(self, message: Dict[str, Any], exclude: Optional[ClientConnection] = None,
+                  room: str = DEFAULT_ROOM):
+        """经背板向一个房间的所有客户端广播，房间不存在时忽略"""
+        if room in self.rooms:
+            self._publish(room, message, exclude.id if exclude is not None else None)
+
+    def broadcast_threadsafe(self, message: Dict[str, Any], room: str = DEFAULT_ROOM) -> bool:
+        """从其他线程（如 Qt 界面线程）向一个房间发送状态或指令，不等待发送；服务器未运行时返回 False"""
+        return self.commands.submit(message, room)
+
+    def dispatch_local(self, room: str, message: Dict[str, Any]):
+        """处理本进程发出的消息；房间不存在时创建，订阅背板完成后再处理（保持消息顺序）"""
+        target = self.get_room(room)
+        subscription = self._subscribe(target)
+        if subscription.done():
+            target.handle_message(None, message)
+        else:
+            subscription.add_done_callback(lambda _: target.handle_message(None, message))
+
+    def schedule_removal(self, client: ClientConnection):
+        """登记断开的客户端；同一轮中断开的所有客户端只触发一次移除，每个房间只广播一次数量"""
+        self._closing.add(client)
+        if not self._reap_scheduled:
+            self._reap_scheduled = True
+            asyncio.get_running_loop().call_soon(self._reap_clients)
+
+    def _reap_clients(self):
+        self._reap_scheduled = False
+        closing, self._closing = self._closing, set()
+        affected: Set[Room] = set()
+        for client in closing:
+            if client in self.clients:
+                self.clients.discard(client)
+                client.room.clients.discard(client)
+                client.close()
+                self.dropped_from_closed += client.messages_dropped
+                self.slow_disconnects += client.disconnected_slow
+                affected.add(client.room)
+        for room in affected:
+            if room.clients or room is self.default_room:
+                self.backplane.presence(room.name, len(room.clients))
+                room.broadcast_client_count()
+            else:
+                self._release_room(room)
+
+    # --- WebSocket 连接 ---
+    async def handle_ws(self, request: web.Request) -> web.WebSocketResponse:
+        room_name = request.query.get('room') or DEFAULT_ROOM
+        if not ROOM_NAME_PATTERN.fullmatch(room_name):
+            raise web.HTTPBadRequest(text=f"无效的房间名: {room_name}")
+        ws = web.WebSocketResponse(heartbeat=30, protocols=available_subprotocols())
+        await ws.prepare(request)
+        codec = negotiate_codec(ws.ws_protocol, request.query.getall('codec', []))
+
+        try:
+            room = await self.join_room(room_name)
+        except ConnectionError as e:
+            await ws.close(code=1011, message=b'Backplane unavailable')
+            print(f"加入房间 {room_name} 失败: {e}")
+            return ws
+        client = ClientConnection(next(self._client_ids), ws, self.queue_size, self.drop_policy,
+                                  codec, on_failed=self.schedule_removal)
+        client.room = room
+        print(f"客户端 {client.id} 已连接 (房间: {room.name}, 编码: {codec.name})")
+        self.clients.add(client)
+        room.clients.add(client)
+        client.sender_task = asyncio.create_task(client.run_sender())
+        # 新客户端收到房间当前的完整状态（附带当前序号）；带 ?since= 重连的客户端只补发错过的变化
+        since = request.query.get('since')
+        room.catch_up(client, int(since) if since and since.isdigit() else None)
+        self.backplane.presence(room.name, len(room.clients))
+        room.broadcast_client_count()
+
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    payload_codec = JSON_CODEC
+                elif msg.type == WSMsgType.BINARY:
+                    payload_codec = client.codec
+                else:
+                    continue
+                try:
+                    data = payload_codec.decode(msg.data)
+                except Exception:
+                    print(f"客户端 {client.id} 发送了无法解析的消息")
+                    continue
+                room.handle_message(client, data)
+        except Exception as e:
+            print(f"WebSocket连接出现错误: {e}")
+        finally:
+            print(f"客户端 {client.id} 已断开")
+            self.schedule_removal(client)
+        return ws
+
+    # --- 状态 ---
+    def status(self) -> Dict[str, Any]:
+        client_stats = [client.stats() for client in self.clients]
+        depths = [item["queue_depth"] for item in client_stats]
+        totals = dict(self._released_totals)
+        for room in self.rooms.values():
+            for counter in ROOM_COUNTERS:
+                totals[counter] += getattr(room, counter)
+        room_stats = [room.status() for room in self.rooms.values()]
+        return {
+            "clients_count": len(self.clients),
+            "map_state": self.default_room.map_state,
+            "messages_received": totals["messages_received"],
+            "messages_broadcast": totals["messages_broadcast"],
+            "sequence": self.default_room.sequence,
+            "coalescing": {
+                "interval_ms": COALESCE_INTERVAL_SECONDS * 1000,
+                "updates_received": totals["state_updates_received"],
+                "updates_broadcast": totals["state_updates_broadcast"],
+            },
+            "queues": {
+                "max_size": self.queue_size,
+                "drop_policy": self.drop_policy,
+                "total_depth": sum(depths),
+                "max_depth": max(depths, default=0),
+                "dropped": self.dropped_from_closed + sum(item["dropped"] for item in client_stats),
+                "slow_disconnects": self.slow_disconnects,
+                "clients": client_stats,
+            },
+            "rooms": {
+                "count": len(self.rooms),
+                "released": self.rooms_released,
+                "largest": max((item["clients_count"] for item in room_stats), default=0),
+                "list": room_stats,
+            },
+            "backplane": self.backplane.stats(),
+            "journal": self.journal.stats() if self.journal is not None else None,
+            "commands": self.commands.stats(),
+        }
+
+
+# --- 全局 WebSocket 中心（main_app 和 server.py 独立运行时共用）---
+map_registry = get_map_registry(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maps.json'))
+map_names = map_registry.names()
+# 状态日志由启动服务器的一方 (hosting.ServerHost / create_app) 在应用数据目录中创建，导入时不创建
+hub = WebSocketHub(map_names[0] if map_names else "default_map")
+# 兼容旧代码直接访问的全局变量（map_state 为默认房间的状态）
+clients = hub.clients
+map_state = hub.map_state
+
+
+def broadcast(message_dict: Dict[str, Any], room: str = DEFAULT_ROOM) -> bool:
+    """线程安全的广播入口，放入发送队列后立即返回"""
+    return hub.broadcast_threadsafe(message_dict, room)
+
+
+# --- HTTP 路由 ---
+async def index(request: web.Request) -> web.Response:
+    sync_hub = request.app['hub']
+    return web.json_response({
         "message": "WutheringWaves Navigator WebSocket Server",
         "status": "running",
-        "clients": len(clients),
-        "current_state": map_state
+        "clients": len(sync_hub.clients),
+        "current_state": sync_hub.map_state
     })
 
-@app.route('/api/status')
-def api_status():
-    return jsonify({
-        "clients_count": len(clients),
-        "map_state": map_state
-    })
 
-# --- 6. 启动服务器 (保持不变) ---
+async def api_status(request: web.Request) -> web.Response:
+    return web.json_response(request.app['hub'].status())
+
+
+def add_sync_routes(app: web.Application, sync_hub: Optional[WebSocketHub] = None):
+    """在应用中注册 /ws、/api 和 /api/status，并把同步中心的启动和停止挂到应用上"""
+    sync_hub = sync_hub or hub
+    app['hub'] = sync_hub
+    app.router.add_get('/api', index)
+    app.router.add_get('/api/status', api_status)
+    app.router.add_get('/ws', sync_hub.handle_ws)
+    app.on_startup.append(sync_hub.on_startup)
+    app.on_shutdown.append(sync_hub.on_shutdown)
+
+
+def create_app(sync_hub: Optional[WebSocketHub] = None, journal_dir: Optional[str] = None) -> web.Application:
+    """
+    创建只有同步服务的 aiohttp 应用（每次启动服务器都需要新的应用实例），文件服务见 hosting.create_site_app
+    指定 journal_dir 且同步中心还没有状态日志时在该目录中记录状态日志
+    """
+    sync_hub = sync_hub or hub
+    if journal_dir and sync_hub.journal is None:
+        sync_hub.journal = StateJournal(journal_dir)
+    app = web.Application()
+    app.router.add_get('/', index)
+    add_sync_routes(app, sync_hub)
+    return app
+
+
+# --- 独立启动 ---
 if __name__ == '__main__':
-    print("服务器启动于 http://127.0.0.1:8080")
+    parser = argparse.ArgumentParser(description="地图同步 WebSocket 服务器")
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f"监听地址 (默认: {DEFAULT_HOST}，仅本机)")
+    parser.add_argument('--lan', action='store_true', help="监听所有地址 (0.0.0.0)，允许局域网设备访问")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"监听端口 (默认: {DEFAULT_PORT})")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help="每个客户端的发送队列上限")
+    parser.add_argument('--drop-policy', default=DEFAULT_DROP_POLICY, choices=DROP_POLICIES,
+                        help="发送队列满时的处理方式")
+    parser.add_argument('--broker', default=None,
+                        help="背板代理地址 host:port（多个服务器进程共享房间时使用，默认只在本进程内同步）")
+    parser.add_argument('--journal', default=None,
+                        help="状态日志和快照目录 (默认: 应用数据目录中的 sync_journal)")
+    parser.add_argument('--no-journal', action='store_true', help="不记录状态日志，重启后从初始状态开始")
+    args = parser.parse_args()
+
+    from hosting import default_data_dir, JOURNAL_DIR_NAME, LAN_HOST
+    host = LAN_HOST if args.lan else args.host
+    journal_dir = None if args.no_journal else (args.journal or os.path.join(default_data_dir(), JOURNAL_DIR_NAME))
+    hub.queue_size = args.queue_size
+    hub.drop_policy = args.drop_policy
+    hub.use_backplane(create_backplane(args.broker))
+    print(f"服务器启动于 http://127.0.0.1:{args.port}")
     print("请在另一个浏览器窗口或设备上打开 index.html")
-    app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    web.run_app(create_app(journal_dir=journal_dir), host=host, port=args.port)
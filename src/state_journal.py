@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同步状态日志
+把改变房间状态的消息 (stateUpdate / mapChange) 追加写入日志，并定期写入紧凑快照，服务器重启后据此恢复：
+- record() 只把事件放入内存队列，由后台写入线程落盘，广播路径不等待磁盘
+- 快照写临时文件后原子替换；每次快照开始一个新的日志段 (events-<代>.log)，恢复时只需读取快照和当前日志段
+- 日志最后一行可能因崩溃只写了一半，恢复时忽略无法解析的行
+
+目录结构:
+  snapshot.json       {"generation": 代, "rooms": {房间: {"state": 地图状态, "seq": 序号}}}
+  events-<代>.log     每行一个事件 {"room": 房间, "message": 消息}
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+SNAPSHOT_FILE = 'snapshot.json'
+LOG_PREFIX = 'events-'
+LOG_SUFFIX = '.log'
+# 日志段累计这么多事件后写快照并开始新段
+SNAPSHOT_EVERY_EVENTS = 5000
+# 有新事件时至少每隔这么久写一次快照
+SNAPSHOT_INTERVAL_SECONDS = 60.0
+# 两次 fsync 之间的最短间隔（进程崩溃不丢数据，断电最多丢失这段时间的事件）
+FSYNC_INTERVAL_SECONDS = 1.0
+# 恢复时为每个房间保留的最近事件数，供重连客户端补发
+RESTORED_HISTORY = 1024
+# 参与 stateUpdate 的状态字段
+STATE_FIELDS = ('lat', 'lng', 'zoom')
+
+_STOP = object()
+
+
+def apply_message(room_state: Dict[str, Any], message: Dict[str, Any]):
+    """把一条状态消息应用到 {"state", "seq"}"""
+    fields = {k: v for k, v in message.items() if k not in ('type', 'seq')}
+    if message.get('type') == 'stateUpdate':
+        fields = {k: v for k, v in fields.items() if k in STATE_FIELDS}
+    room_state["state"].update(fields)
+    if 'seq' in message:
+        room_state["seq"] = message['seq']
+
+
+class StateJournal:
+    """
+    状态日志和快照
+    restore() 在服务器启动时调用一次，start() 启动后台写入线程，stop() 写入最后的快照并停止。
+    """
+
+    def __init__(self, directory: str, snapshot_every: int = SNAPSHOT_EVERY_EVENTS,
+                 snapshot_interval: float = SNAPSHOT_INTERVAL_SECONDS):
+        self.directory = os.path.abspath(directory)
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        # 写入线程维护的房间状态，与已写入的日志保持一致
+        self._rooms: Dict[str, Dict[str, Any]] = {}
+        self._generation = 0
+        self._log = None
+        self._events_in_segment = 0
+        self._last_snapshot = 0.0
+        self._last_fsync = 0.0
+        self._restored = False
+        self.events_written = 0
+        self.snapshots_written = 0
+        self.write_errors = 0
+
+    # --- 恢复 ---
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f'{LOG_PREFIX}{generation}{LOG_SUFFIX}')
+
+    def restore(self) -> Dict[str, Dict[str, Any]]:
+        """
+        读取快照和当前日志段，返回 {房间: {"state", "seq", "history"}}，history 为最近的事件
+        只在第一次调用时读取磁盘，之后返回空字典（内存中的状态已是最新）。
+        """
+        if self._restored:
+            return {}
+        self._restored = True
+        os.makedirs(self.directory, exist_ok=True)
+        rooms: Dict[str, Dict[str, Any]] = {}
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        try:
+            with open(snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self._generation = int(snapshot.get("generation", 0))
+            for name, room in (snapshot.get("rooms") or {}).items():
+                rooms[name] = {"state": dict(room.get("state") or {}), "seq": int(room.get("seq", 0))}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            print(f"读取状态快照失败，只从日志恢复: {e}")
+
+        histories: Dict[str, Deque] = {}
+        replayed = 0
+        try:
+            with open(self._log_path(self._generation), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                        name, message = event["room"], event["message"]
+                    except (ValueError, KeyError, TypeError):
+                        continue  # 崩溃时写了一半的行
+                    room = rooms.setdefault(name, {"state": {}, "seq": 0})
+                    apply_message(room, message)
+                    histories.setdefault(name, deque(maxlen=RESTORED_HISTORY)).append(message)
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+
+        self._remove_stale_logs()
+        self._rooms = {name: {"state": dict(room["state"]), "seq": room["seq"]} for name, room in rooms.items()}
+        self._events_in_segment = replayed
+        for name, room in rooms.items():
+            room["history"] = list(histories.get(name, ()))
+        if rooms:
+            print(f"已从状态日志恢复 {len(rooms)} 个房间 (日志段 {self._generation} 中 {replayed} 个事件)")
+        return rooms
+
+    def _remove_stale_logs(self):
+        """删除快照之前的日志段（写快照后、删除旧段前崩溃时会留下）"""
+        current = os.path.basename(self._log_path(self._generation))
+        for name in os.listdir(self.directory):
+            if name.startswith(LOG_PREFIX) and name.endswith(LOG_SUFFIX) and name != current:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    # --- 写入 ---
+    def record(self, room: str, message: Dict[str, Any]):
+        """登记一条状态事件，立即返回"""
+        self._queue.put((room, message))
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if not self._restored:
+            self.restore()
+        self._thread = threading.Thread(target=self._run, name="StateJournalWriter", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """写完队列中的事件和最后的快照后停止写入线程"""
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._log = open(self._log_path(self._generation), 'a', encoding='utf-8')
+        self._last_snapshot = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self._time_to_next_snapshot())
+                except queue.Empty:
+                    item = None
+                stopping = item is _STOP
+                if item is not None and not stopping:
+                    batch = [item]
+                    # 一次取出队列中所有积压的事件，合并为一次写入
+                    while True:
+                        try:
+                            item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is _STOP:
+                            stopping = True
+                            break
+                        batch.append(item)
+                    self._write_batch(batch)
+                if stopping or self._snapshot_due():
+                    self._write_snapshot()
+                if stopping:
+                    return
+        finally:
+            self._log.close()
+            self._log = None
+
+    def _time_to_next_snapshot(self) -> float:
+        if not self._events_in_segment:
+            return self.snapshot_interval
+        return max(0.01, self.snapshot_interval - (time.monotonic() - self._last_snapshot))
+
+    def _snapshot_due(self) -> bool:
+        if not self._events_in_segment:
+            return False
+        return (self._events_in_segment >= self.snapshot_every
+                or time.monotonic() - self._last_snapshot >= self.snapshot_interval)
+
+    def _write_batch(self, batch):
+        lines = []
+        for name, message in batch:
+            room = self._rooms.setdefault(name, {"state": {}, "seq": 0})
+            apply_message(room, message)
+            lines.append(json.dumps({"room": name, "message": message}, ensure_ascii=False, separators=(',', ':')))
+        try:
+            self._log.write('\n'.join(lines) + '\n')
+            self._log.flush()
+            now = time.monotonic()
+            if now - self._last_fsync >= FSYNC_INTERVAL_SECONDS:
+                os.fsync(self._log.fileno())
+                self._last_fsync = now
+        except OSError as e:
+            self.write_errors += 1
+            print(f"写入状态日志失败: {e}")
+            return
+        self._events_in_segment += len(batch)
+        self.events_written += len(batch)
+
+    def _write_snapshot(self):
+        """写入新一代快照，然后切换到新的日志段并删除旧段"""
+        generation = self._generation + 1
+        snapshot = {"generation": generation, "rooms": self._rooms}
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.write_errors += 1
+            print(f"写入状态快照失败: {e}")
+            return
+        old_log_path = self._log_path(self._generation)
+        self._log.close()
+        self._generation = generation
+        self._log = open(self._log_path(generation), 'a', encoding='utf-8')
+        try:
+            os.remove(old_log_path)
+        except OSError:
+            pass
+        self._events_in_segment = 0
+        self._last_snapshot = time.monotonic()
+        self.snapshots_written += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "generation": self._generation,
+            "pending": self._queue.qsize(),
+            "events_written": self.events_written,
+            "events_in_segment": self._events_in_segment,
+            "snapshots_written": self.snapshots_written,
+            "write_errors": self.write_errors,
+        }
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+静态资源层
+为 index.html、maps.json、脚本和样式表等小文件提供可缓存的响应：
+- 文件内容、强校验 ETag（内容哈希）和压缩后的 gzip / brotli 版本按文件的 (mtime, size) 缓存在内存中，文件变化后自动重新载入
+- 同目录下已有比源文件新的 .br / .gz 预压缩文件时直接使用，否则在载入时压缩一次（brotli 需要安装 brotli 模块）
+- 按 Accept-Encoding 选择版本并带 Vary: Accept-Encoding，If-None-Match 命中时返回 304
+- 内容哈希同时作为文件的版本号 (version)，请求带 ?v=<版本号> 且与当前版本一致时可以长期缓存
+
+图片等不可压缩或较大的文件不进入内存缓存，由调用方交给 aiohttp 的 FileResponse 处理。
+"""
+
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODING_BROTLI = 'br'
+ENCODING_GZIP = 'gzip'
+ENCODING_IDENTITY = 'identity'
+# 预压缩文件的扩展名
+PRECOMPRESSED_SUFFIXES = {ENCODING_BROTLI: '.br', ENCODING_GZIP: '.gz'}
+# ETag 中区分不同编码版本的后缀（同一资源的不同编码必须有不同的强校验值）
+ETAG_SUFFIXES = {ENCODING_IDENTITY: '', ENCODING_BROTLI: '-br', ENCODING_GZIP: '-gz'}
+
+# 进入内存缓存的文件类型和大小上限
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+MAX_ASSET_BYTES = 4 * 1024 * 1024
+# 小于该大小的文件压缩收益不足以抵消解压开销
+MIN_COMPRESS_BYTES = 512
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# 未带版本号的请求每次都向服务器验证（未变化时只返回 304），带当前版本号的请求长期缓存
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+VERSIONED_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# 不进入内存缓存的文件（图片等）
+DEFAULT_CACHE_CONTROL = 'public, max-age=3600'
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def guess_content_type(path: str) -> str:
+    content_type, _ = mimetypes.guess_type(path)
+    return content_type or 'application/octet-stream'
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """把 Accept-Encoding 解析为 {编码: q 值}"""
+    accepted = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 使用弱比较：W/ 前缀不影响匹配"""
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate == etag or candidate == 'W/' + etag:
+            return True
+    return False
+
+
+class Asset:
+    """一个已载入的静态文件及其各编码版本"""
+    __slots__ = ('path', 'signature', 'content_type', 'version', 'variants')
+
+    def __init__(self, path: str, signature: Tuple[int, int], content_type: str, data: bytes):
+        self.path = path
+        self.signature = signature
+        self.content_type = content_type
+        self.version = hashlib.blake2b(data, digest_size=8).hexdigest()
+        # 编码 -> (数据, ETag)
+        self.variants: Dict[str, Tuple[bytes, str]] = {}
+        self._add_variant(ENCODING_IDENTITY, data)
+        if len(data) >= MIN_COMPRESS_BYTES:
+            self._add_compressed_variants(data)
+
+    def _add_variant(self, encoding: str, data: bytes):
+        self.variants[encoding] = (data, f'"{self.version}{ETAG_SUFFIXES[encoding]}"')
+
+    def _add_compressed_variants(self, data: bytes):
+        for encoding, suffix in PRECOMPRESSED_SUFFIXES.items():
+            compressed = self._read_precompressed(self.path + suffix)
+            if compressed is None:
+                if encoding == ENCODING_GZIP:
+                    # mtime=0 使相同内容的压缩结果完全一致
+                    compressed = gzip.compress(data, GZIP_LEVEL, mtime=0)
+                elif brotli is not None:
+                    compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+            if compressed is not None and len(compressed) < len(data):
+                self._add_variant(encoding, compressed)
+
+    def _read_precompressed(self, path: str) -> Optional[bytes]:
+        """读取比源文件新的预压缩文件"""
+        try:
+            if os.stat(path).st_mtime_ns < self.signature[0]:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def select(self, accept_encoding: str) -> Tuple[str, bytes, str]:
+        """按 Accept-Encoding 选择最小的可接受版本，返回 (编码, 数据, ETag)"""
+        if len(self.variants) > 1 and accept_encoding:
+            accepted = parse_accept_encoding(accept_encoding)
+            for encoding in (ENCODING_BROTLI, ENCODING_GZIP):
+                if encoding in self.variants and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                    data, etag = self.variants[encoding]
+                    return encoding, data, etag
+        data, etag = self.variants[ENCODING_IDENTITY]
+        return ENCODING_IDENTITY, data, etag
+
+    def size(self) -> int:
+        return sum(len(data) for data, _ in self.variants.values())
+
+
+class StaticAssets:
+    """按路径缓存的静态资源，线程安全"""
+
+    def __init__(self, max_asset_bytes: int = MAX_ASSET_BYTES):
+        self.max_asset_bytes = max_asset_bytes
+        self._assets: Dict[str, Asset] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def _signature(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def peek(self, path: str) -> Optional[Asset]:
+        """返回仍然有效的已缓存资源（只做一次 stat），需要重新载入时返回 None"""
+        asset = self._assets.get(path)
+        if asset is not None and asset.signature == self._signature(path):
+            return asset
+        return None
+
+    def load(self, path: str) -> Optional[Asset]:
+        """读取并缓存资源；文件不存在、不是可压缩类型或超过大小上限时返回 None"""
+        asset = self.peek(path)
+        if asset is not None:
+            return asset
+        content_type = guess_content_type(path)
+        signature = self._signature(path)
+        if signature is None or not is_compressible(content_type) or signature[1] > self.max_asset_bytes:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        asset = Asset(path, signature, content_type, data)
+        with self._lock:
+            self._assets[path] = asset
+            self.loads += 1
+        return asset
+
+    def version(self, path: str) -> Optional[str]:
+        """文件的内容版本号（内容哈希），文件不存在时返回 None"""
+        asset = self.load(path)
+        return asset.version if asset is not None else None
+
+    def invalidate(self, path: Optional[str] = None):
+        with self._lock:
+            if path is None:
+                self._assets.clear()
+            else:
+                self._assets.pop(path, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._assets),
+                "bytes": sum(asset.size() for asset in self._assets.values()),
+                "loads": self.loads,
+                "not_modified": self.not_modified,
+            }
+
+    def respond(self, request: web.Request, asset: Asset) -> web.Response:
+        """生成 200 或 304 响应；请求的 ?v= 与当前版本一致时允许长期缓存"""
+        encoding, data, etag = asset.select(request.headers.get('Accept-Encoding', ''))
+        cache_control = VERSIONED_CACHE_CONTROL if request.query.get('v') == asset.version else REVALIDATE_CACHE_CONTROL
+        headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if etag_matches(request.headers.get('If-None-Match', ''), etag):
+            self.not_modified += 1
+            return web.Response(status=304, headers=headers)
+        if encoding != ENCODING_IDENTITY:
+            headers["Content-Encoding"] = encoding
+        response = web.Response(body=data, content_type=asset.content_type, headers=headers)
+        if asset.content_type.startswith('text/') or asset.content_type == 'application/json':
+            response.charset = 'utf-8'
+        return response
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+单文件瓦片归档
+把整张地图的瓦片金字塔写入一个带目录索引的文件（类似 PMTiles 的布局），
+避免生成成千上万个小文件，复制、删除和杀毒扫描都只需处理一个文件。
+
+文件布局:
+    [头部 8 字节魔数]
+    [瓦片数据 ...]            内容相同的瓦片只存一份（如透明边角瓦片）
+    [目录: N 条 (z, x, y, offset, length)]
+    [元数据 JSON]
+    [尾部: 目录偏移, 目录条数, 元数据偏移, 元数据长度, 魔数]
+"""
+
+import os
+import mmap
+import json
+import struct
+import hashlib
+import threading
+from typing import Dict, Optional, Tuple, Any
+
+ARCHIVE_EXT = '.wwtiles'
+ARCHIVE_MAGIC = b'WWTILES1'
+
+# 目录条目: z(uint8) + 3字节填充 + x(uint32) + y(uint32) + offset(uint64) + length(uint32)
+_ENTRY_STRUCT = struct.Struct('<B3xIIQI')
+# 尾部: 目录偏移 + 目录条数 + 元数据偏移 + 元数据长度 + 魔数
+_FOOTER_STRUCT = struct.Struct('<QIQI8s')
+
+
+class TileArchiveError(Exception):
+    """归档文件损坏或格式不正确"""
+
+
+def get_archive_path(tiles_dir: str, map_name: str) -> str:
+    """返回地图对应的归档文件路径"""
+    return os.path.join(tiles_dir, f'{map_name}{ARCHIVE_EXT}')
+
+
+class TileArchiveWriter:
+    """
+    顺序写入瓦片归档
+    先写入临时文件，close() 时再原子替换为正式文件，写入中途失败不会留下半个归档。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(ARCHIVE_MAGIC)
+        self._entries: Dict[Tuple[int, int, int], Tuple[int, int]] = {}
+        self._blobs: Dict[bytes, Tuple[int, int]] = {}
+        self.bytes_written = len(ARCHIVE_MAGIC)
+
+    def add_tile(self, z: int, x: int, y: int, data: bytes):
+        """追加一个瓦片，内容重复的瓦片只记录索引"""
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        location = self._blobs.get(digest)
+        if location is None:
+            offset = self._file.tell()
+            self._file.write(data)
+            location = (offset, len(data))
+            self._blobs[digest] = location
+            self.bytes_written += len(data)
+        self._entries[(z, x, y)] = location
+
+    @property
+    def tile_count(self) -> int:
+        return len(self._entries)
+
+    def close(self, metadata: Optional[Dict[str, Any]] = None):
+        """写入目录和元数据，并替换为正式文件"""
+        if self._file is None:
+            return
+        try:
+            directory_offset = self._file.tell()
+            for (z, x, y), (offset, length) in sorted(self._entries.items()):
+                self._file.write(_ENTRY_STRUCT.pack(z, x, y, offset, length))
+
+            metadata_bytes = json.dumps(metadata or {}, ensure_ascii=False).encode('utf-8')
+            metadata_offset = self._file.tell()
+            self._file.write(metadata_bytes)
+
+            self._file.write(_FOOTER_STRUCT.pack(
+                directory_offset, len(self._entries), metadata_offset, len(metadata_bytes), ARCHIVE_MAGIC
+            ))
+            self._file.close()
+            self._file = None
+            os.replace(self._tmp_path, self.path)
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        """放弃写入并删除临时文件"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class TileArchiveReader:
+    """
+    按 (z, x, y) 从归档中定位并读取瓦片
+    归档以只读方式内存映射，读取瓦片只是一次切片，无需 seek/read 系统调用，也无需加锁。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index, self.metadata = self._read_index()
+        except Exception:
+            if getattr(self, '_mmap', None) is not None:
+                self._mmap.close()
+            self._file.close()
+            raise
+
+    def _read_index(self):
+        data = self._mmap
+        if len(data) < len(ARCHIVE_MAGIC) + _FOOTER_STRUCT.size or data[:len(ARCHIVE_MAGIC)] != ARCHIVE_MAGIC:
+            raise TileArchiveError(f"不是有效的瓦片归档: {self.path}")
+
+        directory_offset, count, metadata_offset, metadata_length, magic = _FOOTER_STRUCT.unpack_from(
+            data, len(data) - _FOOTER_STRUCT.size
+        )
+        if magic != ARCHIVE_MAGIC:
+            raise TileArchiveError(f"瓦片归档尾部损坏: {self.path}")
+
+        raw_directory = data[directory_offset:directory_offset + count * _ENTRY_STRUCT.size]
+        index = {
+            (z, x, y): (offset, length)
+            for z, x, y, offset, length in _ENTRY_STRUCT.iter_unpack(raw_directory)
+        }
+
+        raw_metadata = data[metadata_offset:metadata_offset + metadata_length]
+        metadata = json.loads(raw_metadata.decode('utf-8') or '{}')
+        return index, metadata
+
+    def __contains__(self, key) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get_tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """读取瓦片数据，不存在时返回 None"""
+        location = self._index.get((z, x, y))
+        if location is None:
+            return None
+        offset, length = location
+        try:
+            return self._mmap[offset:offset + length]
+        except ValueError:
+            # 映射已在其他线程中关闭（地图被删除或重新生成）
+            return None
+
+    def close(self):
+        if not self._mmap.closed:
+            self._mmap.close()
+        if not self._file.closed:
+            self._file.close()
+
+
+class TileArchivePool:
+    """
+    本地服务器使用的归档读取器缓存
+    每张地图只打开一次归档，文件被重新生成（mtime 变化）后自动重新打开。
+    """
+
+    def __init__(self, tiles_dir: str):
+        self.tiles_dir = tiles_dir
+        self._readers: Dict[str, Tuple[float, TileArchiveReader]] = {}
+        self._lock = threading.Lock()
+
+    def get_reader(self, map_name: str) -> Optional[TileArchiveReader]:
+        """返回地图的归档读取器，地图不是归档存储时返回 None"""
+        path = get_archive_path(self.tiles_dir, map_name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            self.close(map_name)
+            return None
+
+        with self._lock:
+            cached = self._readers.get(map_name)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            if cached:
+                cached[1].close()
+            try:
+                reader = TileArchiveReader(path)
+            except (OSError, TileArchiveError, struct.error, ValueError) as e:
+                print(f"打开瓦片归档失败 {path}: {e}")
+                self._readers.pop(map_name, None)
+                return None
+            self._readers[map_name] = (mtime, reader)
+            return reader
+
+    def close(self, map_name: str):
+        """关闭地图的归档（删除或重新生成前调用，Windows 下打开的文件无法删除）"""
+        with self._lock:
+            cached = self._readers.pop(map_name, None)
+        if cached:
+            cached[1].close()
+
+    def close_all(self):
+        with self._lock:
+            readers = list(self._readers.values())
+            self._readers.clear()
+        for _, reader in readers:
+            reader.close()
@@ -1,19 +1,89 @@
 import os
-import json
-from PIL import Image
+import io
+from PIL import Image, features
 import math
 import shutil
 
+from tile_archive import TileArchiveWriter, get_archive_path
+from map_registry import get_map_registry
+
 # --- 配置 ---
 TILE_SIZE = 256
 MAX_IMAGE_SIZE_MB = 12
 MAX_DIMENSION = 8192
+# 切瓦片时同时存在的整图 RGBA 副本数（原图、转换后的 RGBA 和最高级别画布）
+DECODE_MEMORY_FACTOR = 3
 OUTPUT_TILES_DIR = 'tiles'
 OUTPUT_IMAGES_DIR = 'images'
 MAP_CONFIG_FILE = 'maps.json'
+DEFAULT_TILE_FORMAT = 'png'
+
+# 瓦片存储方式: directory - 每个瓦片一个文件; archive - 整张地图写入单个归档文件;
+# lazy - 只登记地图，瓦片由本地服务器在首次请求时渲染（见 lazy_tiles.py）
+TILE_STORAGE_DIRECTORY = 'directory'
+TILE_STORAGE_ARCHIVE = 'archive'
+TILE_STORAGE_LAZY = 'lazy'
+TILE_STORAGES = (TILE_STORAGE_DIRECTORY, TILE_STORAGE_ARCHIVE, TILE_STORAGE_LAZY)
+DEFAULT_TILE_STORAGE = TILE_STORAGE_DIRECTORY
+LAZY_SOURCE_NAME = 'source'
+
+# 瓦片编码格式: 名称 -> 文件扩展名 / Pillow 编码器 / 保存参数
+# png8 会先做调色板量化（保留透明通道），体积通常只有 RGBA PNG 的 1/3 左右
+TILE_FORMATS = {
+    'png': {'ext': 'png', 'encoder': 'PNG', 'params': {}, 'quantize': False},
+    'png8': {'ext': 'png', 'encoder': 'PNG', 'params': {'optimize': True}, 'quantize': True},
+    'webp': {'ext': 'webp', 'encoder': 'WEBP', 'params': {'quality': 80, 'method': 4}, 'quantize': False},
+    'webp_lossless': {'ext': 'webp', 'encoder': 'WEBP', 'params': {'lossless': True, 'quality': 100, 'method': 4}, 'quantize': False},
+    'avif': {'ext': 'avif', 'encoder': 'AVIF', 'params': {'quality': 60, 'speed': 6}, 'quantize': False},
+    # 仅用于导入现成的 JPEG 瓦片金字塔（派生缺失级别时保持原格式），不支持透明
+    'jpeg': {'ext': 'jpg', 'encoder': 'JPEG', 'params': {'quality': 85}, 'quantize': False},
+}
 
 Image.MAX_IMAGE_PIXELS = None
 
+class TileGenerationCancelled(Exception):
+    """地图生成在两个瓦片之间被取消"""
+
+def get_output_paths(base_dir=None):
+    """返回 (瓦片目录, 图片目录, maps.json 路径)；base_dir 为 None 时相对于当前目录"""
+    if base_dir is None:
+        return OUTPUT_TILES_DIR, OUTPUT_IMAGES_DIR, MAP_CONFIG_FILE
+    return (os.path.join(base_dir, OUTPUT_TILES_DIR), os.path.join(base_dir, OUTPUT_IMAGES_DIR),
+            os.path.join(base_dir, MAP_CONFIG_FILE))
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise TileGenerationCancelled()
+
+def is_tile_format_supported(tile_format):
+    """检查当前 Pillow 是否能编码指定的瓦片格式"""
+    if tile_format not in TILE_FORMATS:
+        return False
+    encoder = TILE_FORMATS[tile_format]['encoder']
+    if encoder == 'PNG':
+        return True
+    try:
+        return bool(features.check(encoder.lower()))
+    except ValueError:
+        # 旧版本 Pillow 不认识该特性名称
+        return False
+
+def get_available_tile_formats():
+    """返回当前环境可用的瓦片格式列表"""
+    return [name for name in TILE_FORMATS if is_tile_format_supported(name)]
+
+def encode_tile(tile_img, tile_format=DEFAULT_TILE_FORMAT):
+    """按指定格式把瓦片图像编码为字节串"""
+    spec = TILE_FORMATS[tile_format]
+    if spec['quantize']:
+        # FASTOCTREE 支持 RGBA，量化后透明区域仍然保持透明
+        tile_img = tile_img.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    elif spec['encoder'] == 'JPEG' and tile_img.mode != 'RGB':
+        tile_img = tile_img.convert('RGB')
+    buffer = io.BytesIO()
+    tile_img.save(buffer, spec['encoder'], **spec['params'])
+    return buffer.getvalue()
+
 def get_image_info(image_path):
     if not os.path.exists(image_path):
         print(f"错误: 文件 '{image_path}' 不存在。")
@@ -23,41 +93,85 @@ def get_image_info(image_path):
         width, height = img.size
     return file_size_mb, width, height
 
-def update_map_config(map_name, is_tiled, width, height, max_zoom):
-    config = []
-    if os.path.exists(MAP_CONFIG_FILE):
-        with open(MAP_CONFIG_FILE, 'r', encoding='utf-8') as f:
-            try:
-                config = json.load(f)
-            except json.JSONDecodeError:
-                print(f"警告: '{MAP_CONFIG_FILE}' 文件为空或格式错误，将创建新的配置。")
-                config = []
-
-
-    map_entry = next((item for item in config if item["name"] == map_name), None)
-    if map_entry:
-        map_entry["tiled"] = is_tiled
-        map_entry["width"] = width
-        map_entry["height"] = height
-        map_entry["maxZoom"] = max_zoom if is_tiled else 0
-    else:
-        config.append({
-            "name": map_name,
-            "tiled": is_tiled,
-            "width": width,
-            "height": height,
-            "maxZoom": max_zoom if is_tiled else 0
-        })
-    
-    with open(MAP_CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, indent=4, ensure_ascii=False)
-    print(f"'{MAP_CONFIG_FILE}' 已更新。")
+def estimate_decode_bytes(image_path, storage=DEFAULT_TILE_STORAGE):
+    """
+    process_image 处理该文件时解码整张图片所需内存的估计值（字节）
+    只有需要切瓦片的大图会整图解码（原图、RGBA 副本和最高级别的画布同时存在）；
+    瓦片目录、按需渲染、直接复制的小图和带概览的 TIFF 返回 0
+    """
+    if os.path.isdir(image_path) or storage == TILE_STORAGE_LAZY:
+        return 0
+    try:
+        file_size_mb = os.path.getsize(image_path) / (1024 * 1024)
+        with Image.open(image_path) as img:
+            width, height = img.size
+    except (OSError, ValueError):
+        return 0
+    if file_size_mb <= MAX_IMAGE_SIZE_MB and width <= MAX_DIMENSION and height <= MAX_DIMENSION:
+        return 0
+    if image_path.lower().endswith(('.tif', '.tiff')):
+        from pyramid_importer import is_pyramid_source
+        if is_pyramid_source(image_path):
+            return 0
+    return width * height * 4 * DECODE_MEMORY_FACTOR
+
+def calculate_max_zoom(width, height):
+    return math.ceil(math.log2(max(width, height) / TILE_SIZE))
+
+def count_pyramid_tiles(width, height):
+    """整个瓦片金字塔的瓦片总数，用于报告进度"""
+    max_zoom = calculate_max_zoom(width, height)
+    total = 0
+    for z in range(max_zoom + 1):
+        current_width = int(width / (2**(max_zoom - z)))
+        current_height = int(height / (2**(max_zoom - z)))
+        total += math.ceil(current_width / TILE_SIZE) * math.ceil(current_height / TILE_SIZE)
+    return total
 
-def process_image(image_path):
+def update_map_config(map_name, is_tiled, width, height, max_zoom, tile_format=None, storage=None,
+                      lazy_source=None, lazy=False, base_dir=None):
+    fields = {
+        "tiled": is_tiled,
+        "width": width,
+        "height": height,
+        "maxZoom": max_zoom if is_tiled else 0,
+        # 记录瓦片编码，前端据此拼接瓦片URL的扩展名
+        "tileFormat": None,
+        "tileExt": None,
+        "storage": None,
+        # 按需渲染的地图记录源图副本文件名，补全完成后由服务器移除这两个字段；
+        # 导入的瓦片金字塔缺少级别时只有 lazy 标记，缺失瓦片由子瓦片合成
+        "lazy": True if lazy_source or lazy else None,
+        "source": lazy_source or None,
+    }
+    if is_tiled:
+        tile_format = tile_format or DEFAULT_TILE_FORMAT
+        fields["tileFormat"] = tile_format
+        fields["tileExt"] = TILE_FORMATS[tile_format]['ext']
+        fields["storage"] = storage or DEFAULT_TILE_STORAGE
+
+    map_config_file = get_output_paths(base_dir)[2]
+    get_map_registry(map_config_file).update(map_name, fields)
+    print(f"'{map_config_file}' 已更新。")
+
+def process_image(image_path, tile_format=DEFAULT_TILE_FORMAT, storage=DEFAULT_TILE_STORAGE,
+                  base_dir=None, cancel_event=None, progress_callback=None):
+    """
+    导入一张地图。输出写入 base_dir 下的 tiles/、images/ 和 maps.json（默认为当前目录）；
+    cancel_event 被设置时在两个瓦片之间抛出 TileGenerationCancelled，
+    progress_callback(已完成, 总数) 在每个瓦片完成后调用。
+    """
     # --- 关键修改：使用不带扩展名的文件名作为地图ID ---
     map_identifier = os.path.splitext(os.path.basename(image_path))[0]
     original_map_name = os.path.basename(image_path)
 
+    # 现成的瓦片目录直接链接进瓦片目录，不再重新编码
+    if os.path.isdir(image_path):
+        from pyramid_importer import import_pyramid
+        import_pyramid(image_path, tile_format, base_dir=base_dir, cancel_event=cancel_event,
+                       progress_callback=progress_callback)
+        return
+
     file_size_mb, width, height = get_image_info(image_path)
 
     if file_size_mb is None:
@@ -68,21 +182,111 @@ def process_image(image_path):
     print(f"  - 文件大小: {file_size_mb:.2f} MB")
 
     if file_size_mb > MAX_IMAGE_SIZE_MB or width > MAX_DIMENSION or height > MAX_DIMENSION:
+        from pyramid_importer import is_pyramid_source, import_pyramid
+        if is_pyramid_source(image_path):
+            # 带内部概览的 TIFF: 各级别直接取自概览页
+            print("  - 结果: 检测到内部概览，按多分辨率源导入。")
+            import_pyramid(image_path, tile_format, base_dir=base_dir, cancel_event=cancel_event,
+                           progress_callback=progress_callback)
+            return
         print("  - 结果: 需要瓦片化处理。")
-        generate_tiles(image_path, map_identifier, width, height)
+        generate_tiles(image_path, map_identifier, width, height, tile_format, storage,
+                       base_dir, cancel_event, progress_callback)
     else:
         print("  - 结果: 作为普通图片处理。")
-        os.makedirs(OUTPUT_IMAGES_DIR, exist_ok=True)
-        shutil.copy(image_path, os.path.join(OUTPUT_IMAGES_DIR, original_map_name))
-        print(f"  - 图片已复制到 '{OUTPUT_IMAGES_DIR}/' 目录。")
+        images_dir = get_output_paths(base_dir)[1]
+        os.makedirs(images_dir, exist_ok=True)
+        shutil.copy(image_path, os.path.join(images_dir, original_map_name))
+        print(f"  - 图片已复制到 '{images_dir}/' 目录。")
         # 对于普通图片，我们仍然使用原始文件名进行配置
-        update_map_config(original_map_name, False, width, height, 0)
+        update_map_config(original_map_name, False, width, height, 0, base_dir=base_dir)
+        if progress_callback:
+            progress_callback(1, 1)
+
+def remove_map_tiles(map_identifier, base_dir=None):
+    """删除地图的瓦片目录和归档文件"""
+    tiles_dir = get_output_paths(base_dir)[0]
+    tile_folder = os.path.join(tiles_dir, map_identifier)
+    if os.path.isdir(tile_folder):
+        shutil.rmtree(tile_folder)
+    archive_path = get_archive_path(tiles_dir, map_identifier)
+    if os.path.exists(archive_path):
+        os.remove(archive_path)
 
-def generate_tiles(image_path, map_identifier, width, height):
+def generate_tiles(image_path, map_identifier, width, height, tile_format=DEFAULT_TILE_FORMAT,
+                   storage=DEFAULT_TILE_STORAGE, base_dir=None, cancel_event=None, progress_callback=None):
+    if not is_tile_format_supported(tile_format):
+        raise ValueError(f"不支持的瓦片格式: {tile_format}")
+    if storage not in TILE_STORAGES:
+        raise ValueError(f"不支持的瓦片存储方式: {storage}")
+    tile_ext = TILE_FORMATS[tile_format]['ext']
+    tiles_dir = get_output_paths(base_dir)[0]
+
+    # 切换存储方式或重新生成时，先清理旧的瓦片，避免服务器读到过期数据
+    remove_map_tiles(map_identifier, base_dir)
+
+    if storage == TILE_STORAGE_LAZY:
+        register_lazy_map(image_path, map_identifier, width, height, tile_format, base_dir)
+        if progress_callback:
+            progress_callback(1, 1)
+        return
+
+    archive_writer = None
+    if storage == TILE_STORAGE_ARCHIVE:
+        os.makedirs(tiles_dir, exist_ok=True)
+        archive_writer = TileArchiveWriter(get_archive_path(tiles_dir, map_identifier))
+
+    try:
+        max_zoom = _write_tile_pyramid(image_path, tiles_dir, map_identifier, width, height, tile_format,
+                                       tile_ext, archive_writer, cancel_event, progress_callback)
+    except Exception as e:
+        if archive_writer:
+            archive_writer.abort()
+        if isinstance(e, TileGenerationCancelled):
+            # 不保留生成了一半的瓦片目录
+            remove_map_tiles(map_identifier, base_dir)
+            print(f"  - 已取消 '{map_identifier}' 的瓦片生成。")
+        raise
+
+    if archive_writer:
+        archive_writer.close({
+            "name": map_identifier,
+            "width": width,
+            "height": height,
+            "maxZoom": max_zoom,
+            "tileFormat": tile_format,
+            "tileExt": tile_ext,
+        })
+        print(f"  - 瓦片化完成！{archive_writer.tile_count} 个瓦片已写入归档 '{archive_writer.path}'。")
+    else:
+        print(f"  - 瓦片化完成！所有瓦片已保存至 '{os.path.join(tiles_dir, map_identifier)}'。")
+    update_map_config(map_identifier, True, width, height, max_zoom, tile_format, storage, base_dir=base_dir)
+
+def register_lazy_map(image_path, map_identifier, width, height, tile_format=DEFAULT_TILE_FORMAT,
+                      base_dir=None):
+    """按需渲染模式: 只复制源图并立即更新 maps.json，瓦片在浏览时才生成"""
+    tile_folder = os.path.join(get_output_paths(base_dir)[0], map_identifier)
+    os.makedirs(tile_folder, exist_ok=True)
+    # 保存一份源图副本，原图之后被移动或删除也不影响渲染
+    source_name = LAZY_SOURCE_NAME + os.path.splitext(image_path)[1].lower()
+    shutil.copy(image_path, os.path.join(tile_folder, source_name))
+
+    max_zoom = calculate_max_zoom(width, height)
+    print(f"  - 计算得到最大缩放级别: {max_zoom}")
+    print(f"  - 按需渲染模式: 瓦片 ({tile_format}) 将在首次浏览时生成并由后台线程补全。")
+    update_map_config(map_identifier, True, width, height, max_zoom, tile_format,
+                      TILE_STORAGE_DIRECTORY, lazy_source=source_name, base_dir=base_dir)
+
+def _write_tile_pyramid(image_path, tiles_dir, map_identifier, width, height, tile_format, tile_ext,
+                        archive_writer=None, cancel_event=None, progress_callback=None):
+    """逐级缩放并切分瓦片，写入目录或归档，返回最大缩放级别"""
+    total_tiles = count_pyramid_tiles(width, height)
+    done_tiles = 0
     with Image.open(image_path) as original_img:
         img = original_img.convert("RGBA")
-        max_zoom = math.ceil(math.log2(max(width, height) / TILE_SIZE))
+        max_zoom = calculate_max_zoom(width, height)
         print(f"  - 计算得到最大缩放级别: {max_zoom}")
+        print(f"  - 瓦片格式: {tile_format} ({'单文件归档' if archive_writer else '独立文件'})")
 
         for z in range(max_zoom + 1):
             current_width = int(width / (2**(max_zoom - z)))
@@ -105,14 +309,11 @@ def generate_tiles(image_path, map_identifier, width, height):
             # ----------------------------------------------------
 
             for x in range(cols):
-                for y in range(rows):
-                    tile_dir = os.path.join(OUTPUT_TILES_DIR, map_identifier, str(z), str(x))
+                if archive_writer is None:
+                    tile_dir = os.path.join(tiles_dir, map_identifier, str(z), str(x))
                     os.makedirs(tile_dir, exist_ok=True)
-                    tile_path = os.path.join(tile_dir, f'{y}.png')
-                    
-                    # 即使文件存在也重新生成，以确保是新逻辑生成的
-                    # if os.path.exists(tile_path): continue
-                    
+                for y in range(rows):
+                    check_cancelled(cancel_event)
                     left = x * TILE_SIZE
                     top = y * TILE_SIZE
                     right = left + TILE_SIZE
@@ -120,18 +321,35 @@ def generate_tiles(image_path, map_identifier, width, height):
                     
                     # --- 从大画布上裁剪瓦片，而不是从缩放图上裁剪 ---
                     tile_img = canvas_img.crop((left, top, right, bottom))
-                    tile_img.save(tile_path, 'PNG')
-        
-        print(f"  - 瓦片化完成！所有瓦片已保存至 '{os.path.join(OUTPUT_TILES_DIR, map_identifier)}'。")
-        update_map_config(map_identifier, True, width, height, max_zoom)
+                    tile_data = encode_tile(tile_img, tile_format)
+                    if archive_writer is not None:
+                        archive_writer.add_tile(z, x, y, tile_data)
+                    else:
+                        with open(os.path.join(tile_dir, f'{y}.{tile_ext}'), 'wb') as f:
+                            f.write(tile_data)
+                    done_tiles += 1
+                    if progress_callback:
+                        progress_callback(done_tiles, total_tiles)
+
+        return max_zoom
 
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) < 2:
-        print("使用方法: python tile_generator.py <图片1.jpg> [图片2.png] ...")
+    import argparse
+    parser = argparse.ArgumentParser(description="将地图图片切分为瓦片或复制为普通图片")
+    parser.add_argument('images', nargs='+', help="图片文件或现成的瓦片目录，例如 图片1.jpg 图片2.png")
+    parser.add_argument('--format', dest='tile_format', default=DEFAULT_TILE_FORMAT,
+                        choices=list(TILE_FORMATS), help="瓦片编码格式 (默认: png)")
+    parser.add_argument('--storage', default=DEFAULT_TILE_STORAGE, choices=TILE_STORAGES,
+                        help="瓦片存储方式: directory 为独立文件, archive 为单文件归档, "
+                             "lazy 为浏览时按需渲染 (默认: directory)")
+    args = parser.parse_args()
+
+    if not is_tile_format_supported(args.tile_format):
+        print(f"错误: 当前 Pillow 不支持 '{args.tile_format}' 编码，可用格式: {', '.join(get_available_tile_formats())}")
         sys.exit(1)
-    
+
     os.makedirs(OUTPUT_IMAGES_DIR, exist_ok=True)
 
-    for image_file in sys.argv[1:]:
-        process_image(image_file)
\ No newline at end of file
+    for image_file in args.images:
+        process_image(image_file, args.tile_format, args.storage)
\ No newline at end of file
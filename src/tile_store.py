@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+瓦片存取层
+为本地服务器的瓦片端点提供统一的读取接口：
+- 归档存储的地图从内存映射的归档中读取，目录存储的地图读取单个文件
+- 按需渲染的地图在瓦片缺失时交给 LazyTileManager 即时生成
+- 热点瓦片保存在按字节数限制大小的 LRU 缓存中，命中时无需任何文件系统调用
+- 每个瓦片附带强校验 ETag，配合 Cache-Control 让 QWebEngine 不再重复下载
+"""
+
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple
+from urllib.parse import unquote
+
+from tile_archive import TileArchivePool
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+# 瓦片只会在重新生成地图时变化，缓存一小时后用 ETag 重新验证
+TILE_CACHE_CONTROL = 'public, max-age=3600'
+
+TILE_URL_PATTERN = re.compile(r'^/tiles/([^/]+)/(\d+)/(\d+)/(\d+)\.(\w+)$')
+TILE_CONTENT_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+    'jpg': 'image/jpeg',
+}
+
+
+class Tile(NamedTuple):
+    """一个可直接发送的瓦片响应"""
+    data: bytes
+    etag: str
+    content_type: str
+
+
+def is_safe_map_name(map_name: str) -> bool:
+    """地图名只能是 tiles/ 下的一级目录名，拒绝 .、..、反斜杠、盘符和 NUL 等可能逃出瓦片目录的名字"""
+    return bool(map_name) and map_name not in ('.', '..') and not any(c in map_name for c in '/\\:\0')
+
+
+def parse_tile_path(path: str) -> Optional[Tuple[str, int, int, int, str]]:
+    """把 /tiles/<map>/<z>/<x>/<y>.<ext> 解析为 (map, z, x, y, ext)，不匹配或地图名不安全时返回 None"""
+    match = TILE_URL_PATTERN.match(unquote(path.split('?', 1)[0]))
+    if not match:
+        return None
+    map_name, z, x, y, ext = match.groups()
+    if not is_safe_map_name(map_name):
+        return None
+    return map_name, int(z), int(x), int(y), ext
+
+
+class TileCache:
+    """按总字节数限制大小的线程安全 LRU 缓存"""
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[tuple, Tile]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[Tile]:
+        with self._lock:
+            tile = self._items.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile: Tile):
+        size = len(tile.data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old.data)
+            self._items[key] = tile
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= len(evicted.data)
+
+    def invalidate(self, map_name: str):
+        """清除某张地图的所有缓存瓦片（键的第一项是地图名）"""
+        with self._lock:
+            for key in [k for k in self._items if k[0] == map_name]:
+                self.current_bytes -= len(self._items.pop(key).data)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class TileStore:
+    """从归档或瓦片目录读取瓦片，并维护 LRU 缓存"""
+
+    def __init__(self, tiles_dir: str, cache_bytes: int = DEFAULT_CACHE_BYTES, lazy_tiles=None):
+        self.tiles_dir = tiles_dir
+        self.archives = TileArchivePool(tiles_dir)
+        self.cache = TileCache(cache_bytes)
+        self.lazy_tiles = lazy_tiles
+
+    def get_tile(self, map_name: str, z: int, x: int, y: int, ext: str) -> Optional[Tile]:
+        """读取瓦片，不存在或地图名不安全时返回 None"""
+        if not is_safe_map_name(map_name):
+            return None
+        key = (map_name, z, x, y, ext)
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+
+        data = self._read_tile(map_name, z, x, y, ext)
+        if data is None:
+            return None
+
+        etag = '"' + hashlib.blake2b(data, digest_size=8).hexdigest() + '"'
+        tile = Tile(data, etag, TILE_CONTENT_TYPES.get(ext, 'application/octet-stream'))
+        self.cache.put(key, tile)
+        return tile
+
+    def peek_tile(self, map_name: str, z: int, x: int, y: int, ext: str) -> Optional[Tile]:
+        """只查询缓存，不读取文件，供事件循环线程在进入线程池前快速返回热点瓦片"""
+        return self.cache.get((map_name, z, x, y, ext))
+
+    def _read_tile(self, map_name, z, x, y, ext) -> Optional[bytes]:
+        reader = self.archives.get_reader(map_name)
+        if reader is not None:
+            # 归档只有一种格式，扩展名不符的请求返回 404，避免把其他格式的数据按请求的扩展名缓存和发送
+            archive_ext = reader.metadata.get('tileExt')
+            if archive_ext and archive_ext != ext:
+                return None
+            return reader.get_tile(z, x, y)
+
+        tile_path = os.path.join(self.tiles_dir, map_name, str(z), str(x), f'{y}.{ext}')
+        if not self._is_inside_tiles_dir(tile_path):
+            return None
+        try:
+            with open(tile_path, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+
+        if self.lazy_tiles is not None:
+            return self.lazy_tiles.render_tile(map_name, z, x, y, ext)
+        return None
+
+    def _is_inside_tiles_dir(self, path: str) -> bool:
+        """规范化后的路径仍在瓦片目录之下（不解析符号链接，链接到其他磁盘的地图目录仍可使用）"""
+        root = os.path.abspath(self.tiles_dir)
+        try:
+            return os.path.commonpath([root, os.path.abspath(path)]) == root
+        except ValueError:
+            # 不同盘符
+            return False
+
+    def invalidate(self, map_name: str):
+        """地图被删除或重新生成前调用：停止按需渲染、释放归档句柄并清除缓存"""
+        if self.lazy_tiles is not None:
+            self.lazy_tiles.discard(map_name)
+        self.archives.close(map_name)
+        self.cache.invalidate(map_name)
+
+    def close(self):
+        if self.lazy_tiles is not None:
+            self.lazy_tiles.stop_all()
+        self.archives.close_all()
+        self.cache.clear()
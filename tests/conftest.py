@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""测试使用 src/ 下的模块"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""message_codec 的二进制协议"""
+
+from message_codec import CODECS, CODEC_BINARY, JSON_CODEC, EncodedMessage
+
+BINARY_CODEC = CODECS[CODEC_BINARY]
+
+
+def test_binary_round_trip():
+    data = BINARY_CODEC.encode({"type": "jumpTo", "lat": -12.5, "lng": 40.25})
+    assert BINARY_CODEC.decode(data) == {"type": "jumpTo", "lat": -12.5, "lng": 40.25}
+
+
+def test_out_of_range_float_falls_back_to_json():
+    messages = [
+        {"type": "jumpTo", "lat": 1e40, "lng": 0},
+        {"type": "panBy", "x": -1e300, "y": 0},
+        {"type": "stateUpdate", "seq": 1, "lat": 0, "lng": 1e39, "zoom": 3},
+        {"type": "stateUpdate", "seq": 1, "lat": 0, "lng": "far away"},
+    ]
+    for message in messages:
+        encoded = EncodedMessage(message)
+        assert encoded.frame(BINARY_CODEC) is None
+        assert JSON_CODEC.decode(encoded.frame(JSON_CODEC)) == message
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""pyramid_importer 导入现成的瓦片目录"""
+
+import json
+import os
+
+from PIL import Image
+
+from pyramid_importer import estimate_image_size, import_tile_directory, scan_tile_directory
+
+
+def write_tile(root, z, x, y, color):
+    tile_dir = root / str(z) / str(x)
+    tile_dir.mkdir(parents=True, exist_ok=True)
+    Image.new('RGB', (256, 256), color).save(tile_dir / f'{y}.png')
+
+
+def make_offset_pyramid(root):
+    """只覆盖一个区域的瓦片包：级别 16~17，最高级别的瓦片编号从 (102, 40) 开始"""
+    for x in range(102, 105):
+        for y in range(40, 42):
+            write_tile(root, 17, x, y, (x, y, 0))
+    for x in range(51, 53):
+        write_tile(root, 16, x, 20, (x, 0, 0))
+    # 最高级别原点 (102, 40) 在 15 级对应 (25, 10)，102 不能被 4 整除，瓦片边界不对齐
+    write_tile(root, 15, 25, 10, (0, 0, 255))
+
+
+def test_offset_pyramid_is_rebased(tmp_path):
+    source = tmp_path / 'pack'
+    make_offset_pyramid(source)
+    base_dir = tmp_path / 'out'
+    base_dir.mkdir()
+
+    assert estimate_image_size(scan_tile_directory(str(source))["levels"][17]) == (768, 512)
+    assert import_tile_directory(str(source), 'region', base_dir=str(base_dir))
+
+    tiles_dir = base_dir / 'tiles' / 'region'
+    with open(base_dir / 'maps.json', encoding='utf-8') as f:
+        entry = next(item for item in json.load(f) if item['name'] == 'region')
+    assert (entry['width'], entry['height'], entry['maxZoom']) == (768, 512, 2)
+    # 级别 17 -> 2，瓦片编号从 (0, 0) 开始
+    assert sorted((int(x), int(os.path.splitext(y)[0]))
+                  for x in os.listdir(tiles_dir / '2') for y in os.listdir(tiles_dir / '2' / x)) == \
+        [(x, y) for x in range(3) for y in range(2)]
+    with Image.open(tiles_dir / '2' / '0' / '0.png') as tile:
+        assert tile.getpixel((0, 0)) == (102, 40, 0)
+    # 级别 16 -> 1，原点 (51, 20)
+    assert sorted(os.listdir(tiles_dir / '1')) == ['0', '1']
+    assert os.listdir(tiles_dir / '1' / '1') == ['0.png']
+    # 不对齐的级别不链接，登记为按需合成
+    assert not (tiles_dir / '0').exists()
+    assert entry['lazy'] is True
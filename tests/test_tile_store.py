@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""tile_store 的路径解析和读取"""
+
+import os
+
+import pytest
+
+from tile_archive import TileArchiveWriter, get_archive_path
+from tile_store import TileStore, parse_tile_path
+
+
+@pytest.fixture
+def store(tmp_path):
+    tiles_dir = tmp_path / 'tiles'
+    tile_dir = tiles_dir / 'world' / '0' / '0'
+    tile_dir.mkdir(parents=True)
+    (tile_dir / '0.png').write_bytes(b'tile')
+    # tiles/ 之外的文件
+    secret_dir = tmp_path / '0' / '0'
+    secret_dir.mkdir(parents=True)
+    (secret_dir / '0.png').write_bytes(b'secret')
+    return TileStore(str(tiles_dir))
+
+
+def test_parse_tile_path():
+    assert parse_tile_path('/tiles/world/3/1/2.webp?v=1') == ('world', 3, 1, 2, 'webp')
+    assert parse_tile_path('/tiles/%E4%B8%96%E7%95%8C/0/0/0.png') == ('世界', 0, 0, 0, 'png')
+
+
+@pytest.mark.parametrize('path', [
+    '/tiles/../0/0/0.png',
+    '/tiles/%2e%2e/0/0/0.png',
+    '/tiles/./0/0/0.png',
+    '/tiles/..%5C..%5Cwindows/0/0/0.png',
+    '/tiles/C:/0/0/0.png',
+    '/tiles/world%00/0/0/0.png',
+    '/tiles/%2e%2e%2f/0/0/0.png',
+])
+def test_parse_tile_path_rejects_traversal(path):
+    assert parse_tile_path(path) is None
+
+
+def test_get_tile_stays_inside_tiles_dir(store):
+    assert store.get_tile('world', 0, 0, 0, 'png').data == b'tile'
+    for name in ('..', '.', '..\\..', 'C:', 'a/..'):
+        assert store.get_tile(name, 0, 0, 0, 'png') is None
+    assert store._read_tile('..', 0, 0, 0, 'png') is None
+
+
+def test_archive_rejects_other_extension(tmp_path):
+    tiles_dir = tmp_path / 'tiles'
+    tiles_dir.mkdir()
+    writer = TileArchiveWriter(get_archive_path(str(tiles_dir), 'packed'))
+    writer.add_tile(0, 0, 0, b'webp-tile')
+    writer.close({"name": "packed", "tileFormat": "webp", "tileExt": "webp"})
+    store = TileStore(str(tiles_dir))
+    try:
+        assert store.get_tile('packed', 0, 0, 0, 'png') is None
+        assert store.get_tile('packed', 0, 0, 0, 'webp').data == b'webp-tile'
+        # 扩展名不符的请求没有以错误的键缓存数据
+        assert store.get_tile('packed', 0, 0, 0, 'png') is None
+    finally:
+        store.close()